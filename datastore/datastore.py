@@ -1,6 +1,20 @@
-from abc import ABC, abstractmethod
-from typing import Dict, List, Optional
 import asyncio
+import functools
+import os
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    TypeVar,
+    Union,
+)
 
 from models.models import (
     Document,
@@ -10,36 +24,74 @@ from models.models import (
     QueryResult,
     QueryWithEmbedding,
 )
-from services.chunks import get_document_chunks
-from services.openai import get_embeddings
+from services.embedding_cache import get_query_embedding_cache
+from services.jobs import JobProgress
+from services.pipeline import IngestPipeline
+from services.token_budget import QUERY_RESPONSE_MAX_TOKENS, pack_query_results
+
+# The number of blocking client calls a datastore runs at once, each in a thread of its own pool
+DATASTORE_MAX_WORKERS = int(os.environ.get("DATASTORE_MAX_WORKERS", 16))
+
+T = TypeVar("T")
 
 
 class DataStore(ABC):
+    # The number of chunks written per _upsert call by import_chunks, set by each provider to the
+    # batch size its writes are most efficient at
+    IMPORT_BATCH_SIZE = 500
+    # Whether the index name selects an index of its own, so delete_all only deletes the chunks of
+    # that index. Providers that keep every index name in one shared collection leave it False
+    SEPARATE_INDEXES = False
+
+    # The thread pool of the blocking client calls of the datastore, created on first use
+    _executor: Optional[ThreadPoolExecutor] = None
+
+    async def _run_sync(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Run a call of a blocking client in the bounded thread pool of the datastore, so it doesn't
+        block the event loop and concurrent queries and writes actually overlap. The pool is bounded
+        by DATASTORE_MAX_WORKERS, so a burst of requests can't open unbounded connections.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                DATASTORE_MAX_WORKERS, thread_name_prefix=type(self).__name__
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def ensure_index(self) -> None:
+        """
+        Create the index of the datastore if it doesn't exist, for a caller asking to create an index
+        whose handle is already open. Providers that create their index along with the handle have
+        nothing to do.
+        """
+
+    async def close(self) -> None:
+        """
+        Release the clients and the thread pool of the datastore, once it is dropped from the
+        registry. Calls already in the thread pool still run.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
     async def upsert(
-        self, documents: List[Document], chunk_token_size: Optional[int] = None
+        self,
+        documents: List[Document],
+        chunk_token_size: Optional[int] = None,
+        progress: Optional[JobProgress] = None,
     ) -> List[str]:
         """
         Takes in a list of documents and inserts them into the database.
         First deletes all the existing vectors with the document id (if necessary, depends on the vector db), then inserts the new ones.
+        If a progress is given, the number of chunks embedded and vectors written are recorded to it.
         Return a list of document ids.
         """
-        # Delete any existing vectors for documents with the input document ids
-        await asyncio.gather(
-            *[
-                self.delete(
-                    filter=DocumentMetadataFilter(
-                        document_id=document.id,
-                    ),
-                    delete_all=False,
-                )
-                for document in documents
-                if document.id
-            ]
-        )
-
-        chunks = get_document_chunks(documents, chunk_token_size)
-
-        return await self._upsert(chunks)
+        # deletes, chunking, embedding and writes run as concurrent pipeline stages
+        pipeline = IngestPipeline(self, chunk_token_size, progress=progress)
+        return await pipeline.run(documents)
 
     @abstractmethod
     async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
@@ -50,20 +102,80 @@ class DataStore(ABC):
 
         raise NotImplementedError
 
-    async def query(self, queries: List[Query], index) -> List[QueryResult]:
+    async def query(
+        self, queries: List[Query], index, max_response_tokens: Optional[int] = None
+    ) -> List[QueryResult]:
         """
         Takes in a list of queries and filters and returns a list of query results with matching document chunks and scores.
+        With max_response_tokens, or QUERY_RESPONSE_MAX_TOKENS if it is set, the chunks of all the results fit in that many
+        tokens: the lowest ranked ones that don't fit and the repeats of chunks returned by an earlier query are left out.
         """
         # get a list of of just the queries from the Query list
         query_texts = [query.query for query in queries]
-        query_embeddings = get_embeddings(query_texts)
+        # repeated and concurrent identical queries share cached or in-flight embeddings
+        query_embeddings = await get_query_embedding_cache().get_embeddings(query_texts)
         # hydrate the queries with embeddings
         queries_with_embeddings = [
             QueryWithEmbedding(**query.dict(), embedding=embedding)
             for query, embedding in zip(queries, query_embeddings)
         ]
         print("Query - checking specific datastore")
-        return await self._query(queries_with_embeddings, index)
+        results = await self._query(queries_with_embeddings, index)
+        # providers leave the vectors out of their searches unless asked to, drop any that a
+        # provider returns anyway so they aren't serialized into the response
+        for query, result in zip(queries, results):
+            if not query.include_embeddings:
+                for chunk in result.results:
+                    chunk.embedding = None
+        if max_response_tokens is None:
+            max_response_tokens = QUERY_RESPONSE_MAX_TOKENS
+        return pack_query_results(results, max_response_tokens)
+
+    async def export_chunks(self, batch_size: int = 1000) -> AsyncIterator[List[DocumentChunk]]:
+        """
+        Yields every chunk of the datastore with its text, metadata and embedding, in batches of up
+        to batch_size chunks, so an export holds one batch in memory at a time.
+        Providers that can enumerate their vectors override this.
+        """
+        raise NotImplementedError(f"{type(self).__name__} can't export its chunks")
+        yield  # makes this an async generator, like the overrides
+
+    async def import_chunks(
+        self,
+        batches: Union[Iterable[List[DocumentChunk]], AsyncIterable[List[DocumentChunk]]],
+        progress: Optional[JobProgress] = None,
+    ) -> int:
+        """
+        Writes chunks that already have their embeddings, such as an export of another index, without
+        chunking or embedding them again. The chunks are grouped by their document_id metadata and
+        written in batches of IMPORT_BATCH_SIZE. Existing vectors are not deleted first, so this is
+        meant to fill an empty index.
+        Returns the number of chunks written.
+        """
+        count = 0
+        pending: List[DocumentChunk] = []
+
+        async def write(chunks: List[DocumentChunk]):
+            chunks_by_document: Dict[str, List[DocumentChunk]] = {}
+            for chunk in chunks:
+                if chunk.embedding is None:
+                    raise ValueError(f"Chunk {chunk.id} has no embedding to import")
+                doc_id = chunk.metadata.document_id if chunk.metadata else None
+                chunks_by_document.setdefault(doc_id or "", []).append(chunk)
+            await self._upsert(chunks_by_document)
+            if progress is not None:
+                progress.record_vectors(len(chunks))
+
+        async for batch in _iter_batches(batches):
+            pending.extend(batch)
+            while len(pending) >= self.IMPORT_BATCH_SIZE:
+                await write(pending[: self.IMPORT_BATCH_SIZE])
+                count += self.IMPORT_BATCH_SIZE
+                del pending[: self.IMPORT_BATCH_SIZE]
+        if pending:
+            await write(pending)
+            count += len(pending)
+        return count
 
     @abstractmethod
     async def _query(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
@@ -72,6 +184,15 @@ class DataStore(ABC):
         """
         raise NotImplementedError
 
+    async def delete_documents(self, document_ids: List[str]) -> bool:
+        """
+        Removes the vectors of all the given documents, before they are written again by upsert.
+        Every provider deletes by document ids with delete(ids=...), in as few round trips as its
+        client allows.
+        Returns whether the operation was successful.
+        """
+        return await self.delete(ids=document_ids)
+
     @abstractmethod
     async def delete(
         self,
@@ -85,3 +206,19 @@ class DataStore(ABC):
         Returns whether the operation was successful.
         """
         raise NotImplementedError
+
+
+async def _iter_batches(
+    batches: Union[Iterable[List[DocumentChunk]], AsyncIterable[List[DocumentChunk]]]
+) -> AsyncIterator[List[DocumentChunk]]:
+    if isinstance(batches, AsyncIterable):
+        async for batch in batches:
+            yield batch
+    else:
+        # reading a batch from a file is blocking, so the iterable is advanced in a thread
+        iterator = iter(batches)
+        while True:
+            batch = await asyncio.to_thread(next, iterator, None)
+            if batch is None:
+                return
+            yield batch
@@ -1,12 +1,25 @@
 from datastore.datastore import DataStore
+from datastore.registry import DataStoreRegistry
 import os
 
 
 async def get_datastore(index_name, create_index=False) -> DataStore:
+    """
+    Return a warm handle of the datastore for an index from the process-wide registry.
+    With create_index, the index is created if it doesn't exist, on the open handle if there is one.
+    """
+    return await _registry.get(index_name, create_index)
+
+
+async def create_datastore(index_name, create_index=False) -> DataStore:
     datastore = os.environ.get("DATASTORE")
     assert datastore is not None
 
     match datastore:
+        case "local":
+            from datastore.providers.local_datastore import LocalDataStore
+
+            return LocalDataStore(index_name, create_index)
         case "llama":
             from datastore.providers.llama_datastore import LlamaDataStore
             return LlamaDataStore()
@@ -37,3 +50,6 @@ async def get_datastore(index_name, create_index=False) -> DataStore:
             return QdrantDataStore()
         case _:
             raise ValueError(f"Unsupported vector database: {datastore}")
+
+
+_registry = DataStoreRegistry(create_datastore)
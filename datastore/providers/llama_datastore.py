@@ -3,6 +3,7 @@ import os
 from typing import Dict, List, Optional, Type
 from loguru import logger
 from datastore.datastore import DataStore
+from models.embeddings import embedding_to_list
 from models.models import DocumentChunk, DocumentChunkMetadata, DocumentChunkWithScore, DocumentMetadataFilter, Query, QueryResult, QueryWithEmbedding
 
 from llama_index.indices.base import BaseGPTIndex
@@ -66,7 +67,7 @@ def _doc_chunk_to_node(doc_chunk: DocumentChunk, source_doc_id: str) -> Node:
     return Node(
         doc_id=doc_chunk.id,
         text=doc_chunk.text,
-        embedding=doc_chunk.embedding,
+        embedding=embedding_to_list(doc_chunk.embedding),
         extra_info=doc_chunk.metadata.dict(),
         relationships={
             DocumentRelationship.SOURCE: source_doc_id
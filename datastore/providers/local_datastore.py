@@ -0,0 +1,868 @@
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+import numpy as np
+from fastapi import HTTPException
+
+from datastore.datastore import DataStore
+from datastore.providers.local_ivfpq import (
+    PQ_CENTROIDS,
+    TRAIN_SAMPLES_PER_CENTROID,
+    IVFPQIndex,
+    open_array,
+)
+from models.embeddings import assign_embeddings, stack_embeddings
+from models.models import (
+    DocumentChunk,
+    DocumentChunkMetadata,
+    DocumentChunkWithScore,
+    DocumentMetadataFilter,
+    QueryResult,
+    QueryWithEmbedding,
+)
+from services.chunks import count_tokens
+from services.date import to_unix_timestamp
+from services.quantization import (
+    VECTOR_PRECISION,
+    VECTOR_RESCORE,
+    float_dtype,
+    quantize_int8,
+    rescore,
+)
+
+# The directory holding one subdirectory per index
+LOCAL_DATASTORE_PATH = os.environ.get("LOCAL_DATASTORE_PATH", "local_datastore")
+
+# The search index of new indexes, "flat" for an exact search over all rows or "ivfpq" for an
+# approximate search with an IVF-PQ index
+LOCAL_INDEX_TYPE = os.environ.get("LOCAL_INDEX_TYPE", "flat")
+assert LOCAL_INDEX_TYPE in ("flat", "ivfpq")
+# The build parameters of new IVF-PQ indexes: the number of lists, the number of subspaces of the
+# product quantizer, and the number of rows needed to train them
+LOCAL_IVF_NLIST = int(os.environ.get("LOCAL_IVF_NLIST", 1024))
+LOCAL_PQ_M = int(os.environ.get("LOCAL_PQ_M", 64))
+LOCAL_IVF_MIN_TRAIN_ROWS = int(os.environ.get("LOCAL_IVF_MIN_TRAIN_ROWS", 50000))
+# The search parameters of new IVF-PQ indexes: the number of lists searched, and the number of
+# candidates rescored with the full vectors
+LOCAL_IVF_NPROBE = int(os.environ.get("LOCAL_IVF_NPROBE", 16))
+LOCAL_IVF_RERANK = int(os.environ.get("LOCAL_IVF_RERANK", 100))
+
+# The number of rows the files of a new index have room for, they double in size when full
+INITIAL_CAPACITY = 1024
+# Compact the files once more than this share of their rows are deleted
+COMPACT_DELETED_RATIO = 0.5
+# The number of rows copied at a time when compacting
+COMPACT_BATCH_SIZE = 65536
+# The number of rows scored at a time by an exact search, which bounds the memory used to convert
+# float16 and int8 rows to float32
+SCAN_BATCH_SIZE = 65536
+
+# The created_at timestamp of chunks without a date
+NO_TIMESTAMP = np.iinfo(np.int64).min
+# The code of a missing value in a dictionary encoded column
+NO_VALUE = -1
+
+# The metadata fields stored as dictionary encoded columns
+METADATA_FIELDS = list(DocumentChunkMetadata.__fields__.keys())
+# The metadata fields that can be filtered on by equality
+FILTER_FIELDS = ["document_id", "source", "source_id", "author"]
+
+
+def _write_json(path: str, data):
+    """Write a JSON file atomically, so a crash keeps the previous version."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def default_index_params() -> Dict:
+    params = {"precision": VECTOR_PRECISION, "rescore": VECTOR_RESCORE}
+    if LOCAL_INDEX_TYPE == "flat":
+        return {"type": "flat", **params}
+    return {
+        "type": "ivfpq",
+        **params,
+        "nlist": LOCAL_IVF_NLIST,
+        "m": LOCAL_PQ_M,
+        "min_train_rows": LOCAL_IVF_MIN_TRAIN_ROWS,
+        "nprobe": LOCAL_IVF_NPROBE,
+        "rerank": LOCAL_IVF_RERANK,
+    }
+
+
+class ReadWriteLock:
+    """
+    A lock held by any number of readers at once or by a single writer. Waiting writers go before
+    new readers, so a steady stream of queries can't starve the writes.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        with self._condition:
+            while self._writing or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class BlobColumn:
+    """
+    A column of strings stored back to back in a data file, with the offset of each row's string
+    in a memory-mapped offsets array, so a row is read without loading the others.
+    """
+
+    def __init__(self, directory: str, name: str, capacity: int):
+        self.data_path = os.path.join(directory, f"{name}.bin")
+        self.offsets_path = os.path.join(directory, f"{name}.offsets")
+        open(self.data_path, "ab").close()
+        self.offsets = open_array(self.offsets_path, np.int64, (capacity + 1,))
+        self._data: Optional[np.memmap] = None
+
+    def grow(self, capacity: int):
+        self.offsets.flush()
+        self.offsets = open_array(self.offsets_path, np.int64, (capacity + 1,))
+
+    def append(self, row: int, values: List[str]):
+        """Write the strings of the rows starting at row, over anything written after the committed rows."""
+        encoded = [value.encode("utf-8") for value in values]
+        start = int(self.offsets[row])
+        with open(self.data_path, "r+b") as file:
+            file.seek(start)
+            file.write(b"".join(encoded))
+        lengths = np.fromiter((len(value) for value in encoded), np.int64, len(encoded))
+        self.offsets[row + 1 : row + 1 + len(encoded)] = start + np.cumsum(lengths)
+        self._data = None
+
+    def get(self, row: int) -> str:
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        if start == end:
+            return ""
+        if self._data is None or len(self._data) < end:
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode="r")
+        return bytes(self._data[start:end]).decode("utf-8")
+
+    def flush(self):
+        self.offsets.flush()
+
+
+class LocalDataStore(DataStore):
+    """
+    A datastore kept in local files, for single node deployments and benchmarks without an external service.
+
+    Each index is a directory with an index.json file, the commit point, and a generation directory of
+    column files for its chunk rows:
+
+    - vectors.f32: the normalized embeddings, as a memory-mapped float32 matrix, or vectors.f16 for
+      indexes with float16 precision
+    - vectors.i8 and scales.f32: for indexes with int8 precision, the embeddings quantized to int8
+      codes and a scale per row, which exact searches scan before rescoring the best candidates
+      with vectors.f32
+    - alive.u8: whether each row is alive, deletes only clear this flag until the files are compacted
+    - created_at.i64: the created_at date of each row as a unix timestamp, for date range filters
+    - <field>.i32: a dictionary encoded column per metadata field, with the values in dictionaries.json
+    - token_count.i32: the number of tokens of the text of each row, 0 for rows written before it was stored
+    - ids and text: the chunk ids and texts as blob columns
+
+    Rows are appended to the files first and only become visible once index.json records the new row
+    count, so an interrupted write leaves the index as it was. Opening an index maps the files
+    without reading them, so it takes milliseconds whatever the size of the index.
+    Queries score all rows with a matrix product and select the top k with argpartition. The numpy
+    work and file writes run in the thread pool of the datastore, so they don't block the event loop:
+    queries run concurrently under the read side of a lock, and writes under its write side. Indexes
+    created with the "ivfpq" index type instead search an IVF-PQ index once they have enough rows
+    to train it, trading some recall for latency on large indexes.
+    """
+
+    # Every _upsert commits index.json, so imports write large batches
+    IMPORT_BATCH_SIZE = 10000
+    SEPARATE_INDEXES = True
+
+    def __init__(
+        self,
+        index_name: Optional[str] = None,
+        create_index: bool = False,
+        path: str = LOCAL_DATASTORE_PATH,
+        index_params: Optional[Dict] = None,
+    ):
+        """
+        Args:
+            index_name: The name of the index, the directory of its files under path.
+            create_index: Whether to create the index if it doesn't exist.
+            path: The directory holding the indexes.
+            index_params: The search index of a new index and its parameters, see default_index_params.
+        """
+        self.directory = os.path.join(path, index_name or "default")
+        self.index_path = os.path.join(self.directory, "index.json")
+        # guards the state and the column files, which writes replace when they grow or compact them
+        self._lock = ReadWriteLock()
+        # whether an upsert is training the IVF-PQ index
+        self._training = False
+        # whether the column files were unmapped by close
+        self._closed = False
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                self.state = json.load(index_file)
+        elif create_index or not index_name:
+            print(f"Creating local index in {self.directory}")
+            os.makedirs(self.directory, exist_ok=True)
+            self.state = {
+                "generation": 0,
+                "dimension": None,
+                "count": 0,
+                "capacity": INITIAL_CAPACITY,
+                "index": index_params or default_index_params(),
+            }
+        else:
+            raise HTTPException(status_code=404, detail="Repo is not indexed. You can index it by posting to the /index-repo endpoint.")
+
+        self._open()
+        if not os.path.exists(self.index_path):
+            self._commit()
+
+    @contextmanager
+    def _reading(self) -> Iterator[None]:
+        with self._lock.read():
+            self._check_open()
+            yield
+
+    @contextmanager
+    def _writing(self) -> Iterator[None]:
+        with self._lock.write():
+            self._check_open()
+            yield
+
+    def _check_open(self):
+        if self._closed:
+            raise RuntimeError(f"The local index in {self.directory} was closed")
+
+    async def close(self) -> None:
+        await self._run_sync(self._close)
+        await super().close()
+
+    def _close(self):
+        """Flush the column files and unmap them, once the searches and writes running on them are done."""
+        with self._lock.write():
+            if self._closed:
+                return
+            self._flush()
+            self._closed = True
+            # the files are unmapped when the last reference to their arrays goes
+            self.vectors = self.quantized = self.scales = self.ann = None
+            del self.alive, self.created_at, self.token_counts, self.codes, self.ids, self.texts
+
+    @property
+    def count(self) -> int:
+        return self.state["count"]
+
+    @property
+    def index_params(self) -> Dict:
+        # indexes written before there was a choice of search index are flat
+        return self.state.setdefault("index", {"type": "flat"})
+
+    @property
+    def precision(self) -> str:
+        # indexes written before there was a choice of precision store float32 vectors
+        return self.index_params.get("precision", "float32")
+
+    def set_search_params(
+        self,
+        nprobe: Optional[int] = None,
+        rerank: Optional[int] = None,
+        rescore: Optional[int] = None,
+    ):
+        """
+        Set the search parameters, which trade recall for latency: nprobe and rerank of an IVF-PQ
+        index, and the number of candidates of an int8 index rescored at full precision.
+        """
+        if (nprobe is not None or rerank is not None) and self.index_params["type"] != "ivfpq":
+            raise ValueError(f"{self.directory} has no IVF-PQ index")
+        with self._writing():
+            if nprobe is not None:
+                self.index_params["nprobe"] = nprobe
+            if rerank is not None:
+                self.index_params["rerank"] = rerank
+            if rescore is not None:
+                self.index_params["rescore"] = rescore
+            self._commit()
+
+    def _generation_directory(self, generation: int) -> str:
+        return os.path.join(self.directory, f"gen-{generation}")
+
+    def _open(self):
+        """Map the column files of the current generation."""
+        directory = self._generation_directory(self.state["generation"])
+        os.makedirs(directory, exist_ok=True)
+        capacity = self.state["capacity"]
+
+        self.vectors: Optional[np.memmap] = None
+        self.quantized: Optional[np.memmap] = None
+        self.scales: Optional[np.memmap] = None
+        self._open_vectors(directory, capacity)
+        self.alive = open_array(os.path.join(directory, "alive.u8"), np.uint8, (capacity,))
+        self.created_at = open_array(
+            os.path.join(directory, "created_at.i64"), np.int64, (capacity,)
+        )
+        self.token_counts = open_array(
+            os.path.join(directory, "token_count.i32"), np.int32, (capacity,)
+        )
+        self.codes = {
+            field: open_array(os.path.join(directory, f"{field}.i32"), np.int32, (capacity,))
+            for field in METADATA_FIELDS
+        }
+        self.ids = BlobColumn(directory, "ids", capacity)
+        self.texts = BlobColumn(directory, "text", capacity)
+        self.ann: Optional[IVFPQIndex] = None
+        if self.index_params["type"] == "ivfpq" and self.state["dimension"] is not None:
+            self.ann = IVFPQIndex(directory, self.index_params, self.state["dimension"], capacity)
+
+        self.dictionaries: Dict[str, List[str]] = {field: [] for field in METADATA_FIELDS}
+        dictionaries_path = os.path.join(directory, "dictionaries.json")
+        if os.path.exists(dictionaries_path):
+            with open(dictionaries_path) as dictionaries_file:
+                self.dictionaries.update(json.load(dictionaries_file))
+        self._value_codes = {
+            field: {value: code for code, value in enumerate(values)}
+            for field, values in self.dictionaries.items()
+        }
+
+    def _grow(self, capacity: int):
+        """Grow the column files to hold capacity rows."""
+        self._flush()
+        self.state["capacity"] = capacity
+        directory = self._generation_directory(self.state["generation"])
+        self._open_vectors(directory, capacity)
+        self.alive = open_array(os.path.join(directory, "alive.u8"), np.uint8, (capacity,))
+        self.created_at = open_array(
+            os.path.join(directory, "created_at.i64"), np.int64, (capacity,)
+        )
+        self.token_counts = open_array(
+            os.path.join(directory, "token_count.i32"), np.int32, (capacity,)
+        )
+        for field in METADATA_FIELDS:
+            self.codes[field] = open_array(
+                os.path.join(directory, f"{field}.i32"), np.int32, (capacity,)
+            )
+        self.ids.grow(capacity)
+        self.texts.grow(capacity)
+        if self.ann is not None:
+            self.ann.grow(capacity)
+        elif self.index_params["type"] == "ivfpq" and self.state["dimension"] is not None:
+            self.ann = IVFPQIndex(directory, self.index_params, self.state["dimension"], capacity)
+
+    def _open_vectors(self, directory: str, capacity: int):
+        """Map the vector files for the precision of the index, once the dimension is known."""
+        dimension = self.state["dimension"]
+        if dimension is None:
+            return
+        dtype = float_dtype(self.precision)
+        self.vectors = open_array(
+            os.path.join(directory, "vectors.f16" if dtype == np.float16 else "vectors.f32"),
+            dtype,
+            (capacity, dimension),
+        )
+        if self.precision == "int8":
+            self.quantized = open_array(
+                os.path.join(directory, "vectors.i8"), np.int8, (capacity, dimension)
+            )
+            self.scales = open_array(os.path.join(directory, "scales.f32"), np.float32, (capacity,))
+
+    def _flush(self):
+        if self.vectors is not None:
+            self.vectors.flush()
+        if self.quantized is not None and self.scales is not None:
+            self.quantized.flush()
+            self.scales.flush()
+        self.alive.flush()
+        self.created_at.flush()
+        self.token_counts.flush()
+        for codes in self.codes.values():
+            codes.flush()
+        self.ids.flush()
+        self.texts.flush()
+        if self.ann is not None:
+            self.ann.flush()
+
+    def _commit(self):
+        """Flush the column files, then make their rows visible by writing index.json."""
+        self._flush()
+        directory = self._generation_directory(self.state["generation"])
+        _write_json(os.path.join(directory, "dictionaries.json"), self.dictionaries)
+        _write_json(self.index_path, self.state)
+
+    def _encode(self, field: str, value: Optional[str]) -> int:
+        if value is None:
+            return NO_VALUE
+        code = self._value_codes[field].get(value)
+        if code is None:
+            code = len(self.dictionaries[field])
+            self.dictionaries[field].append(value)
+            self._value_codes[field][value] = code
+        return code
+
+    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+        """
+        Takes in a dict of document ids to list of document chunks and appends them to the index.
+        Return a list of document ids.
+        """
+        document_ids = await self._run_sync(self._write_chunks, chunks)
+        # the IVF-PQ index is trained in the thread pool too, without holding the lock for the
+        # training itself, so queries and writes go on while it runs
+        await self._run_sync(self._train_ann)
+        return document_ids
+
+    def _write_chunks(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+        with self._writing():
+            return self._append_chunks(chunks)
+
+    def _append_chunks(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+        rows = [(doc_id, chunk) for doc_id, doc_chunks in chunks.items() for chunk in doc_chunks]
+        if not rows:
+            return list(chunks.keys())
+
+        embeddings = stack_embeddings([chunk.embedding for _, chunk in rows])  # type: ignore
+        if self.state["dimension"] is None:
+            self.state["dimension"] = embeddings.shape[1]
+            self._grow(self.state["capacity"])
+        elif embeddings.shape[1] != self.state["dimension"]:
+            raise ValueError(
+                f"Embeddings of dimension {embeddings.shape[1]} can't be added to an index of dimension {self.state['dimension']}"
+            )
+        # store unit vectors, so the dot product of a query with them is the cosine similarity
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.where(norms > 0, norms, 1)
+
+        start, end = self.count, self.count + len(rows)
+        capacity = self.state["capacity"]
+        while capacity < end:
+            capacity *= 2
+        if capacity != self.state["capacity"]:
+            self._grow(capacity)
+
+        self.vectors[start:end] = embeddings  # type: ignore
+        if self.quantized is not None and self.scales is not None:
+            self.quantized[start:end], self.scales[start:end] = quantize_int8(embeddings)
+        self.alive[start:end] = 1
+        metadatas = [
+            chunk.metadata.copy(update={"document_id": doc_id})
+            if chunk.metadata is not None
+            else DocumentChunkMetadata(document_id=doc_id)
+            for doc_id, chunk in rows
+        ]
+        self.created_at[start:end] = [
+            to_unix_timestamp(metadata.created_at)
+            if metadata.created_at is not None
+            else NO_TIMESTAMP
+            for metadata in metadatas
+        ]
+        for field in METADATA_FIELDS:
+            self.codes[field][start:end] = [
+                self._encode(field, _to_str(getattr(metadata, field)))
+                for metadata in metadatas
+            ]
+        # chunks imported from a bulk file or another datastore may not have been counted
+        self.token_counts[start:end] = [
+            chunk.token_count if chunk.token_count is not None else count_tokens(chunk.text)
+            for _, chunk in rows
+        ]
+        self.ids.append(start, [chunk.id or "" for _, chunk in rows])
+        self.texts.append(start, [chunk.text for _, chunk in rows])
+        if self.ann is not None and self.ann.trained:
+            self.ann.add(start, embeddings)
+
+        self.state["count"] = end
+        self._commit()
+        return list(chunks.keys())
+
+    def _train_ann(self):
+        """
+        Train the IVF-PQ index once there are enough rows, and add the rows to it. The sample is
+        copied under the lock, the model is trained without it, and the rows are encoded under it
+        again, so only one upsert trains the index and queries use exact search until it is ready.
+        """
+        with self._writing():
+            ann = self.ann
+            if ann is None or ann.trained or self._training:
+                return
+            live_rows = np.flatnonzero(self.alive[: self.count])
+            if len(live_rows) < max(ann.min_train_rows, PQ_CENTROIDS):
+                return
+
+            num_samples = max(ann.nlist, PQ_CENTROIDS) * TRAIN_SAMPLES_PER_CENTROID
+            if len(live_rows) > num_samples:
+                live_rows = np.sort(np.random.default_rng(0).choice(live_rows, num_samples, replace=False))
+            sample = np.asarray(self.vectors[live_rows], dtype=np.float32)  # type: ignore
+            self._training = True
+
+        try:
+            centroids, codebooks = ann.fit(sample)
+        except Exception:
+            with self._lock.write():
+                self._training = False
+            raise
+
+        with self._writing():
+            self._training = False
+            # the index may have been rewritten meanwhile, the model fits its new files as well
+            if self.ann is None or self.ann.trained:
+                return
+            self.ann.save_model(centroids, codebooks)
+            for start in range(0, self.count, COMPACT_BATCH_SIZE):
+                end = min(start + COMPACT_BATCH_SIZE, self.count)
+                self.ann.add(start, self.vectors[start:end])  # type: ignore
+            self._commit()
+
+    async def _query(
+        self,
+        queries: List[QueryWithEmbedding],
+        repo_url: Optional[str] = None,
+    ) -> List[QueryResult]:
+        """
+        Takes in a list of queries with embeddings and filters and returns a list of query results with matching document chunks and scores.
+        """
+        return await self._run_sync(self._search, queries)
+
+    def _search(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
+        with self._reading():
+            return self._search_rows(queries)
+
+    def _search_rows(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
+        if self.vectors is None or self.count == 0:
+            return [QueryResult(query=query.query, results=[]) for query in queries]
+
+        query_embeddings = np.asarray([query.embedding for query in queries], dtype=np.float32)
+        norms = np.linalg.norm(query_embeddings, axis=1, keepdims=True)
+        query_embeddings /= np.where(norms > 0, norms, 1)
+
+        use_ann = self.ann is not None and self.ann.trained
+        if not use_ann:
+            scores = self._scan(query_embeddings)
+        num_rescored = self.index_params.get("rescore", 0) if self.quantized is not None else 0
+
+        results = []
+        for i, query in enumerate(queries):
+            mask = self.alive[: self.count]
+            filter_mask = self._filter_mask(query.filter)
+            if filter_mask is not None:
+                mask = filter_mask & mask.astype(bool)
+            if use_ann:
+                rows, row_scores = self.ann.search(  # type: ignore
+                    query_embeddings[i], mask, query.top_k or 0, self.vectors
+                )
+            elif num_rescored > 0:
+                # rescore the best candidates by their int8 scores with the full precision vectors
+                k = query.top_k or 0
+                rows = self._top_k(scores[:, i], mask, max(k, num_rescored))
+                rows, row_scores = rescore(
+                    rows,
+                    scores[rows, i],
+                    lambda rows: self.vectors[rows] @ query_embeddings[i],  # type: ignore
+                    k,
+                    num_rescored,
+                )
+            else:
+                rows = self._top_k(scores[:, i], mask, query.top_k or 0)
+                row_scores = scores[rows, i]
+            results.append(
+                QueryResult(
+                    query=query.query,
+                    results=[
+                        self._get_chunk(row, float(score), query.include_embeddings)
+                        for row, score in zip(rows, row_scores)
+                    ],
+                )
+            )
+        return results
+
+    def _scan(self, query_embeddings: np.ndarray) -> np.ndarray:
+        """
+        Score every row against every query with a matrix product per batch of rows. Indexes with
+        int8 precision are scored from their int8 codes, which are a quarter of the bytes to read.
+        """
+        scores = np.empty((self.count, len(query_embeddings)), dtype=np.float32)
+        for start in range(0, self.count, SCAN_BATCH_SIZE):
+            end = min(start + SCAN_BATCH_SIZE, self.count)
+            if self.quantized is not None and self.scales is not None:
+                block = self.quantized[start:end].astype(np.float32) @ query_embeddings.T
+                scores[start:end] = block * self.scales[start:end, None]
+            else:
+                scores[start:end] = (
+                    np.asarray(self.vectors[start:end], dtype=np.float32) @ query_embeddings.T  # type: ignore
+                )
+        return scores
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, mask: np.ndarray, k: int) -> np.ndarray:
+        """Return the rows with the k highest scores among the rows in mask, best first."""
+        candidates = np.flatnonzero(mask)
+        if k <= 0 or len(candidates) == 0:
+            return candidates[:0]
+        candidate_scores = scores[candidates]
+        if len(candidates) > k:
+            # select the k best in linear time, then only sort those
+            best = np.argpartition(-candidate_scores, k - 1)[:k]
+            candidates, candidate_scores = candidates[best], candidate_scores[best]
+        return candidates[np.argsort(-candidate_scores, kind="stable")]
+
+    def _get_metadata(self, row: int) -> DocumentChunkMetadata:
+        metadata = {
+            field: self.dictionaries[field][code] if code != NO_VALUE else None
+            for field, code in ((field, int(self.codes[field][row])) for field in METADATA_FIELDS)
+        }
+        return DocumentChunkMetadata(**metadata)
+
+    def _get_token_count(self, row: int) -> Optional[int]:
+        token_count = int(self.token_counts[row])
+        return token_count if token_count > 0 else None
+
+    def _get_chunk(
+        self, row: int, score: float, include_embedding: Optional[bool] = False
+    ) -> DocumentChunkWithScore:
+        chunk = DocumentChunkWithScore(
+            id=self.ids.get(row),
+            text=self.texts.get(row),
+            metadata=self._get_metadata(row),
+            token_count=self._get_token_count(row),
+            score=score,
+        )
+        if include_embedding:
+            # the stored vectors are normalized
+            chunk.embedding = np.asarray(self.vectors[row], dtype=np.float32).tolist()  # type: ignore
+        return chunk
+
+    async def export_chunks(self, batch_size: int = 1000) -> AsyncIterator[List[DocumentChunk]]:
+        """Yields the live chunks in row order, with their normalized embeddings as float32 rows."""
+        start = 0
+        while True:
+            chunks = await self._run_sync(self._read_chunks, start, batch_size)
+            if chunks is None:
+                return
+            if chunks:
+                yield chunks
+            start += batch_size
+
+    def _read_chunks(self, start: int, batch_size: int) -> Optional[List[DocumentChunk]]:
+        """Return the live chunks of the rows from start, or None past the last row."""
+        with self._reading():
+            if self.vectors is None or start >= self.count:
+                return None
+            end = min(start + batch_size, self.count)
+            rows = start + np.flatnonzero(self.alive[start:end])
+            chunks = [
+                DocumentChunk(
+                    id=self.ids.get(row),
+                    text=self.texts.get(row),
+                    metadata=self._get_metadata(row),
+                    token_count=self._get_token_count(row),
+                )
+                for row in rows
+            ]
+            if chunks:
+                assign_embeddings(chunks, np.asarray(self.vectors[rows], dtype=np.float32))
+            return chunks
+
+    def _filter_mask(
+        self, filter: Optional[DocumentMetadataFilter]
+    ) -> Optional[np.ndarray]:
+        """Return the rows matching a metadata filter, or None if the filter has no conditions."""
+        if filter is None:
+            return None
+
+        mask: Optional[np.ndarray] = None
+
+        def restrict(condition: np.ndarray):
+            nonlocal mask
+            mask = condition if mask is None else mask & condition
+
+        for field in FILTER_FIELDS:
+            value = _to_str(getattr(filter, field))
+            if value is None:
+                continue
+            code = self._value_codes[field].get(value)
+            if code is None:
+                # the value isn't in the dictionary, so no row has it
+                restrict(np.zeros(self.count, dtype=bool))
+            else:
+                restrict(self.codes[field][: self.count] == code)
+
+        if filter.start_date is not None or filter.end_date is not None:
+            created_at = self.created_at[: self.count]
+            condition = created_at != NO_TIMESTAMP
+            if filter.start_date is not None:
+                condition &= created_at >= to_unix_timestamp(filter.start_date)
+            if filter.end_date is not None:
+                condition &= created_at <= to_unix_timestamp(filter.end_date)
+            restrict(condition)
+
+        return mask
+
+    async def delete(
+        self,
+        ids: Optional[List[str]] = None,
+        filter: Optional[DocumentMetadataFilter] = None,
+        delete_all: Optional[bool] = None,
+    ) -> bool:
+        """
+        Removes vectors by document ids, filter, or everything in the datastore.
+        Returns whether the operation was successful.
+        """
+        return await self._run_sync(self._delete, ids, filter, delete_all)
+
+    def _delete(
+        self,
+        ids: Optional[List[str]],
+        filter: Optional[DocumentMetadataFilter],
+        delete_all: Optional[bool],
+    ) -> bool:
+        with self._writing():
+            return self._delete_rows(ids, filter, delete_all)
+
+    def _delete_rows(
+        self,
+        ids: Optional[List[str]],
+        filter: Optional[DocumentMetadataFilter],
+        delete_all: Optional[bool],
+    ) -> bool:
+        if delete_all:
+            print(f"Deleting all vectors from {self.directory}")
+            self._rewrite(np.arange(0))
+            return True
+
+        mask = np.zeros(self.count, dtype=bool)
+        filter_mask = self._filter_mask(filter)
+        if filter_mask is not None:
+            mask |= filter_mask
+        if ids:
+            codes = [
+                self._value_codes["document_id"][doc_id]
+                for doc_id in ids
+                if doc_id in self._value_codes["document_id"]
+            ]
+            mask |= np.isin(self.codes["document_id"][: self.count], codes)
+
+        if mask.any():
+            self.alive[: self.count][mask] = 0
+            self._commit()
+
+            num_deleted = self.count - int(np.count_nonzero(self.alive[: self.count]))
+            if num_deleted > COMPACT_DELETED_RATIO * self.count:
+                self._compact()
+        return True
+
+    def compact(self):
+        """Rewrite the index without its deleted rows."""
+        with self._writing():
+            self._compact()
+
+    def _compact(self):
+        live_rows = np.flatnonzero(self.alive[: self.count])
+        print(f"Compacting {self.directory} from {self.count} to {len(live_rows)} rows")
+        self._rewrite(live_rows)
+
+    def _rewrite(self, rows: np.ndarray):
+        """
+        Write the given rows to the files of a new generation, switch to it by committing, and
+        remove the files of the previous generation.
+        """
+        old = {
+            "vectors": self.vectors,
+            "quantized": self.quantized,
+            "scales": self.scales,
+            "created_at": self.created_at,
+            "token_counts": self.token_counts,
+            "codes": self.codes,
+            "ids": self.ids,
+            "texts": self.texts,
+            "dictionaries": self.dictionaries,
+            "ann": self.ann,
+        }
+        old_directory = self._generation_directory(self.state["generation"])
+
+        capacity = INITIAL_CAPACITY
+        while capacity < len(rows):
+            capacity *= 2
+        self.state = {
+            "generation": self.state["generation"] + 1,
+            "dimension": self.state["dimension"],
+            "count": len(rows),
+            "capacity": capacity,
+            "index": self.index_params,
+        }
+        self._open()
+        if old["ann"] is not None and old["ann"].trained:
+            self.ann.save_model_from(old["ann"])  # type: ignore
+
+        # re-encode the metadata columns with dictionaries of the values that are still in use
+        remapped_codes = {}
+        for field in METADATA_FIELDS:
+            codes = np.asarray(old["codes"][field][rows])
+            used = np.unique(codes[codes != NO_VALUE])
+            self.dictionaries[field] = [old["dictionaries"][field][code] for code in used]
+            self._value_codes[field] = {
+                value: code for code, value in enumerate(self.dictionaries[field])
+            }
+            remapped_codes[field] = np.where(
+                codes != NO_VALUE, np.searchsorted(used, codes), NO_VALUE
+            ).astype(np.int32)
+
+        for start in range(0, len(rows), COMPACT_BATCH_SIZE):
+            batch = rows[start : start + COMPACT_BATCH_SIZE]
+            end = start + len(batch)
+            if self.vectors is not None:
+                self.vectors[start:end] = old["vectors"][batch]
+            if self.quantized is not None and self.scales is not None:
+                self.quantized[start:end] = old["quantized"][batch]
+                self.scales[start:end] = old["scales"][batch]
+            self.alive[start:end] = 1
+            self.created_at[start:end] = old["created_at"][batch]
+            self.token_counts[start:end] = old["token_counts"][batch]
+            for field in METADATA_FIELDS:
+                self.codes[field][start:end] = remapped_codes[field][start:end]
+            self.ids.append(start, [old["ids"].get(row) for row in batch])
+            self.texts.append(start, [old["texts"].get(row) for row in batch])
+            if self.ann is not None and self.ann.trained:
+                self.ann.copy_rows(old["ann"], batch, start)
+
+        self._commit()
+        shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def _to_str(value) -> Optional[str]:
+    """Return the string stored for a metadata value, the value of enums like Source."""
+    if value is None:
+        return None
+    return getattr(value, "value", value)
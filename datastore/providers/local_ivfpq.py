@@ -0,0 +1,260 @@
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# The number of rows assigned or encoded at a time, which bounds the memory of the distance matrices
+ENCODE_BATCH_SIZE = 16384
+# The number of candidates scored at a time with the lookup tables
+SCORE_BATCH_SIZE = 65536
+# The number of k-means iterations when training the coarse quantizer and the codebooks
+KMEANS_ITERATIONS = 12
+# The maximum number of vectors sampled per centroid to train on
+TRAIN_SAMPLES_PER_CENTROID = 64
+# The number of centroids of each product quantizer codebook, so each code is a byte
+PQ_CENTROIDS = 256
+
+
+def kmeans(
+    data: np.ndarray, k: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0
+) -> np.ndarray:
+    """
+    Cluster data into k centroids by euclidean distance with Lloyd's algorithm.
+    Centroids that end up with no points are reset to random points.
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(data))
+    centroids = data[rng.choice(len(data), k, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        assignments = assign(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+        counts = np.bincount(assignments, minlength=k)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def assign(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Return the index of the nearest centroid of each row of data, by euclidean distance."""
+    result = np.empty(len(data), dtype=np.int32)
+    centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+    for start in range(0, len(data), ENCODE_BATCH_SIZE):
+        batch = data[start : start + ENCODE_BATCH_SIZE]
+        # the squared norm of the rows is the same for every centroid, so it can be left out
+        distances = centroid_norms[None, :] - 2 * (batch @ centroids.T)
+        result[start : start + len(batch)] = np.argmin(distances, axis=1)
+    return result
+
+
+def open_array(path: str, dtype, shape) -> np.memmap:
+    """Map a file as a writable array of the given shape, growing the file with zeros if it is too small."""
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(path, "ab") as file:
+        if file.tell() < size:
+            file.truncate(size)
+    return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+
+class IVFPQIndex:
+    """
+    An inverted file index with product quantization (IVF-PQ) over unit vectors, for approximate
+    maximum inner product search.
+
+    A coarse quantizer splits the vectors into nlist lists by their nearest centroid. The residual
+    of each vector to its centroid is split into m subvectors, and each subvector is stored as the
+    byte code of its nearest centroid in a per-subspace codebook of 256 centroids. A search only
+    looks at the vectors of the nprobe lists nearest to the query, scores them from their codes
+    with per-query lookup tables, and rescores the best rerank candidates with the full vectors.
+
+    nlist and m are build parameters, set when the index is created. nprobe and rerank are search
+    parameters: raising them improves recall at the cost of latency.
+
+    The trained centroids and codebooks are kept in ivfpq.npz, and the list and codes of each row in
+    memory-mapped files, so the index is not rebuilt when it is opened again. Inserts are encoded
+    with the trained model as they come, and deletes are left to the tombstones of the datastore.
+    """
+
+    def __init__(self, directory: str, params: Dict, dimension: int, capacity: int):
+        self.directory = directory
+        self.params = params
+        self.dimension = dimension
+        self.nlist = params["nlist"]
+        self.m = self._num_subspaces(dimension, params["m"])
+
+        self.centroids: Optional[np.ndarray] = None
+        self.codebooks: Optional[np.ndarray] = None
+        model_path = os.path.join(directory, "ivfpq.npz")
+        if os.path.exists(model_path):
+            with np.load(model_path) as model:
+                self.centroids = model["centroids"]
+                self.codebooks = model["codebooks"]
+        self._open(capacity)
+
+        # the rows of each list, built from the list column when searching, as a tuple of (order,
+        # bounds, indexed_count). Searches run concurrently, so a rebuild replaces the whole tuple
+        # in one assignment and a search reads it once
+        self._inverted_lists: Optional[Tuple[np.ndarray, np.ndarray, int]] = None
+
+    @staticmethod
+    def _num_subspaces(dimension: int, m: int) -> int:
+        """Return the largest number of subspaces up to m that divides the dimension."""
+        m = max(1, min(m, dimension))
+        while dimension % m:
+            m -= 1
+        return m
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    @property
+    def min_train_rows(self) -> int:
+        return max(self.params["min_train_rows"], self.nlist)
+
+    def _open(self, capacity: int):
+        self.lists = open_array(
+            os.path.join(self.directory, "ivf_lists.i32"), np.int32, (capacity,)
+        )
+        self.codes = open_array(
+            os.path.join(self.directory, "pq_codes.u8"), np.uint8, (capacity, self.m)
+        )
+
+    def grow(self, capacity: int):
+        self.flush()
+        self._open(capacity)
+
+    def flush(self):
+        self.lists.flush()
+        self.codes.flush()
+
+    def train(self, sample: np.ndarray):
+        """Train the coarse quantizer and the codebooks on a sample of vectors."""
+        self.save_model(*self.fit(sample))
+
+    def fit(self, sample: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the centroids and the codebooks trained on a sample of vectors, without using them,
+        so the slow training doesn't touch the index.
+        """
+        if len(sample) < PQ_CENTROIDS:
+            raise ValueError(f"IVF-PQ needs at least {PQ_CENTROIDS} vectors to train")
+        print(
+            f"Training IVF-PQ index with {self.nlist} lists and {self.m} subspaces on {len(sample)} vectors"
+        )
+        centroids = kmeans(sample, self.nlist)
+        residuals = sample - centroids[assign(sample, centroids)]
+        subspace = self.dimension // self.m
+        codebooks = np.stack(
+            [
+                kmeans(residuals[:, j * subspace : (j + 1) * subspace], PQ_CENTROIDS, seed=j)
+                for j in range(self.m)
+            ]
+        )
+        return centroids, codebooks
+
+    def add(self, start: int, vectors: np.ndarray):
+        """Assign and encode the vectors of the rows starting at start."""
+        assert self.centroids is not None and self.codebooks is not None
+        subspace = self.dimension // self.m
+        for offset in range(0, len(vectors), ENCODE_BATCH_SIZE):
+            batch = np.asarray(vectors[offset : offset + ENCODE_BATCH_SIZE], dtype=np.float32)
+            rows = slice(start + offset, start + offset + len(batch))
+            lists = assign(batch, self.centroids)
+            residuals = batch - self.centroids[lists]
+            self.lists[rows] = lists
+            for j in range(self.m):
+                self.codes[rows, j] = assign(
+                    residuals[:, j * subspace : (j + 1) * subspace], self.codebooks[j]
+                )
+
+    def copy_rows(self, source: "IVFPQIndex", rows: np.ndarray, start: int):
+        """Copy the lists and codes of rows of another index with the same model to the rows starting at start."""
+        self.lists[start : start + len(rows)] = source.lists[rows]
+        self.codes[start : start + len(rows)] = source.codes[rows]
+
+    def save_model_from(self, source: "IVFPQIndex"):
+        """Use the trained model of another index, when rewriting the index into a new directory."""
+        assert source.centroids is not None and source.codebooks is not None
+        self.save_model(source.centroids, source.codebooks)
+
+    def save_model(self, centroids: np.ndarray, codebooks: np.ndarray):
+        self.centroids, self.codebooks = centroids, codebooks
+        tmp_path = os.path.join(self.directory, "ivfpq.tmp.npz")
+        np.savez(tmp_path, centroids=centroids, codebooks=codebooks)
+        os.replace(tmp_path, os.path.join(self.directory, "ivfpq.npz"))
+
+    def _candidates(self, probed: np.ndarray, count: int) -> np.ndarray:
+        """Return the rows in the probed lists, out of the first count rows."""
+        # rebuild the inverted lists once the rows added since the last build are more than a tenth,
+        # or if they were built over more rows than this search sees
+        inverted_lists = self._inverted_lists
+        if inverted_lists is None or not (
+            0 <= count - inverted_lists[2] <= max(1024, inverted_lists[2] // 10)
+        ):
+            order = np.argsort(self.lists[:count], kind="stable").astype(np.int64)
+            bounds = np.searchsorted(self.lists[:count][order], np.arange(self.nlist + 1))
+            inverted_lists = self._inverted_lists = (order, bounds, count)
+
+        order, bounds, indexed_count = inverted_lists
+        parts = [order[bounds[i] : bounds[i + 1]] for i in probed]
+        if count > indexed_count:
+            # the rows added since the last build are scanned
+            recent = np.arange(indexed_count, count)
+            parts.append(recent[np.isin(self.lists[indexed_count:count], probed)])
+        return np.concatenate(parts) if parts else np.arange(0)
+
+    def search(
+        self,
+        query: np.ndarray,
+        mask: np.ndarray,
+        k: int,
+        vectors: np.ndarray,
+        nprobe: Optional[int] = None,
+        rerank: Optional[int] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows with the highest inner product with a unit query vector, among the rows in mask.
+
+        Returns:
+            A tuple of (rows, scores), best first. The scores are exact for the reranked candidates.
+            The mask can be a boolean or a 0/1 array over the rows.
+        """
+        assert self.centroids is not None and self.codebooks is not None
+        nprobe = nprobe or self.params["nprobe"]
+        rerank = self.params["rerank"] if rerank is None else rerank
+
+        coarse_scores = self.centroids @ query
+        probed = np.argsort(-coarse_scores)[: min(nprobe, len(coarse_scores))]
+        candidates = self._candidates(probed, len(mask))
+        candidates = candidates[mask[candidates].astype(bool)]
+        if len(candidates) == 0 or k <= 0:
+            return candidates[:0], np.zeros(0, dtype=np.float32)
+
+        # the inner product of the query with each subvector centroid, per subspace
+        subspace = self.dimension // self.m
+        tables = np.einsum(
+            "jkd,jd->jk", self.codebooks, query.reshape(self.m, subspace)
+        )
+        scores = np.empty(len(candidates), dtype=np.float32)
+        subspaces = np.arange(self.m)
+        for start in range(0, len(candidates), SCORE_BATCH_SIZE):
+            batch = candidates[start : start + SCORE_BATCH_SIZE]
+            scores[start : start + len(batch)] = coarse_scores[self.lists[batch]] + tables[
+                subspaces, self.codes[batch]
+            ].sum(axis=1)
+
+        # keep the best candidates by approximate score, then rescore them with the full vectors
+        keep = max(k, rerank)
+        if len(candidates) > keep:
+            best = np.argpartition(-scores, keep - 1)[:keep]
+            candidates, scores = candidates[best], scores[best]
+        if rerank > 0:
+            order = np.argsort(candidates)
+            candidates = candidates[order]
+            scores = np.asarray(vectors[candidates], dtype=np.float32) @ query
+
+        top = np.argsort(-scores, kind="stable")[:k]
+        return candidates[top], scores[top]
@@ -1,8 +1,9 @@
 import json
 import os
 import asyncio
+import time
 
-from typing import Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional
 from pymilvus import (
     Collection,
     connections,
@@ -16,7 +17,10 @@ from uuid import uuid4
 
 
 from services.date import to_unix_timestamp
+from services.pipeline import StageMetrics
+from services.quantization import VECTOR_PRECISION
 from datastore.datastore import DataStore
+from models.embeddings import embedding_to_list
 from models.models import (
     DocumentChunk,
     DocumentChunkMetadata,
@@ -37,8 +41,15 @@ MILVUS_USE_SECURITY = False if MILVUS_PASSWORD is None else True
 MILVUS_INDEX_PARAMS = os.environ.get("MILVUS_INDEX_PARAMS")
 MILVUS_SEARCH_PARAMS = os.environ.get("MILVUS_SEARCH_PARAMS")
 MILVUS_CONSISTENCY_LEVEL = os.environ.get("MILVUS_CONSISTENCY_LEVEL")
-
-UPSERT_BATCH_SIZE = 100
+# The number of clusters of the IVF_SQ8 index created by default with VECTOR_PRECISION=int8
+MILVUS_SQ8_NLIST = int(os.environ.get("MILVUS_SQ8_NLIST", 1024))
+
+# The maximum number of rows and the approximate maximum size in bytes of each insert request, which
+# keeps requests under the gRPC message size limit of Milvus (64 MB by default)
+UPSERT_BATCH_SIZE = int(os.environ.get("MILVUS_UPSERT_BATCH_SIZE", 100))
+UPSERT_BATCH_BYTES = int(os.environ.get("MILVUS_UPSERT_BATCH_BYTES", 16 << 20))
+# The number of insert requests in flight at once
+UPSERT_CONCURRENCY = int(os.environ.get("MILVUS_UPSERT_CONCURRENCY", 4))
 OUTPUT_DIM = 1536
 EMBEDDING_FIELD = "embedding"
 
@@ -119,6 +130,8 @@ class MilvusDataStore(DataStore):
         """
         # Overwrite the default consistency level by MILVUS_CONSISTENCY_LEVEL
         self._consistency_level = MILVUS_CONSISTENCY_LEVEL or consistency_level
+        # The rows and time of each insert batch, for the throughput of ingests
+        self.insert_metrics = StageMetrics("insert")
         self._create_connection()
 
         self._create_collection(MILVUS_COLLECTION, create_new)  # type: ignore
@@ -220,13 +233,22 @@ class MilvusDataStore(DataStore):
                     # Create an index on the 'embedding' field with the index params found in init
                     self.col.create_index(EMBEDDING_FIELD, index_params=self.index_params)
                 else:
-                    # If no index param supplied, to first create an HNSW index for Milvus
+                    # If no index param supplied, to first create an HNSW index for Milvus, or an
+                    # IVF_SQ8 index which keeps the vectors as int8 codes when quantizing. float16
+                    # vectors need Milvus 2.4, so they are stored as float32 vectors with HNSW.
                     try:
-                        i_p = {
-                            "metric_type": "IP",
-                            "index_type": "HNSW",
-                            "params": {"M": 8, "efConstruction": 64},
-                        }
+                        if VECTOR_PRECISION == "int8":
+                            i_p = {
+                                "metric_type": "IP",
+                                "index_type": "IVF_SQ8",
+                                "params": {"nlist": MILVUS_SQ8_NLIST},
+                            }
+                        else:
+                            i_p = {
+                                "metric_type": "IP",
+                                "index_type": "HNSW",
+                                "params": {"M": 8, "efConstruction": 64},
+                            }
                         self._print_info("Attempting creation of Milvus '{}' index".format(i_p["index_type"]))
                         self.col.create_index(EMBEDDING_FIELD, index_params=i_p)
                         self.index_params = i_p
@@ -290,49 +312,97 @@ class MilvusDataStore(DataStore):
         """
         try:
             # The doc id's to return for the upsert
-            doc_ids: List[str] = []
-            # List to collect all the insert data, skip the "pk" for schema V1
-            offset = 1 if self._schema_ver == "V1" else 0
-            insert_data = [[] for _ in range(len(self._get_schema()) - offset)]
-
-            # Go through each document chunklist and grab the data
-            for doc_id, chunk_list in chunks.items():
-                # Append the doc_id to the list we are returning
-                doc_ids.append(doc_id)
-                # Examine each chunk in the chunklist
-                for chunk in chunk_list:
-                    # Extract data from the chunk
-                    list_of_data = self._get_values(chunk)
-                    # Check if the data is valid
-                    if list_of_data is not None:
-                        # Append each field to the insert_data
-                        for x in range(len(insert_data)):
-                            insert_data[x].append(list_of_data[x])
-            # Slice up our insert data into batches
-            batches = [
-                insert_data[i : i + UPSERT_BATCH_SIZE]
-                for i in range(0, len(insert_data), UPSERT_BATCH_SIZE)
-            ]
-
-            # Attempt to insert each batch into our collection
-            # batch data can work with both V1 and V2 schema
-            for batch in batches:
-                if len(batch[0]) != 0:
-                    try:
-                        self._print_info(f"Upserting batch of size {len(batch[0])}")
-                        self.col.insert(batch)
-                        self._print_info(f"Upserted batch successfully")
-                    except Exception as e:
-                        self._print_err(f"Failed to insert batch records, error: {e}")
-                        raise e
+            doc_ids: List[str] = list(chunks.keys())
+            # Bound the inserts in flight, the client is blocking so they run in the thread pool
+            semaphore = asyncio.Semaphore(UPSERT_CONCURRENCY)
+
+            async def _insert(rows: List[List[Any]], num_bytes: int):
+                try:
+                    # Transpose the rows of the batch into the columns the client takes,
+                    # batch data can work with both V1 and V2 schema
+                    columns = [list(column) for column in zip(*rows)]
+                    started = time.monotonic()
+                    await self._run_sync(self.col.insert, columns)
+                    seconds = time.monotonic() - started
+                    self.insert_metrics.record(len(rows), seconds)
+                    self._print_info(
+                        f"Upserted batch of {len(rows)} rows ({num_bytes} bytes) in {seconds:.2f}s"
+                    )
+                except Exception as e:
+                    self._print_err(f"Failed to insert batch records, error: {e}")
+                    raise e
+                finally:
+                    semaphore.release()
+
+            if self.insert_metrics.started_at is None:
+                self.insert_metrics.started_at = time.monotonic()
+            inserts: List[asyncio.Task] = []
+            try:
+                for rows, num_bytes in self._get_batches(chunks):
+                    # Wait for a free slot before building the next batch, so at most
+                    # UPSERT_CONCURRENCY batches are held in memory
+                    await semaphore.acquire()
+                    inserts.append(asyncio.create_task(_insert(rows, num_bytes)))
+                await asyncio.gather(*inserts)
+            except BaseException:
+                for insert in inserts:
+                    insert.cancel()
+                raise
+            self.insert_metrics.finished_at = time.monotonic()
 
             # This setting perfoms flushes after insert. Small insert == bad to use
             # self.col.flush()
             return doc_ids
         except Exception as e:
             self._print_err("Failed to insert records, error: {}".format(e))
-            return []
+            raise e
+
+    def _get_batches(
+        self, chunks: Dict[str, List[DocumentChunk]]
+    ) -> Iterator[tuple]:
+        """Split the rows of the chunks into batches of at most UPSERT_BATCH_SIZE rows and about
+        UPSERT_BATCH_BYTES bytes, a batch holds one row at least.
 
+        Args:
+            chunks (Dict[str, List[DocumentChunk]]): The chunks to insert, by document id.
+
+        Returns:
+            Iterator[tuple]: Tuples of the rows of a batch and their estimated size in bytes.
+        """
+        rows: List[List[Any]] = []
+        num_bytes = 0
+        for chunk_list in chunks.values():
+            for chunk in chunk_list:
+                # Extract data from the chunk
+                values = self._get_values(chunk)
+                # Check if the data is valid
+                if values is None:
+                    continue
+                row_bytes = self._row_bytes(values)
+                if rows and (
+                    len(rows) == UPSERT_BATCH_SIZE
+                    or num_bytes + row_bytes > UPSERT_BATCH_BYTES
+                ):
+                    yield rows, num_bytes
+                    rows, num_bytes = [], 0
+                rows.append(values)
+                num_bytes += row_bytes
+        if rows:
+            yield rows, num_bytes
+
+    @staticmethod
+    def _row_bytes(values: List[Any]) -> int:
+        """Estimate the size of a row in an insert request: 4 bytes per float of a vector, the
+        UTF-8 length of strings, and 8 bytes for other scalars."""
+        num_bytes = 0
+        for value in values:
+            if isinstance(value, list):
+                num_bytes += 4 * len(value)
+            elif isinstance(value, str):
+                num_bytes += len(value.encode("utf-8"))
+            else:
+                num_bytes += 8
+        return num_bytes
 
     def _get_values(self, chunk: DocumentChunk) -> List[any] | None:  # type: ignore
         """Convert the chunk into a list of values to insert whose indexes align with fields.
@@ -348,6 +418,7 @@ class MilvusDataStore(DataStore):
         # Unpack the metadata into the same dict
         meta = values.pop("metadata")
         values.update(meta)
+        values[EMBEDDING_FIELD] = embedding_to_list(values[EMBEDDING_FIELD])
 
         # Convert date to int timestamp form
         if values["created_at"]:
@@ -396,7 +467,8 @@ class MilvusDataStore(DataStore):
 
                 # Perform our search
                 return_from = 2 if self._schema_ver == "V1" else 1
-                res = self.col.search(
+                res = await self._run_sync(
+                    self.col.search,
                     data=[query.embedding],
                     anns_field=EMBEDDING_FIELD,
                     param=self.search_params,
@@ -482,7 +554,7 @@ class MilvusDataStore(DataStore):
                 # Add quotation marks around the string format id
                 ids = ['"' + str(id) + '"' for id in ids]
                 # Query for the pk's of entries that match id's
-                ids = self.col.query(f"document_id in [{','.join(ids)}]")
+                ids = await self._run_sync(self.col.query, f"document_id in [{','.join(ids)}]")
                 # Convert to list of pks
                 pks = [str(entry[pk_name]) for entry in ids]  # type: ignore
                 # for schema V2, the "id" is varchar, rewrite the expression
@@ -495,7 +567,7 @@ class MilvusDataStore(DataStore):
                     batch_pks = pks[:batch_size]
                     pks = pks[batch_size:]
                     # Delete the entries batch by batch
-                    res = self.col.delete(f"{pk_name} in [{','.join(batch_pks)}]")
+                    res = await self._run_sync(self.col.delete, f"{pk_name} in [{','.join(batch_pks)}]")
                     # Increment our deleted count
                     delete_count += int(res.delete_count)  # type: ignore
         except Exception as e:
@@ -509,7 +581,7 @@ class MilvusDataStore(DataStore):
                 # Check if there is anything to filter
                 if len(filter) != 0:  # type: ignore
                     # Query for the pk's of entries that match filter
-                    res = self.col.query(filter)  # type: ignore
+                    res = await self._run_sync(self.col.query, filter)  # type: ignore
                     # Convert to list of pks
                     pks = [str(entry[pk_name]) for entry in res]  # type: ignore
                     # for schema V2, the "id" is varchar, rewrite the expression
@@ -520,7 +592,7 @@ class MilvusDataStore(DataStore):
                         batch_pks = pks[:batch_size]
                         pks = pks[batch_size:]
                         # Delete the entries batch by batch
-                        res = self.col.delete(f"{pk_name} in [{','.join(batch_pks)}]")  # type: ignore
+                        res = await self._run_sync(self.col.delete, f"{pk_name} in [{','.join(batch_pks)}]")  # type: ignore
                         # Increment our delete count
                         delete_count += int(res.delete_count)  # type: ignore
         except Exception as e:
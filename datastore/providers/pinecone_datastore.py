@@ -3,10 +3,12 @@ from typing import Any, Dict, List, Optional
 import pinecone
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 import asyncio
+import time
 from urllib.parse import urlparse
 from fastapi import HTTPException
 
 from datastore.datastore import DataStore
+from models.embeddings import embedding_to_list
 from models.models import (
     DocumentChunk,
     DocumentChunkMetadata,
@@ -30,34 +32,45 @@ pinecone.init(api_key=PINECONE_API_KEY, environment=PINECONE_ENVIRONMENT)
 # Set the batch size for upserting vectors to Pinecone
 UPSERT_BATCH_SIZE = 100
 
+# How long the list of indexes is reused for before asking the Pinecone control plane again
+PINECONE_INDEX_LIST_TTL_SECONDS = float(
+    os.environ.get("PINECONE_INDEX_LIST_TTL_SECONDS", 60)
+)
+
+_index_list: Optional[List[str]] = None
+_index_list_expires_at = 0.0
+
+
+def list_indexes(refresh: bool = False) -> List[str]:
+    """
+    Return the names of the Pinecone indexes, cached for PINECONE_INDEX_LIST_TTL_SECONDS since
+    listing them is a control plane call. Pass refresh to bypass the cache.
+    """
+    global _index_list, _index_list_expires_at
+    if refresh or _index_list is None or _index_list_expires_at <= time.monotonic():
+        _index_list = pinecone.list_indexes()
+        _index_list_expires_at = time.monotonic() + PINECONE_INDEX_LIST_TTL_SECONDS
+    return _index_list
+
 
 # create index
 class PineconeDataStore(DataStore):
+    IMPORT_BATCH_SIZE = UPSERT_BATCH_SIZE
+    SEPARATE_INDEXES = True
+
     def __init__(self, index_name, create_index=False):
+        self.index_name = index_name
 
-        if index_name and index_name not in pinecone.list_indexes() and create_index:
-            # # Get all fields in the metadata object in a list
-            fields_to_index = list(DocumentChunkMetadata.__fields__.keys())
+        # creating an index needs an up to date list, the index may have been deleted since
+        index_names = list_indexes(refresh=create_index)
 
-            # Create a new index with the specified name, dimension, and metadata configuration
-            try:
-                print(
-                    f"Creating index {index_name} with metadata config {fields_to_index}"
-                )
-                pinecone.create_index(
-                    index_name,
-                    dimension=1536,  # dimensionality of OpenAI ada v2 embeddings
-                    metadata_config={"indexed": fields_to_index},
-                )
-                self.index = pinecone.Index(index_name)
-                print(f"Index {index_name} created successfully")
-            except Exception as e:
-                print(f"Error creating index {index_name}: {e}")
-                raise e
+        if index_name and index_name not in index_names and create_index:
+            self._create_index()
+            index_names = list_indexes(refresh=True)
 
-        if index_name and index_name not in pinecone.list_indexes():
+        if index_name and index_name not in index_names:
             raise HTTPException(status_code=404, detail="Repo is not indexed. You can index it by posting to the /index-repo endpoint.")
-        elif index_name and index_name in pinecone.list_indexes():
+        elif index_name:
             # Connect to an existing index with the specified name
             try:
                 print(f"Connecting to existing index {index_name}")
@@ -67,6 +80,34 @@ class PineconeDataStore(DataStore):
                 print(f"Error connecting to index {index_name}: {e}")
                 raise e
 
+    def _create_index(self):
+        # # Get all fields in the metadata object in a list
+        fields_to_index = list(DocumentChunkMetadata.__fields__.keys())
+
+        # Create a new index with the specified name, dimension, and metadata configuration
+        try:
+            print(
+                f"Creating index {self.index_name} with metadata config {fields_to_index}"
+            )
+            pinecone.create_index(
+                self.index_name,
+                dimension=1536,  # dimensionality of OpenAI ada v2 embeddings
+                metadata_config={"indexed": fields_to_index},
+            )
+            print(f"Index {self.index_name} created successfully")
+        except Exception as e:
+            print(f"Error creating index {self.index_name}: {e}")
+            raise e
+
+    async def ensure_index(self) -> None:
+        """Create the index again if it was deleted since the handle was opened."""
+        if not self.index_name:
+            return
+        index_names = await self._run_sync(list_indexes, refresh=True)
+        if self.index_name not in index_names:
+            await self._run_sync(self._create_index)
+            await self._run_sync(list_indexes, refresh=True)
+
     @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
     async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
         """
@@ -89,7 +130,9 @@ class PineconeDataStore(DataStore):
                 # Add the text and document id to the metadata dict
                 pinecone_metadata["text"] = chunk.text
                 pinecone_metadata["document_id"] = doc_id
-                vector = (chunk.id, chunk.embedding, pinecone_metadata)
+                if chunk.token_count is not None:
+                    pinecone_metadata["token_count"] = chunk.token_count
+                vector = (chunk.id, embedding_to_list(chunk.embedding), pinecone_metadata)
                 vectors.append(vector)
 
         # Split the vectors list into batches of the specified size
@@ -97,16 +140,18 @@ class PineconeDataStore(DataStore):
             vectors[i : i + UPSERT_BATCH_SIZE]
             for i in range(0, len(vectors), UPSERT_BATCH_SIZE)
         ]
-        # Upsert each batch to Pinecone
-        for batch in batches:
+        # Upsert the batches to Pinecone concurrently, in the thread pool of the datastore
+        async def _upsert_batch(batch):
             try:
                 print(f"Upserting batch of size {len(batch)}")
-                self.index.upsert(vectors=batch)
+                await self._run_sync(self.index.upsert, vectors=batch)
                 print(f"Upserted batch successfully")
             except Exception as e:
                 print(f"Error upserting batch: {e}")
                 raise e
 
+        await asyncio.gather(*[_upsert_batch(batch) for batch in batches])
+
         return doc_ids
 
     async def _query(
@@ -127,12 +172,14 @@ class PineconeDataStore(DataStore):
 
             try:
                 # Query the index with the query embedding, filter, and top_k
-                query_response = self.index.query(
+                query_response = await self._run_sync(
+                    self.index.query,
                     # namespace=namespace,
                     top_k=query.top_k,
                     vector=query.embedding,
                     filter=pinecone_filter,
                     include_metadata=True,
+                    include_values=bool(query.include_embeddings),
                 )
             except Exception as e:
                 print(f"Error querying index: {e}")
@@ -161,6 +208,11 @@ class PineconeDataStore(DataStore):
                 result = DocumentChunk(
                     id=result.id,
                     text=metadata["text"] if metadata and "text" in metadata else None,
+                    embedding=result.values or None,
+                    # Pinecone returns numbers as floats
+                    token_count=int(metadata["token_count"])
+                    if metadata and "token_count" in metadata
+                    else None,
                 )
                 query_results.append(result)
             return QueryResult(query=query.query, results=query_results)
@@ -186,7 +238,7 @@ class PineconeDataStore(DataStore):
         if delete_all:
             try:
                 print(f"Deleting all vectors from index")
-                self.index.delete(delete_all=True)
+                await self._run_sync(self.index.delete, delete_all=True)
                 print(f"Deleted all vectors successfully")
                 return True
             except Exception as e:
@@ -199,7 +251,7 @@ class PineconeDataStore(DataStore):
         if pinecone_filter != {}:
             try:
                 print(f"Deleting vectors with filter {pinecone_filter}")
-                self.index.delete(filter=pinecone_filter)
+                await self._run_sync(self.index.delete, filter=pinecone_filter)
                 print(f"Deleted vectors with filter successfully")
             except Exception as e:
                 print(f"Error deleting vectors with filter: {e}")
@@ -210,7 +262,7 @@ class PineconeDataStore(DataStore):
             try:
                 print(f"Deleting vectors with ids {ids}")
                 pinecone_filter = {"document_id": {"$in": ids}}
-                self.index.delete(filter=pinecone_filter)  # type: ignore
+                await self._run_sync(self.index.delete, filter=pinecone_filter)  # type: ignore
                 print(f"Deleted vectors with ids successfully")
             except Exception as e:
                 print(f"Error deleting vectors with ids: {e}")
@@ -1,12 +1,14 @@
+import asyncio
 import os
 import uuid
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, List, Optional
 
 from grpc._channel import _InactiveRpcError
 from qdrant_client.http.exceptions import UnexpectedResponse
 from qdrant_client.http.models import PayloadSchemaType
 
 from datastore.datastore import DataStore
+from models.embeddings import assign_embeddings, embedding_to_list
 from models.models import (
     DocumentChunk,
     DocumentMetadataFilter,
@@ -19,12 +21,23 @@ from qdrant_client.http import models as rest
 import qdrant_client
 
 from services.date import to_unix_timestamp
+from services.quantization import VECTOR_PRECISION, VECTOR_RESCORE
 
 QDRANT_URL = os.environ.get("QDRANT_URL", "http://localhost")
 QDRANT_PORT = os.environ.get("QDRANT_PORT", "6333")
 QDRANT_GRPC_PORT = os.environ.get("QDRANT_GRPC_PORT", "6334")
 QDRANT_API_KEY = os.environ.get("QDRANT_API_KEY")
 QDRANT_COLLECTION = os.environ.get("QDRANT_COLLECTION", "document_chunks")
+# Qdrant keeps int8 scalar quantized copies of the vectors in RAM for collections created with
+# VECTOR_PRECISION=int8, which needs qdrant-client >= 1.1. float16 collections store float32
+# vectors, which is the smallest float type of the supported Qdrant versions.
+QDRANT_QUANTIZATION_QUANTILE = float(os.environ.get("QDRANT_QUANTIZATION_QUANTILE", 0.99))
+# The number of points sent per upsert request, and the number of requests in flight at once
+QDRANT_UPSERT_BATCH_SIZE = int(os.environ.get("QDRANT_UPSERT_BATCH_SIZE", 256))
+QDRANT_UPSERT_CONCURRENCY = int(os.environ.get("QDRANT_UPSERT_CONCURRENCY", 4))
+# Whether every upsert request waits for its points to be applied. When false, only the last
+# request of an upsert waits, as a barrier for the requests sent before it.
+QDRANT_UPSERT_WAIT = os.environ.get("QDRANT_UPSERT_WAIT", "true").lower() == "true"
 
 
 class QdrantDataStore(DataStore):
@@ -63,16 +76,25 @@ class QdrantDataStore(DataStore):
         Takes in a list of document chunks and inserts them into the database.
         Return a list of document ids.
         """
-        points = [
-            self._convert_document_chunk_to_point(chunk)
-            for _, chunks in chunks.items()
-            for chunk in chunks
+        all_chunks = [chunk for _, chunks in chunks.items() for chunk in chunks]
+        batches = [
+            all_chunks[i : i + QDRANT_UPSERT_BATCH_SIZE]
+            for i in range(0, len(all_chunks), QDRANT_UPSERT_BATCH_SIZE)
         ]
-        self.client.upsert(
-            collection_name=self.collection_name,
-            points=points,  # type: ignore
-            wait=True,
-        )
+        semaphore = asyncio.Semaphore(QDRANT_UPSERT_CONCURRENCY)
+
+        async def _upsert_batch(batch: List[DocumentChunk], wait: bool):
+            async with semaphore:
+                # the points are only built once the batch can be sent, so memory stays bounded
+                await self._run_sync(self._send_batch, batch, wait)
+
+        if QDRANT_UPSERT_WAIT:
+            await asyncio.gather(*[_upsert_batch(batch, True) for batch in batches])
+        elif batches:
+            # Qdrant applies the operations of a collection in order, so once the other requests
+            # are acknowledged, waiting for the last one waits for all of them
+            await asyncio.gather(*[_upsert_batch(batch, False) for batch in batches[:-1]])
+            await _upsert_batch(batches[-1], True)
         return list(chunks.keys())
 
     async def _query(
@@ -85,7 +107,8 @@ class QdrantDataStore(DataStore):
         search_requests = [
             self._convert_query_to_search_request(query) for query in queries
         ]
-        results = self.client.search_batch(
+        results = await self._run_sync(
+            self.client.search_batch,
             collection_name=self.collection_name,
             requests=search_requests,
         )
@@ -100,6 +123,36 @@ class QdrantDataStore(DataStore):
             for query, result in zip(queries, results)
         ]
 
+    async def export_chunks(self, batch_size: int = 1000) -> AsyncIterator[List[DocumentChunk]]:
+        """
+        Yields every point of the collection as a chunk with its vector, paging through the
+        collection with the scroll API.
+        """
+        offset = None
+        while True:
+            points, offset = await self._run_sync(
+                self.client.scroll,
+                collection_name=self.collection_name,
+                limit=batch_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=True,
+            )
+            if points:
+                chunks = [
+                    DocumentChunk(
+                        id=point.payload.get("id"),  # type: ignore
+                        text=point.payload.get("text"),  # type: ignore
+                        metadata=point.payload.get("metadata"),  # type: ignore
+                        token_count=point.payload.get("token_count"),  # type: ignore
+                    )
+                    for point in points
+                ]
+                assign_embeddings(chunks, [point.vector for point in points])
+                yield chunks
+            if offset is None:
+                return
+
     async def delete(
         self,
         ids: Optional[List[str]] = None,
@@ -122,30 +175,57 @@ class QdrantDataStore(DataStore):
                 filter, ids
             )
 
-        response = self.client.delete(
+        response = await self._run_sync(
+            self.client.delete,
             collection_name=self.collection_name,
             points_selector=points_selector,  # type: ignore
         )
         return "COMPLETED" == response.status
 
-    def _convert_document_chunk_to_point(
-        self, document_chunk: DocumentChunk
-    ) -> rest.PointStruct:
+    def _send_batch(self, document_chunks: List[DocumentChunk], wait: bool):
+        # runs in the thread pool, so the vectors are converted off the event loop and only while
+        # the batch is being sent
+        self.client.upsert(
+            collection_name=self.collection_name,
+            points=self._convert_document_chunks_to_batch(document_chunks),
+            wait=wait,
+        )
+
+    def _convert_document_chunks_to_batch(
+        self, document_chunks: List[DocumentChunk]
+    ) -> rest.Batch:
+        # the client only takes vectors as lists of floats, it builds its gRPC points from them, so
+        # each vector is converted once here: rows of an embedding batch with tolist, and vectors
+        # that are lists already as they are. The batch is built without pydantic validating every
+        # float of every point
+        return rest.Batch.construct(
+            ids=[
+                self._create_document_chunk_id(document_chunk.id)
+                for document_chunk in document_chunks
+            ],
+            vectors=[
+                embedding_to_list(document_chunk.embedding)
+                for document_chunk in document_chunks
+            ],
+            payloads=[
+                self._get_payload(document_chunk) for document_chunk in document_chunks
+            ],
+        )
+
+    @staticmethod
+    def _get_payload(document_chunk: DocumentChunk) -> dict:
         created_at = (
             to_unix_timestamp(document_chunk.metadata.created_at)
             if document_chunk.metadata.created_at is not None
             else None
         )
-        return rest.PointStruct(
-            id=self._create_document_chunk_id(document_chunk.id),
-            vector=document_chunk.embedding,  # type: ignore
-            payload={
-                "id": document_chunk.id,
-                "text": document_chunk.text,
-                "metadata": document_chunk.metadata.dict(),
-                "created_at": created_at,
-            },
-        )
+        return {
+            "id": document_chunk.id,
+            "text": document_chunk.text,
+            "metadata": document_chunk.metadata.dict(),
+            "created_at": created_at,
+            "token_count": document_chunk.token_count,
+        }
 
     def _create_document_chunk_id(self, external_id: Optional[str]) -> str:
         if external_id is None:
@@ -160,7 +240,17 @@ class QdrantDataStore(DataStore):
             filter=self._convert_metadata_filter_to_qdrant_filter(query.filter),
             limit=query.top_k,  # type: ignore
             with_payload=True,
-            with_vector=False,
+            with_vector=bool(query.include_embeddings),
+            params=self._search_params(),
+        )
+
+    @staticmethod
+    def _search_params() -> Optional["rest.SearchParams"]:
+        if VECTOR_PRECISION != "int8":
+            return None
+        # search the quantized vectors, then rescore the candidates with the original vectors
+        return rest.SearchParams(
+            quantization=rest.QuantizationSearchParams(rescore=VECTOR_RESCORE > 0)
         )
 
     def _convert_metadata_filter_to_qdrant_filter(
@@ -173,15 +263,23 @@ class QdrantDataStore(DataStore):
 
         must_conditions, should_conditions = [], []
 
-        # Filtering by document ids
+        # Filtering by document ids, with a single condition on clients that support MatchAny
         if ids and len(ids) > 0:
-            for document_id in ids:
+            if hasattr(rest, "MatchAny"):
                 should_conditions.append(
                     rest.FieldCondition(
                         key="metadata.document_id",
-                        match=rest.MatchValue(value=document_id),
+                        match=rest.MatchAny(any=ids),
                     )
                 )
+            else:
+                for document_id in ids:
+                    should_conditions.append(
+                        rest.FieldCondition(
+                            key="metadata.document_id",
+                            match=rest.MatchValue(value=document_id),
+                        )
+                    )
 
         # Equality filters for the payload attributes
         if metadata_filter:
@@ -237,6 +335,7 @@ class QdrantDataStore(DataStore):
             text=scored_point.payload.get("text"),  # type: ignore
             metadata=scored_point.payload.get("metadata"),  # type: ignore
             embedding=scored_point.vector,  # type: ignore
+            token_count=payload.get("token_count"),
             score=scored_point.score,
         )
 
@@ -272,12 +371,17 @@ class QdrantDataStore(DataStore):
             self._recreate_collection(distance, vector_size)
 
     def _recreate_collection(self, distance: rest.Distance, vector_size: int):
+        # only pass a quantization config when quantizing, older clients don't accept the argument
+        quantization = {}
+        if VECTOR_PRECISION == "int8":
+            quantization["quantization_config"] = self._quantization_config()
         self.client.recreate_collection(
             self.collection_name,
             vectors_config=rest.VectorParams(
                 size=vector_size,
                 distance=distance,
             ),
+            **quantization,
         )
 
         # Create the payload index for the document_id metadata attribute, as it is
@@ -295,3 +399,13 @@ class QdrantDataStore(DataStore):
             field_name="created_at",
             field_schema=PayloadSchemaType.INTEGER,
         )
+
+    @staticmethod
+    def _quantization_config() -> "rest.ScalarQuantization":
+        return rest.ScalarQuantization(
+            scalar=rest.ScalarQuantizationConfig(
+                type=rest.ScalarType.INT8,
+                quantile=QDRANT_QUANTIZATION_QUANTILE,
+                always_ram=True,
+            )
+        )
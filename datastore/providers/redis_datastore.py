@@ -3,6 +3,7 @@ import logging
 import os
 import re
 import json
+import arrow
 import redis.asyncio as redis
 import numpy as np
 
@@ -14,8 +15,9 @@ from redis.commands.search.field import (
     NumericField,
     VectorField,
 )
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, List, Optional
 from datastore.datastore import DataStore
+from models.embeddings import assign_embeddings, embedding_to_list
 from models.models import (
     DocumentChunk,
     DocumentMetadataFilter,
@@ -25,6 +27,7 @@ from models.models import (
     QueryWithEmbedding,
 )
 from services.date import to_unix_timestamp
+from services.quantization import VECTOR_PRECISION
 
 # Read environment variables for Redis
 REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
@@ -35,13 +38,24 @@ REDIS_DOC_PREFIX = os.environ.get("REDIS_DOC_PREFIX", "doc")
 REDIS_DISTANCE_METRIC = os.environ.get("REDIS_DISTANCE_METRIC", "COSINE")
 REDIS_INDEX_TYPE = os.environ.get("REDIS_INDEX_TYPE", "FLAT")
 assert REDIS_INDEX_TYPE in ("FLAT", "HNSW")
+# The key prefix of the sets holding the chunk keys of each document, so the chunks of a document are
+# found without scanning the keyspace. The key of the prefix itself marks that the sets are built.
+REDIS_DOC_KEYS_PREFIX = os.environ.get("REDIS_DOC_KEYS_PREFIX", f"{REDIS_DOC_PREFIX}_keys")
+# The number of keys scanned at a time when building the sets of an index written without them
+REDIS_SCAN_BATCH_SIZE = 1000
 
 # OpenAI Ada Embeddings Dimension
 VECTOR_DIMENSION = 1536
 
+# The RediSearch vector type new indexes store embeddings as for each VECTOR_PRECISION. RediSearch has
+# no int8 vectors, so int8 isn't supported. FLOAT16 needs RediSearch >= 2.10.
+REDIS_VECTOR_TYPES = {"float32": "FLOAT32", "float16": "FLOAT16"}
+# The dtype of the query vector blobs for each vector type, which must match the type of the index
+REDIS_VECTOR_DTYPES = {"FLOAT64": np.float64, "FLOAT32": np.float32, "FLOAT16": np.float16}
+
 # RediSearch constants
 REDIS_REQUIRED_MODULES = [
-    {"name": "search", "ver": 20600},
+    {"name": "search", "ver": 20600 if VECTOR_PRECISION == "float32" else 21000},
     {"name": "ReJSON", "ver": 20404}
 ]
 REDIS_DEFAULT_ESCAPED_CHARS = re.compile(r"[,.<>{}\[\]\\\"\':;!@#$%^&*()\-+=~\/ ]")
@@ -54,13 +68,28 @@ def unpack_schema(d: dict):
         else:
             yield v
 
+def _index_vector_type(info: dict) -> Optional[str]:
+    """Return the vector type of the embedding field of an existing index from its FT.INFO, if found."""
+    for attribute in info.get("attributes", []):
+        values = [value.decode() if isinstance(value, bytes) else value for value in attribute]
+        fields = dict(zip(values[::2], values[1::2]))
+        if fields.get("attribute") == "embedding" or fields.get("identifier") == "$.embedding":
+            vector_type = fields.get("data_type")
+            if isinstance(vector_type, str) and vector_type.upper() in REDIS_VECTOR_DTYPES:
+                return vector_type.upper()
+    return None
+
 async def _check_redis_module_exist(client: redis.Redis, modules: List[dict]):
 
     installed_modules = (await client.info()).get("modules", [])
     installed_modules = {module["name"]: module for module in installed_modules}
     for module in modules:
         if module["name"] not in installed_modules or int(installed_modules[module["name"]]["ver"]) < int(module["ver"]):
-            error_message =  "You must add the RediSearch (>= 2.6) and ReJSON (>= 2.4) modules from Redis Stack. " \
+            versions = {
+                required["name"]: f"{required['ver'] // 10000}.{required['ver'] // 100 % 100}"
+                for required in modules
+            }
+            error_message =  f"You must add the RediSearch (>= {versions['search']}) and ReJSON (>= {versions['ReJSON']}) modules from Redis Stack. " \
                 "Please refer to Redis Stack docs: https://redis.io/docs/stack/"
             logging.error(error_message)
             raise AttributeError(error_message)
@@ -68,9 +97,10 @@ async def _check_redis_module_exist(client: redis.Redis, modules: List[dict]):
 
 
 class RedisDataStore(DataStore):
-    def __init__(self, client: redis.Redis, redisearch_schema):
+    def __init__(self, client: redis.Redis, redisearch_schema, vector_type: str = "FLOAT32"):
         self.client = client
         self._schema = redisearch_schema
+        self._vector_dtype = REDIS_VECTOR_DTYPES[vector_type]
         # Init default metadata with sentinel values in case the document written has no metadata
         self._default_metadata = {
             field: "_null_" for field in redisearch_schema["metadata"]
@@ -83,6 +113,11 @@ class RedisDataStore(DataStore):
         """
         Setup the index if it does not exist.
         """
+        if VECTOR_PRECISION not in REDIS_VECTOR_TYPES:
+            error_message = f"Redis has no {VECTOR_PRECISION} vectors, set VECTOR_PRECISION to one of {list(REDIS_VECTOR_TYPES)}"
+            logging.error(error_message)
+            raise ValueError(error_message)
+
         try:
             # Connect to the Redis Client
             logging.info("Connecting to Redis")
@@ -96,6 +131,7 @@ class RedisDataStore(DataStore):
         await _check_redis_module_exist(client, modules=REDIS_REQUIRED_MODULES)
        
         dim = kwargs.get("dim", VECTOR_DIMENSION)
+        vector_type = REDIS_VECTOR_TYPES[VECTOR_PRECISION]
         redisearch_schema = {
             "document_id": TagField("$.document_id", as_name="document_id"),
             "metadata": {
@@ -108,7 +144,7 @@ class RedisDataStore(DataStore):
                 "$.embedding",
                 REDIS_INDEX_TYPE,
                 {
-                    "TYPE": "FLOAT64",
+                    "TYPE": vector_type,
                     "DIM": dim,
                     "DISTANCE_METRIC": REDIS_DISTANCE_METRIC,
                 },
@@ -117,8 +153,11 @@ class RedisDataStore(DataStore):
         }
         try:
             # Check for existence of RediSearch Index
-            await client.ft(REDIS_INDEX_NAME).info()
+            info = await client.ft(REDIS_INDEX_NAME).info()
             logging.info(f"RediSearch index {REDIS_INDEX_NAME} already exists")
+            # Query an existing index with vectors of the type it was created with, which is
+            # FLOAT64 for indexes created before the precision was configurable
+            vector_type = _index_vector_type(info) or "FLOAT64"
         except:
             # Create the RediSearch Index
             logging.info(f"Creating new RediSearch index {REDIS_INDEX_NAME}")
@@ -130,7 +169,41 @@ class RedisDataStore(DataStore):
             await client.ft(REDIS_INDEX_NAME).create_index(
                 fields=fields, definition=definition
             )
-        return cls(client, redisearch_schema)
+            await client.set(REDIS_DOC_KEYS_PREFIX, 1)
+        # Index the chunk keys of documents written before they were tracked per document. A new
+        # index is marked as done, and this runs outside of the check for the index so its errors
+        # aren't taken for a missing index
+        if not await client.exists(REDIS_DOC_KEYS_PREFIX):
+            await cls._build_document_keys(client)
+        return cls(client, redisearch_schema, vector_type)
+
+    async def close(self) -> None:
+        # every handle opens a client of its own
+        await self.client.close()
+        await super().close()
+
+    @staticmethod
+    async def _build_document_keys(client: redis.Redis):
+        """
+        Add the chunk keys of every document to the key set of the document, with a single scan of
+        the keyspace. Runs once, for an index written before the sets were kept.
+        """
+        logging.info(f"Building the chunk key sets of the documents of {REDIS_INDEX_NAME}")
+        count = 0
+        async with client.pipeline(transaction=False) as pipe:
+            async for key in client.scan_iter(
+                f"{REDIS_DOC_PREFIX}:*", count=REDIS_SCAN_BATCH_SIZE
+            ):
+                key = key.decode() if isinstance(key, bytes) else key
+                # keys are "<prefix>:<document_id>:chunk:<chunk_id>"
+                document_id = key[len(REDIS_DOC_PREFIX) + 1 :].partition(":chunk:")[0]
+                await pipe.sadd(RedisDataStore._document_keys_key(document_id), key)
+                count += 1
+                if count % REDIS_SCAN_BATCH_SIZE == 0:
+                    await pipe.execute()
+            await pipe.set(REDIS_DOC_KEYS_PREFIX, 1)
+            await pipe.execute()
+        logging.info(f"Indexed {count} chunk keys")
 
     @staticmethod
     def _redis_key(document_id: str, chunk_id: str) -> str:
@@ -144,7 +217,20 @@ class RedisDataStore(DataStore):
         Returns:
             str: JSON key string.
         """
-        return f"doc:{document_id}:chunk:{chunk_id}"
+        return f"{REDIS_DOC_PREFIX}:{document_id}:chunk:{chunk_id}"
+
+    @staticmethod
+    def _document_keys_key(document_id: str) -> str:
+        """
+        Create the key of the set of the chunk keys of a document.
+
+        Args:
+            document_id (str): Document Identifier
+
+        Returns:
+            str: Set key string.
+        """
+        return f"{REDIS_DOC_KEYS_PREFIX}:{document_id}"
 
     @staticmethod
     def _escape(value: str) -> str:
@@ -179,6 +265,7 @@ class RedisDataStore(DataStore):
         data = chunk.__dict__
         metadata = chunk.metadata.__dict__
         data["chunk_id"] = data.pop("id")
+        data["embedding"] = self._stored_embedding(data["embedding"])
 
         # Prep Redis Metadata
         redis_metadata = dict(self._default_metadata)
@@ -192,6 +279,18 @@ class RedisDataStore(DataStore):
         data["metadata"] = redis_metadata
         return data
 
+    def _stored_embedding(self, embedding) -> Optional[List[float]]:
+        """
+        Return an embedding to store in a JSON document. RediSearch indexes the vector from the
+        document, so it can't be left out, but on a FLOAT16 index it is rounded to the float16
+        values the index holds: the digits past them only made each document about three times
+        larger.
+        """
+        if embedding is None or self._vector_dtype != np.float16:
+            return embedding_to_list(embedding)
+        # the shortest decimal of each float16 value, which reads back as the same value
+        return [float(value) for value in np.asarray(embedding, dtype=np.float16).astype(str)]
+
     def _get_redis_query(self, query: QueryWithEmbedding) -> RediSearchQuery:
         """
         Convert a QueryWithEmbedding into a RediSearchQuery.
@@ -245,12 +344,20 @@ class RedisDataStore(DataStore):
         query_str = (
             f"({filter_str})=>[KNN {query.top_k} @embedding $embedding as score]"
         )
-        return (
+        redis_query = (
             RediSearchQuery(query_str)
             .sort_by("score")
             .paging(0, query.top_k)
+            .return_field("$.chunk_id", as_field="chunk_id")
+            .return_field("$.text", as_field="text")
+            .return_field("$.metadata", as_field="metadata")
+            .return_field("$.token_count", as_field="token_count")
+            .return_field("score")
             .dialect(2)
         )
+        if query.include_embeddings:
+            redis_query.return_field("$.embedding", as_field="embedding")
+        return redis_query
 
     async def _redis_delete(self, keys: List[str]):
         """
@@ -259,8 +366,30 @@ class RedisDataStore(DataStore):
         Args:
             keys (List[str]): List of keys to delete.
         """
-        # Delete the keys
-        await asyncio.gather(*[self.client.delete(key) for key in keys])
+        # Unlink the keys in one round trip, the memory is reclaimed in the background
+        if keys:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    await pipe.unlink(key)
+                await pipe.execute()
+
+    async def _delete_documents(self, document_ids: List[str]) -> int:
+        """
+        Delete the chunks of documents with their key sets, reading the sets in one round trip and
+        unlinking the keys in another, so it costs O(chunks of the documents) whatever the size
+        of the index.
+
+        Returns:
+            int: The number of chunks deleted.
+        """
+        set_keys = [self._document_keys_key(document_id) for document_id in document_ids]
+        async with self.client.pipeline(transaction=False) as pipe:
+            for set_key in set_keys:
+                await pipe.smembers(set_key)
+            members = await pipe.execute()
+        keys = [key for chunk_keys in members for key in chunk_keys]
+        await self._redis_delete(keys + set_keys)
+        return len(keys)
 
     #######
 
@@ -278,12 +407,16 @@ class RedisDataStore(DataStore):
             # Append the id to the ids list
             doc_ids.append(doc_id)
 
-            # Write chunks in a pipelines
+            # Write chunks in a pipelines, and add their keys to the key set of the document
             async with self.client.pipeline(transaction=False) as pipe:
+                keys = []
                 for chunk in chunk_list:
                     key = self._redis_key(doc_id, chunk.id)
                     data = self._get_redis_chunk(chunk)
                     await pipe.json().set(key, "$", data)
+                    keys.append(key)
+                if keys:
+                    await pipe.sadd(self._document_keys_key(doc_id), *keys)
                 await pipe.execute()
 
         return doc_ids
@@ -296,19 +429,14 @@ class RedisDataStore(DataStore):
         Takes in a list of queries with embeddings and filters and
         returns a list of query results with matching document chunks and scores.
         """
-        # Prepare query responses and results object
-        results: List[QueryResult] = []
-
-        # Gather query results in a pipeline
-        logging.info(f"Gathering {len(queries)} query results", flush=True)
-        for query in queries:
+        logging.info(f"Gathering {len(queries)} query results")
 
+        async def _single_query(query: QueryWithEmbedding) -> QueryResult:
             logging.info(f"Query: {query.query}")
-            query_results: List[DocumentChunkWithScore] = []
 
             # Extract Redis query
             redis_query: RediSearchQuery = self._get_redis_query(query)
-            embedding = np.array(query.embedding, dtype=np.float64).tobytes()
+            embedding = np.array(query.embedding, dtype=self._vector_dtype).tobytes()
 
             # Perform vector search
             query_response = await self.client.ft(REDIS_INDEX_NAME).search(
@@ -316,25 +444,72 @@ class RedisDataStore(DataStore):
             )
 
             # Iterate through the most similar documents
+            query_results: List[DocumentChunkWithScore] = []
             for doc in query_response.docs:
-                # Load JSON data
-                doc_json = json.loads(doc.json)
+                # The metadata is returned as JSON, and the embedding only when it is asked for
+                metadata = json.loads(doc.metadata)
                 # Create document chunk object with score
                 result = DocumentChunkWithScore(
-                    id=doc_json["metadata"]["document_id"],
+                    id=doc.chunk_id,
                     score=doc.score,
-                    text=doc_json["text"],
-                    metadata=doc_json["metadata"]
+                    text=doc.text,
+                    metadata=metadata,
+                    embedding=json.loads(doc.embedding) if query.include_embeddings else None,
+                    # returned as JSON, and missing for chunks written before token counts were stored
+                    token_count=json.loads(doc.token_count) if hasattr(doc, "token_count") else None,
                 )
                 query_results.append(result)
 
-            # Add to overall results
-            results.append(QueryResult(query=query.query, results=query_results))
+            return QueryResult(query=query.query, results=query_results)
 
-        return results
+        # Run the searches concurrently over the connection pool of the client, so the latency of a
+        # request doesn't grow with its number of queries
+        return await asyncio.gather(*[_single_query(query) for query in queries])
 
-    async def _find_keys(self, pattern: str) -> List[str]:
-        return [key async for key in self.client.scan_iter(pattern)]
+    async def export_chunks(self, batch_size: int = 1000) -> AsyncIterator[List[DocumentChunk]]:
+        """
+        Yields every chunk stored under the document prefix, reading the JSON documents of each
+        batch of scanned keys in one pipeline.
+        """
+        keys: List[str] = []
+        async for key in self.client.scan_iter(f"{REDIS_DOC_PREFIX}:*", count=batch_size):
+            keys.append(key)
+            if len(keys) == batch_size:
+                yield await self._get_chunks(keys)
+                keys = []
+        if keys:
+            yield await self._get_chunks(keys)
+
+    async def _get_chunks(self, keys: List[str]) -> List[DocumentChunk]:
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                await pipe.json().get(key)
+            documents = await pipe.execute()
+
+        chunks = []
+        embeddings = []
+        for data in documents:
+            if data is None:
+                # deleted since it was scanned
+                continue
+            metadata = {
+                field: None if value == "_null_" else value
+                for field, value in data["metadata"].items()
+            }
+            if isinstance(metadata.get("created_at"), (int, float)):
+                metadata["created_at"] = arrow.get(metadata["created_at"]).isoformat()
+            chunks.append(
+                DocumentChunk(
+                    id=data["chunk_id"],
+                    text=data["text"],
+                    metadata=metadata,
+                    token_count=data.get("token_count"),
+                )
+            )
+            embeddings.append(data["embedding"])
+        if chunks:
+            assign_embeddings(chunks, embeddings)
+        return chunks
 
     async def delete(
         self,
@@ -351,6 +526,14 @@ class RedisDataStore(DataStore):
             try:
                 logging.info(f"Deleting all documents from index")
                 await self.client.ft(REDIS_INDEX_NAME).dropindex(True)
+                # the key sets aren't part of the index, so they are dropped separately
+                keys = [
+                    key
+                    async for key in self.client.scan_iter(
+                        f"{REDIS_DOC_KEYS_PREFIX}:*", count=REDIS_SCAN_BATCH_SIZE
+                    )
+                ]
+                await self._redis_delete(keys)
                 logging.info(f"Deleted all documents successfully")
                 return True
             except Exception as e:
@@ -362,10 +545,7 @@ class RedisDataStore(DataStore):
             # TODO - extend this to work with other metadata filters?
             if filter.document_id:
                 try:
-                    keys = await self._find_keys(
-                        f"{REDIS_DOC_PREFIX}:{filter.document_id}:*"
-                    )
-                    await self._redis_delete(keys)
+                    await self._delete_documents([filter.document_id])
                     logging.info(f"Deleted document {filter.document_id} successfully")
                 except Exception as e:
                     logging.info(f"Error deleting document {filter.document_id}: {e}")
@@ -375,16 +555,9 @@ class RedisDataStore(DataStore):
         if ids:
             try:
                 logging.info(f"Deleting document ids {ids}")
-                keys = []
-                # find all keys associated with the document ids
-                for document_id in ids:
-                    doc_keys = await self._find_keys(
-                        pattern=f"{REDIS_DOC_PREFIX}:{document_id}:*"
-                    )
-                    keys.extend(doc_keys)
-                # delete all keys
-                logging.info(f"Deleting {len(keys)} keys from Redis")
-                await self._redis_delete(keys)
+                # find and delete all keys associated with the document ids
+                num_deleted = await self._delete_documents(ids)
+                logging.info(f"Deleted {num_deleted} keys from Redis")
             except Exception as e:
                 logging.info(f"Error deleting ids: {e}")
                 raise e
@@ -1,5 +1,6 @@
 # TODO
 import asyncio
+import threading
 from typing import Dict, List, Optional
 from loguru import logger
 from weaviate import Client
@@ -10,6 +11,7 @@ import uuid
 from weaviate.util import generate_uuid5
 
 from datastore.datastore import DataStore
+from models.embeddings import embedding_to_list
 from models.models import (
     DocumentChunk,
     DocumentChunkMetadata,
@@ -115,6 +117,8 @@ class WeaviateDataStore(DataStore):
             f"Connecting to weaviate instance at {url} with credential type {type(auth_credentials).__name__}"
         )
         self.client = Client(url, auth_client_secret=auth_credentials)
+        # The batch of the client is shared, so writes from the thread pool take turns using it
+        self._batch_lock = threading.Lock()
         self.client.batch.configure(
             batch_size=WEAVIATE_BATCH_SIZE,
             dynamic=WEAVIATE_BATCH_DYNAMIC,  # type: ignore
@@ -152,39 +156,45 @@ class WeaviateDataStore(DataStore):
         Takes in a list of list of document chunks and inserts them into the database.
         Return a list of document ids.
         """
-        doc_ids = []
-
-        with self.client.batch as batch:
-            for doc_id, doc_chunks in chunks.items():
-                logger.debug(f"Upserting {doc_id} with {len(doc_chunks)} chunks")
-                for doc_chunk in doc_chunks:
-                    # we generate a uuid regardless of the format of the document_id because
-                    # weaviate needs a uuid to store each document chunk and
-                    # a document chunk cannot share the same uuid
-                    doc_uuid = generate_uuid5(doc_chunk, WEAVIATE_INDEX)
-                    metadata = doc_chunk.metadata
-                    doc_chunk_dict = doc_chunk.dict()
-                    doc_chunk_dict.pop("metadata")
-                    for key, value in metadata.dict().items():
-                        doc_chunk_dict[key] = value
-                    doc_chunk_dict["chunk_id"] = doc_chunk_dict.pop("id")
-                    doc_chunk_dict["source"] = (
-                        doc_chunk_dict.pop("source").value
-                        if doc_chunk_dict["source"]
-                        else None
-                    )
-                    embedding = doc_chunk_dict.pop("embedding")
-
-                    batch.add_data_object(
-                        uuid=doc_uuid,
-                        data_object=doc_chunk_dict,
-                        class_name=WEAVIATE_INDEX,
-                        vector=embedding,
-                    )
-
-                doc_ids.append(doc_id)
-            batch.flush()
-        return doc_ids
+        def _write() -> List[str]:
+            doc_ids = []
+
+            with self._batch_lock, self.client.batch as batch:
+                for doc_id, doc_chunks in chunks.items():
+                    logger.debug(f"Upserting {doc_id} with {len(doc_chunks)} chunks")
+                    for doc_chunk in doc_chunks:
+                        # we generate a uuid regardless of the format of the document_id because
+                        # weaviate needs a uuid to store each document chunk and
+                        # a document chunk cannot share the same uuid
+                        doc_uuid = generate_uuid5(doc_chunk, WEAVIATE_INDEX)
+                        metadata = doc_chunk.metadata
+                        doc_chunk_dict = doc_chunk.dict()
+                        doc_chunk_dict.pop("metadata")
+                        for key, value in metadata.dict().items():
+                            doc_chunk_dict[key] = value
+                        doc_chunk_dict["chunk_id"] = doc_chunk_dict.pop("id")
+                        doc_chunk_dict["source"] = (
+                            doc_chunk_dict.pop("source").value
+                            if doc_chunk_dict["source"]
+                            else None
+                        )
+                        embedding = embedding_to_list(doc_chunk_dict.pop("embedding"))
+                        # not a property of the class schema
+                        doc_chunk_dict.pop("token_count")
+
+                        batch.add_data_object(
+                            uuid=doc_uuid,
+                            data_object=doc_chunk_dict,
+                            class_name=WEAVIATE_INDEX,
+                            vector=embedding,
+                        )
+
+                    doc_ids.append(doc_id)
+                batch.flush()
+            return doc_ids
+
+        # the batch blocks while it sends the objects, so it runs in the thread pool of the datastore
+        return await self._run_sync(_write)
 
     async def _query(
         self,
@@ -196,8 +206,10 @@ class WeaviateDataStore(DataStore):
 
         async def _single_query(query: QueryWithEmbedding) -> QueryResult:
             logger.debug(f"Query: {query.query}")
+            # only fetch the vectors when they are asked for, they are most of the response
+            additional = ["score", "vector"] if query.include_embeddings else ["score"]
             if not hasattr(query, "filter") or not query.filter:
-                result = (
+                query_builder = (
                     self.client.query.get(
                         WEAVIATE_INDEX,
                         [
@@ -213,12 +225,12 @@ class WeaviateDataStore(DataStore):
                     )
                     .with_hybrid(query=query.query, alpha=0.5, vector=query.embedding)
                     .with_limit(query.top_k)  # type: ignore
-                    .with_additional(["score", "vector"])
-                    .do()
+                    .with_additional(additional)
                 )
+                result = await self._run_sync(query_builder.do)
             else:
                 filters_ = self.build_filters(query.filter)
-                result = (
+                query_builder = (
                     self.client.query.get(
                         WEAVIATE_INDEX,
                         [
@@ -235,9 +247,9 @@ class WeaviateDataStore(DataStore):
                     .with_hybrid(query=query.query, alpha=0.5, vector=query.embedding)
                     .with_where(filters_)
                     .with_limit(query.top_k)  # type: ignore
-                    .with_additional(["score", "vector"])
-                    .do()
+                    .with_additional(additional)
                 )
+                result = await self._run_sync(query_builder.do)
 
             query_results: List[DocumentChunkWithScore] = []
             response = result["data"]["Get"][WEAVIATE_INDEX]
@@ -246,7 +258,7 @@ class WeaviateDataStore(DataStore):
                 result = DocumentChunkWithScore(
                     id=resp["chunk_id"],
                     text=resp["text"],
-                    embedding=resp["_additional"]["vector"],
+                    embedding=resp["_additional"].get("vector"),
                     score=resp["_additional"]["score"],
                     metadata=DocumentChunkMetadata(
                         document_id=resp["document_id"] if resp["document_id"] else "",
@@ -275,7 +287,7 @@ class WeaviateDataStore(DataStore):
         """
         if delete_all:
             logger.debug(f"Deleting all vectors in index {WEAVIATE_INDEX}")
-            self.client.schema.delete_all()
+            await self._run_sync(self.client.schema.delete_all)
             return True
 
         if ids:
@@ -287,7 +299,8 @@ class WeaviateDataStore(DataStore):
             where_clause = {"operator": "Or", "operands": operands}
 
             logger.debug(f"Deleting vectors from index {WEAVIATE_INDEX} with ids {ids}")
-            result = self.client.batch.delete_objects(
+            result = await self._run_sync(
+                self.client.batch.delete_objects,
                 class_name=WEAVIATE_INDEX, where=where_clause, output="verbose"
             )
 
@@ -302,7 +315,8 @@ class WeaviateDataStore(DataStore):
             logger.debug(
                 f"Deleting vectors from index {WEAVIATE_INDEX} with filter {where_clause}"
             )
-            result = self.client.batch.delete_objects(
+            result = await self._run_sync(
+                self.client.batch.delete_objects,
                 class_name=WEAVIATE_INDEX, where=where_clause
             )
 
@@ -9,6 +9,7 @@ from uuid import uuid4
 from datastore.providers.milvus_datastore import (
     MilvusDataStore,
 )
+from services.pipeline import StageMetrics
 
 
 ZILLIZ_COLLECTION = os.environ.get("ZILLIZ_COLLECTION") or "c" + uuid4().hex
@@ -30,6 +31,8 @@ class ZillizDataStore(MilvusDataStore):
         """
         # Overwrite the default consistency level by MILVUS_CONSISTENCY_LEVEL
         self._consistency_level = ZILLIZ_CONSISTENCY_LEVEL or "Bounded"
+        # The rows and time of each insert batch, for the throughput of ingests
+        self.insert_metrics = StageMetrics("insert")
         self._create_connection()
 
         self._create_collection(ZILLIZ_COLLECTION, create_new)  # type: ignore
@@ -0,0 +1,88 @@
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+from datastore.datastore import DataStore
+
+# The maximum number of datastore handles kept warm, the least recently used ones are dropped first
+DATASTORE_REGISTRY_MAX_ENTRIES = int(
+    os.environ.get("DATASTORE_REGISTRY_MAX_ENTRIES", 32)
+)
+
+
+class DataStoreRegistry:
+    """
+    A process-wide registry of warm datastore handles keyed by index name, so a query reuses the
+    handle, and its connection, of the previous query on the same index instead of building a new one.
+
+    Handles are created by the given factory on first use, and evicted and closed least recently
+    used first.
+    Concurrent lookups of an index that is not in the registry yet share a single creation.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[str, bool], Awaitable[DataStore]],
+        max_entries: int = DATASTORE_REGISTRY_MAX_ENTRIES,
+    ):
+        self.factory = factory
+        self.max_entries = max_entries
+        self._handles: "OrderedDict[str, DataStore]" = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._handles)}
+
+    async def get(self, index_name: str, create_index: bool = False) -> DataStore:
+        """
+        Return the handle of an index, creating it if it is not in the registry.
+        With create_index, the index is created if needed, on the registered handle if there is one.
+        """
+        handle = None if create_index else self._lookup(index_name)
+        if handle is not None:
+            self.hits += 1
+            return handle
+
+        lock = self._locks.setdefault(index_name, asyncio.Lock())
+        try:
+            async with lock:
+                # another caller may have created the handle while this one was waiting
+                handle = self._lookup(index_name)
+                if handle is not None:
+                    self.hits += 1
+                    if create_index:
+                        await handle.ensure_index()
+                    return handle
+
+                self.misses += 1
+                handle = await self.factory(index_name, create_index)
+                self._handles[index_name] = handle
+                self._handles.move_to_end(index_name)
+                evicted_handles = []
+                while len(self._handles) > self.max_entries:
+                    evicted, evicted_handle = self._handles.popitem(last=False)
+                    self._locks.pop(evicted, None)
+                    evicted_handles.append(evicted_handle)
+        except BaseException:
+            # don't keep a lock for an index that has no handle, such as one that isn't indexed
+            if index_name not in self._handles and self._locks.get(index_name) is lock:
+                del self._locks[index_name]
+            raise
+
+        # closed once the lock is released, so the lookups waiting on it don't wait for the close too
+        for evicted_handle in evicted_handles:
+            await evicted_handle.close()
+        return handle
+
+    def _lookup(self, index_name: str) -> Optional[DataStore]:
+        handle = self._handles.get(index_name)
+        if handle is not None:
+            self._handles.move_to_end(index_name)
+        return handle
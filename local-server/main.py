@@ -10,8 +10,7 @@ import os
 from typing import Optional
 import uvicorn
 from fastapi import FastAPI, File, Form, HTTPException, Body, UploadFile
-import uuid
-import zipfile
+import tempfile
 import os
 import json
 import argparse
@@ -20,11 +19,11 @@ import asyncio
 from models.models import Document, DocumentMetadata, Source
 from datastore.datastore import DataStore
 from datastore.factory import get_datastore
-from services.extract_metadata import extract_metadata_from_document
-from services.file import extract_text_from_filepath
-from services.pii_detection import screen_text_for_pii
-
-DOCUMENT_UPSERT_BATCH_SIZE = 50
+from services.chunks import shutdown_chunking_executor
+from services.ingest import process_file_dump
+from services.jobs import JobProgress, JobQueue
+from services.manifest import IndexManifest
+from services.openai import close_session
 
 
 from models.api import (
@@ -32,6 +31,7 @@ from models.api import (
     DeleteResponse,
     IndexRequest,
     IndexResponse,
+    IndexStatusResponse,
     QueryRequest,
     QueryResponse,
     UpsertRequest,
@@ -62,101 +62,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-async def process_file_dump(
-    filepath: str,
-    datastore: DataStore,
-    custom_metadata: dict,
-    screen_for_pii: bool,
-    extract_metadata: bool,
-):
-    # create a ZipFile object and extract all the files into a directory named 'dump'
-    with zipfile.ZipFile(filepath) as zip_file:
-        zip_file.extractall("dump")
-
-    documents = []
-    skipped_files = []
-    # use os.walk to traverse the dump directory and its subdirectories
-    for root, dirs, files in os.walk("dump"):
-        for filename in files:
-            if len(documents) % 20 == 0:
-                print(f"Processed {len(documents)} documents")
-
-            filepath = os.path.join(root, filename)
-
-            try:
-                extracted_text = extract_text_from_filepath(filepath)
-                print(f"extracted_text from {filepath}")
-
-                # create a metadata object with the source and source_id fields
-                metadata = DocumentMetadata(
-                    source=Source.file,
-                    source_id=filename,
-                )
-
-                # update metadata with custom values
-                for key, value in custom_metadata.items():
-                    if hasattr(metadata, key):
-                        setattr(metadata, key, value)
-
-                # screen for pii if requested
-                if screen_for_pii:
-                    pii_detected = screen_text_for_pii(extracted_text)
-                    # if pii detected, print a warning and skip the document
-                    if pii_detected:
-                        print("PII detected in document, skipping")
-                        skipped_files.append(
-                            filepath
-                        )  # add the skipped file to the list
-                        continue
-
-                # extract metadata if requested
-                if extract_metadata:
-                    # extract metadata from the document text
-                    extracted_metadata = extract_metadata_from_document(
-                        f"Text: {extracted_text}; Metadata: {str(metadata)}"
-                    )
-                    # get a Metadata object from the extracted metadata
-                    metadata = DocumentMetadata(**extracted_metadata)
-
-                # create a document object with a random id, text and metadata
-                document = Document(
-                    id=str(uuid.uuid4()),
-                    text=extracted_text,
-                    metadata=metadata,
-                )
-                documents.append(document)
-            except Exception as e:
-                # log the error and continue with the next file
-                print(f"Error processing {filepath}: {e}")
-                skipped_files.append(filepath)  # add the skipped file to the list
-
-    # do this in batches, the upsert method already batches documents but this allows
-    # us to add more descriptive logging
-    for i in range(0, len(documents), DOCUMENT_UPSERT_BATCH_SIZE):
-        # Get the text of the chunks in the current batch
-        batch_documents = [doc for doc in documents[i : i + DOCUMENT_UPSERT_BATCH_SIZE]]
-        print(f"Upserting batch of {len(batch_documents)} documents, batch {i}")
-        print("documents: ", documents)
-        await datastore.upsert(batch_documents)
-
-    # delete all files in the dump directory
-    for root, dirs, files in os.walk("dump", topdown=False):
-        for filename in files:
-            filepath = os.path.join(root, filename)
-            os.remove(filepath)
-        for dirname in dirs:
-            dirpath = os.path.join(root, dirname)
-            os.rmdir(dirpath)
-
-    # delete the dump directory
-    os.rmdir("dump")
-
-    # print the skipped files
-    print(f"Skipped {len(skipped_files)} files due to errors or PII detection")
-    for file in skipped_files:
-        print(file)
-
-
 def convert_url_to_name(url):
     print("doing convert..")
 
@@ -245,39 +150,36 @@ def get_default_branch_name(repo_url):
         return None
 
 
-def download_zip_file(filename, url, output_dir='.'):
-    output_path = f"{output_dir}/{filename}.zip"
-    print(f"Downloading zip to: {output_path}")
-
-    # Send a GET request to the URL to download the file
-    response = requests.get(url)
-
-    # Check if the request was successful (status code 200)
-    if response.status_code == 200:
-        # Write the content of the response to a local file
-        with open(output_path, 'wb') as file:
-            file.write(response.content)
-        print(f"File downloaded successfully to {output_path}")
-    else:
-        print(f"Failed to download file. Status code: {response.status_code}")
-
-@app.post(
-    "/index-repo",
-    response_model=IndexResponse,
-)
-async def index_repo(
-    request: IndexRequest = Body(...),
-):
-    repo_name = convert_url_to_name(request.repo_url)
+def download_zip_file(url):
+    # download to a file of its own, so concurrent downloads of the same repo don't clash
+    with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as file:
+        output_path = file.name
+        print(f"Downloading zip to: {output_path}")
+
+        # Send a GET request to the URL and stream the response to the file
+        with requests.get(url, stream=True) as response:
+            # Check if the request was successful (status code 200)
+            if response.status_code == 200:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    file.write(chunk)
+                print(f"File downloaded successfully to {output_path}")
+            else:
+                print(f"Failed to download file. Status code: {response.status_code}")
+
+    return output_path
+
+async def run_index_job(payload: dict, progress: JobProgress):
+    """Index a repo in the background, reporting progress to the job it runs in."""
+    repo_url = payload["repo_url"]
+    repo_name = convert_url_to_name(repo_url)
     print(f"Indexing {repo_name}")
 
-    zip_url = convert_to_zip_url(request.repo_url)
+    # the GitHub calls are blocking, keep them off the event loop
+    zip_url = await asyncio.to_thread(convert_to_zip_url, repo_url)
     print(f"Downloading {zip_url}")
-    download_zip_file(repo_name, zip_url)
+    zip_filename = await asyncio.to_thread(download_zip_file, zip_url)
 
-    zip_filename = f"./{repo_name}.zip"
-
-    index_name = convert_url_to_name(request.repo_url)
+    index_name = convert_url_to_name(repo_url)
 
     # initialize the db instance once as a global variable
     datastore = await get_datastore(index_name, True)
@@ -285,12 +187,55 @@ async def index_repo(
     screen_for_pii = False
     extract_metadata = False
 
-    await process_file_dump(filepath=zip_filename, datastore=datastore, custom_metadata=custom_metadata, screen_for_pii=screen_for_pii, extract_metadata=extract_metadata)
+    # only changed files are re-indexed, based on the manifest of the previous run. Without one,
+    # start from an empty index so vectors of earlier runs with random document ids don't linger,
+    # unless the index is shared with other repos, whose vectors delete_all would wipe too
+    if not IndexManifest.exists(index_name):
+        if datastore.SEPARATE_INDEXES:
+            await datastore.delete(delete_all=True)
+        else:
+            print(f"No manifest for {index_name}, vectors left by earlier runs of the repo are kept")
+    manifest = IndexManifest.load(index_name)
+
+    try:
+        await process_file_dump(filepath=zip_filename, datastore=datastore, custom_metadata=custom_metadata, screen_for_pii=screen_for_pii, extract_metadata=extract_metadata, repo_url=repo_url, manifest=manifest, progress=progress)
+    finally:
+        os.remove(zip_filename)
 
-    os.remove(zip_filename)
 
-    success = True
-    return IndexResponse(success=success)
+# jobs indexing the same repo run one at a time, they share its index and manifest
+job_queue = JobQueue(
+    run_index_job, key=lambda payload: convert_url_to_name(payload["repo_url"])
+)
+
+@app.post(
+    "/index-repo",
+    response_model=IndexResponse,
+)
+async def index_repo(
+    request: IndexRequest = Body(...),
+):
+    # indexing a repo takes minutes, so it runs as a background job and its progress is polled
+    # from /index-status
+    job_id = await job_queue.submit({"repo_url": request.repo_url})
+    print(f"Queued indexing of {request.repo_url} as job {job_id}")
+    return IndexResponse(success=True, job_id=job_id)
+
+@app.get(
+    "/index-status/{job_id}",
+    response_model=IndexStatusResponse,
+)
+async def index_status(job_id: str):
+    job = await job_queue.status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No indexing job with id {job_id}")
+    return IndexStatusResponse(
+        job_id=job_id,
+        repo_url=job["payload"]["repo_url"],
+        status=job["status"],
+        error=job["error"],
+        **job["progress"],
+    )
 
 @app.post(
     "/upsert-file",
@@ -339,11 +284,13 @@ async def query_main(request: QueryRequest = Body(...)):
         print("Query - checking datastore")
         index_name = convert_url_to_name(request.repo_url)
         global datastore
+        # a warm handle from the registry, so only the first query on an index pays for connecting
         datastore = await get_datastore(index_name)
 
         results = await datastore.query(
             request.queries,
-            request.repo_url
+            request.repo_url,
+            max_response_tokens=request.max_response_tokens,
         )
         return QueryResponse(results=results)
     except Exception as e:
@@ -381,7 +328,14 @@ async def delete(
 
 @app.on_event("startup")
 async def startup():
-    return
+    await job_queue.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await job_queue.stop()
+    await close_session()
+    shutdown_chunking_executor()
 
 def start():
     uvicorn.run("local-server.main:app", host="localhost", port=PORT, reload=True)
@@ -5,7 +5,8 @@ from models.models import (
     QueryResult,
 )
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
+from enum import Enum
 
 
 class UpsertRequest(BaseModel):
@@ -19,6 +20,9 @@ class UpsertResponse(BaseModel):
 class QueryRequest(BaseModel):
     queries: List[Query]
     repo_url: str
+    # the number of tokens the chunks of all the query results can add up to, the lowest ranked
+    # chunks are left out to fit it
+    max_response_tokens: Optional[int] = None
 
 
 class QueryResponse(BaseModel):
@@ -39,3 +43,35 @@ class IndexRequest(BaseModel):
 
 class IndexResponse(BaseModel):
     success: bool
+    job_id: Optional[str] = None
+
+
+class JobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    completed = "completed"
+    failed = "failed"
+
+
+class PipelineStageStatus(BaseModel):
+    batches: int = 0
+    items: int = 0
+    busy_seconds: float = 0
+    elapsed_seconds: float = 0
+    items_per_second: float = 0
+
+
+class IndexStatusResponse(BaseModel):
+    job_id: str
+    repo_url: str
+    status: JobStatus
+    files_processed: int = 0
+    chunks_embedded: int = 0
+    vectors_written: int = 0
+    elapsed_seconds: float = 0
+    files_per_second: float = 0
+    chunks_per_second: float = 0
+    vectors_per_second: float = 0
+    # the work done by each stage of the ingest pipeline, to find the stage that limits throughput
+    stages: Dict[str, PipelineStageStatus] = {}
+    error: Optional[str] = None
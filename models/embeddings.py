@@ -0,0 +1,74 @@
+from typing import Any, Iterator, List, Optional, Sequence, Union
+
+import numpy as np
+
+# An embedding as it flows through an ingest: a float32 row of an EmbeddingBatch, or a list of floats
+# when it comes from an API request or a datastore
+Embedding = Union[np.ndarray, List[float]]
+
+
+class EmbeddingBatch:
+    """
+    A batch of embeddings kept as one contiguous float32 matrix, one row per embedding.
+
+    Embeddings are parsed from the OpenAI response into the matrix once, and the chunks of an ingest
+    hold views of its rows, so they are neither validated float by float by pydantic nor copied
+    between the stages. They are only converted to the format of a datastore client at the wire
+    boundary, with embedding_to_list or stack_embeddings.
+    """
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.vectors.ndim != 2:
+            raise ValueError(f"An embedding batch is a matrix, got an array of shape {self.vectors.shape}")
+
+    @classmethod
+    def from_lists(cls, embeddings: Sequence[Sequence[float]]) -> "EmbeddingBatch":
+        return cls(np.array(embeddings, dtype=np.float32).reshape(len(embeddings), -1))
+
+    @classmethod
+    def empty(cls, size: int, dimension: int) -> "EmbeddingBatch":
+        return cls(np.empty((size, dimension), dtype=np.float32))
+
+    @property
+    def dimension(self) -> int:
+        return self.vectors.shape[1]
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.vectors[i]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        return iter(self.vectors)
+
+    def tolist(self) -> List[List[float]]:
+        return self.vectors.tolist()
+
+
+def assign_embeddings(chunks: Sequence[Any], embeddings: Union[np.ndarray, Sequence[Sequence[float]]]):
+    """
+    Set the embedding of each chunk to a row of one EmbeddingBatch of the embeddings, without the
+    pydantic validation of every float that passing them to the DocumentChunk constructor costs.
+    """
+    if isinstance(embeddings, np.ndarray):
+        batch = EmbeddingBatch(embeddings)
+    else:
+        batch = EmbeddingBatch.from_lists(embeddings)
+    for i, chunk in enumerate(chunks):
+        chunk.embedding = batch[i]
+
+
+def embedding_to_list(embedding: Optional[Embedding]) -> Optional[List[float]]:
+    """Return an embedding as a list of floats, the format of JSON and of most datastore clients."""
+    if isinstance(embedding, np.ndarray):
+        return embedding.tolist()
+    return embedding
+
+
+def stack_embeddings(embeddings: Sequence[Embedding]) -> np.ndarray:
+    """Return embeddings as a float32 matrix, one row per embedding."""
+    if not embeddings:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack([np.asarray(embedding, dtype=np.float32) for embedding in embeddings])
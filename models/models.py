@@ -24,7 +24,11 @@ class DocumentChunkMetadata(DocumentMetadata):
 class DocumentChunk(BaseModel):
     id: Optional[str] = None
     text: str
+    metadata: Optional[DocumentChunkMetadata] = None
     embedding: Optional[List[float]] = None
+    # the number of tokens of the text, counted when the chunk is created so queries can fit their
+    # results to a token budget without tokenizing them again
+    token_count: Optional[int] = None
 
 
 class DocumentChunkWithScore(DocumentChunk):
@@ -54,6 +58,8 @@ class Query(BaseModel):
     query: str
     filter: Optional[DocumentMetadataFilter] = None
     top_k: Optional[int] = 9
+    # whether the results carry the embeddings of their chunks, which are large and rarely read
+    include_embeddings: Optional[bool] = False
 
 
 class QueryWithEmbedding(Query):
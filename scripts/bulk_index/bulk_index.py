@@ -0,0 +1,56 @@
+import argparse
+import asyncio
+import time
+
+from datastore.datastore import DataStore
+from datastore.factory import get_datastore
+from services.bulk import BULK_BATCH_SIZE, BulkWriter, read_chunks
+
+
+async def export_index(datastore: DataStore, filepath: str, batch_size: int) -> int:
+    # write each batch as it is read, so only one batch is held in memory
+    with BulkWriter(filepath) as writer:
+        async for chunks in datastore.export_chunks(batch_size):
+            await asyncio.to_thread(writer.write, chunks)
+            print(f"Exported {writer.count} chunks")
+        return writer.count
+
+
+async def import_index(datastore: DataStore, filepath: str, batch_size: int) -> int:
+    # the chunks keep the embeddings stored in the file, so nothing is sent to OpenAI
+    return await datastore.import_chunks(read_chunks(filepath, batch_size))
+
+
+async def main():
+    # parse the command-line arguments
+    parser = argparse.ArgumentParser(
+        description="Export the chunks of an index with their embeddings to a file, or import them from one"
+    )
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("--index_name", required=True, help="The name of the index to export or import")
+    parser.add_argument(
+        "--filepath",
+        required=True,
+        help="The file to export to or import from, a .jsonl, .jsonl.gz or .parquet file",
+    )
+    parser.add_argument(
+        "--batch_size",
+        default=BULK_BATCH_SIZE,
+        type=int,
+        help="The number of chunks read or written at a time",
+    )
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    if args.command == "export":
+        datastore = await get_datastore(args.index_name)
+        count = await export_index(datastore, args.filepath, args.batch_size)
+    else:
+        # an import fills a new index, so it is created if needed
+        datastore = await get_datastore(args.index_name, create_index=True)
+        count = await import_index(datastore, args.filepath, args.batch_size)
+    print(f"{args.command.capitalize()}ed {count} chunks in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
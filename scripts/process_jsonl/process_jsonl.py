@@ -2,14 +2,18 @@ import uuid
 import json
 import argparse
 import asyncio
+from typing import Optional
 
 from models.models import Document, DocumentMetadata
 from datastore.datastore import DataStore
 from datastore.factory import get_datastore
-from services.extract_metadata import extract_metadata_from_document
-from services.pii_detection import screen_text_for_pii
-
-DOCUMENT_UPSERT_BATCH_SIZE = 50
+from services.enrichment import DocumentEnricher
+from services.openai import close_session
+from services.records import (
+    INGEST_BATCH_SIZE,
+    IngestCheckpoint,
+    iter_jsonl_records,
+)
 
 
 async def process_jsonl_dump(
@@ -18,17 +22,57 @@ async def process_jsonl_dump(
     custom_metadata: dict,
     screen_for_pii: bool,
     extract_metadata: bool,
+    batch_size: int = INGEST_BATCH_SIZE,
+    checkpoint_path: Optional[str] = None,
 ):
-    # open the jsonl file as a generator of dictionaries
-    with open(filepath) as jsonl_file:
-        data = [json.loads(line) for line in jsonl_file]
-
-    documents = []
+    # resume after the last batch written by an interrupted run, if there is one
+    checkpoint = IngestCheckpoint(filepath, checkpoint_path)
+    if checkpoint.offset:
+        print(f"Resuming after {checkpoint.records} items, at byte {checkpoint.offset}")
+    num_items = checkpoint.records
+    offset = checkpoint.offset
+
+    # the items of the current batch, with the id, text and metadata of their documents
+    pending = []
     skipped_items = []
-    # iterate over the data and create document objects
-    for item in data:
-        if len(documents) % 20 == 0:
-            print(f"Processed {len(documents)} documents")
+    enricher = DocumentEnricher(screen_for_pii, extract_metadata)
+
+    async def upsert_batch():
+        # enrich and upsert the documents of the batch, then move the checkpoint past its items
+        nonlocal pending
+        documents = []
+        if enricher.enabled:
+            # screen the documents for pii and extract their metadata concurrently
+            results = await enricher.enrich_many(
+                [(text, metadata) for _, _, text, metadata in pending]
+            )
+        else:
+            results = [metadata for _, _, _, metadata in pending]
+        for (item, id, text, _), result in zip(pending, results):
+            if result is None:
+                # if pii detected, print a warning and skip the document
+                print("PII detected in document, skipping")
+                skipped_items.append(item)  # add the skipped item to the list
+            elif isinstance(result, BaseException):
+                # log the error and continue with the next item
+                print(f"Error processing {item}: {result}")
+                skipped_items.append(item)  # add the skipped item to the list
+            else:
+                # create a document object with the id, text and metadata
+                documents.append(Document(id=id, text=text, metadata=result))
+        pending = []
+
+        if documents:
+            print(f"Upserting {len(documents)} documents")
+            await datastore.upsert(documents)
+        checkpoint.save(offset, num_items)
+
+    # read the jsonl file one line at a time and create document objects, so only the current
+    # batch of documents is held in memory
+    for item, offset in iter_jsonl_records(filepath, checkpoint.offset):
+        num_items += 1
+        if num_items % 20 == 0:
+            print(f"Processed {num_items} items")
 
         try:
             # get the id, text, source, source_id, url, created_at and author from the item
@@ -59,43 +103,21 @@ async def process_jsonl_dump(
                 if hasattr(metadata, key):
                     setattr(metadata, key, value)
 
-            # screen for pii if requested
-            if screen_for_pii:
-                pii_detected = screen_text_for_pii(text)
-                # if pii detected, print a warning and skip the document
-                if pii_detected:
-                    print("PII detected in document, skipping")
-                    skipped_items.append(item)  # add the skipped item to the list
-                    continue
-
-            # extract metadata if requested
-            if extract_metadata:
-                # extract metadata from the document text
-                extracted_metadata = extract_metadata_from_document(
-                    f"Text: {text}; Metadata: {str(metadata)}"
-                )
-                # get a Metadata object from the extracted metadata
-                metadata = DocumentMetadata(**extracted_metadata)
-
-            # create a document object with the id, text and metadata
-            document = Document(
-                id=id,
-                text=text,
-                metadata=metadata,
-            )
-            documents.append(document)
+            # the documents are screened and enriched a batch at a time, before the batch is upserted
+            pending.append((item, id, text, metadata))
         except Exception as e:
             # log the error and continue with the next item
             print(f"Error processing {item}: {e}")
             skipped_items.append(item)  # add the skipped item to the list
 
-    # do this in batches, the upsert method already batches documents but this allows
-    # us to add more descriptive logging
-    for i in range(0, len(documents), DOCUMENT_UPSERT_BATCH_SIZE):
-        # Get the text of the chunks in the current batch
-        batch_documents = documents[i : i + DOCUMENT_UPSERT_BATCH_SIZE]
-        print(f"Upserting batch of {len(batch_documents)} documents, batch {i}")
-        await datastore.upsert(batch_documents)
+        # upsert the batch once it is full, the ingest pipeline overlaps the chunking,
+        # embedding and writes of its documents
+        if len(pending) >= batch_size:
+            await upsert_batch()
+
+    await upsert_batch()
+    # the whole file is ingested, so a new run starts from the beginning
+    checkpoint.clear()
 
     # print the skipped items
     print(f"Skipped {len(skipped_items)} items due to errors or PII detection")
@@ -124,6 +146,17 @@ async def main():
         type=bool,
         help="A boolean flag to indicate whether to try to extract metadata from the document (using a language model)",
     )
+    parser.add_argument(
+        "--batch_size",
+        default=INGEST_BATCH_SIZE,
+        type=int,
+        help="The number of documents upserted at a time, progress is checkpointed after each batch",
+    )
+    parser.add_argument(
+        "--checkpoint_path",
+        default=None,
+        help="The file tracking progress through the dump, defaults to the dump path with a .checkpoint suffix",
+    )
     args = parser.parse_args()
 
     # get the arguments
@@ -135,9 +168,18 @@ async def main():
     # initialize the db instance once as a global variable
     datastore = await get_datastore()
     # process the jsonl dump
-    await process_jsonl_dump(
-        filepath, datastore, custom_metadata, screen_for_pii, extract_metadata
-    )
+    try:
+        await process_jsonl_dump(
+            filepath,
+            datastore,
+            custom_metadata,
+            screen_for_pii,
+            extract_metadata,
+            batch_size=args.batch_size,
+            checkpoint_path=args.checkpoint_path,
+        )
+    finally:
+        await close_session()
 
 
 if __name__ == "__main__":
@@ -20,6 +20,7 @@ from models.api import (
 )
 from datastore.factory import get_datastore
 from services.file import get_document_from_file
+from services.openai import close_session
 
 from models.models import DocumentMetadata, Source
 
@@ -100,6 +101,7 @@ async def query_main(
     try:
         results = await datastore.query(
             request.queries,
+            max_response_tokens=request.max_response_tokens,
         )
         return QueryResponse(results=results)
     except Exception as e:
@@ -111,7 +113,7 @@ async def query_main(
     "/query",
     response_model=QueryResponse,
     # NOTE: We are describing the shape of the API endpoint input due to a current limitation in parsing arrays of objects from OpenAPI schemas. This will not be necessary in the future.
-    description="Accepts search query objects array each with query and optional filter. Break down complex questions into sub-questions. Refine results by criteria, e.g. time / source, don't do this often. Split queries if ResponseTooLargeError occurs.",
+    description="Accepts search query objects array each with query and optional filter. Break down complex questions into sub-questions. Refine results by criteria, e.g. time / source, don't do this often. Results are trimmed to fit the response, lowest ranked first, so there is no need to split queries.",
 )
 async def query(
     request: QueryRequest = Body(...),
@@ -119,6 +121,7 @@ async def query(
     try:
         results = await datastore.query(
             request.queries,
+            max_response_tokens=request.max_response_tokens,
         )
         return QueryResponse(results=results)
     except Exception as e:
@@ -156,5 +159,10 @@ async def startup():
     datastore = await get_datastore()
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await close_session()
+
+
 def start():
     uvicorn.run("server.main:app", host="0.0.0.0", port=8000, reload=True)
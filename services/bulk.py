@@ -0,0 +1,174 @@
+import gzip
+import json
+import os
+from typing import IO, Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from models.embeddings import assign_embeddings, stack_embeddings
+from models.models import DocumentChunk, DocumentChunkMetadata
+
+# The number of chunks read from or written to a bulk file at a time
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 1000))
+
+# The metadata fields of a chunk, stored as top level fields of a bulk record
+METADATA_FIELDS = list(DocumentChunkMetadata.__fields__.keys())
+
+
+def get_format(path: str) -> str:
+    """Return the bulk format of a file from its extension: .jsonl, .jsonl.gz or .parquet."""
+    if path.endswith(".parquet"):
+        return "parquet"
+    if path.endswith(".jsonl") or path.endswith(".jsonl.gz"):
+        return "jsonl"
+    raise ValueError(f"Can't tell the format of {path}, use a .jsonl, .jsonl.gz or .parquet file")
+
+
+def chunk_to_record(chunk: DocumentChunk) -> Dict[str, Any]:
+    """Return a chunk as a flat record of its id, text, metadata fields and embedding."""
+    record: Dict[str, Any] = {"id": chunk.id, "text": chunk.text}
+    metadata = chunk.metadata or DocumentChunkMetadata()
+    for field in METADATA_FIELDS:
+        value = getattr(metadata, field)
+        # store enums like Source by their value
+        record[field] = getattr(value, "value", value)
+    return record
+
+
+def record_to_chunk(record: Dict[str, Any]) -> DocumentChunk:
+    """Return the chunk of a flat record, without its embedding."""
+    return DocumentChunk(
+        id=record.get("id"),
+        text=record["text"],
+        metadata=DocumentChunkMetadata(
+            **{field: record.get(field) for field in METADATA_FIELDS}
+        ),
+    )
+
+
+class BulkWriter:
+    """
+    Writes batches of chunks with their embeddings to a JSONL (optionally gzipped) or Parquet file,
+    one batch at a time, so an export holds a single batch in memory whatever the size of the index.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.format = get_format(path)
+        self.count = 0
+        self._file: Optional[IO[str]] = None
+        self._writer = None
+
+    def __enter__(self) -> "BulkWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, chunks: List[DocumentChunk]):
+        if not chunks:
+            return
+        if self.format == "parquet":
+            self._write_parquet(chunks)
+        else:
+            self._write_jsonl(chunks)
+        self.count += len(chunks)
+
+    def _write_jsonl(self, chunks: List[DocumentChunk]):
+        if self._file is None:
+            if self.path.endswith(".gz"):
+                self._file = gzip.open(self.path, "wt", encoding="utf-8")
+            else:
+                self._file = open(self.path, "w", encoding="utf-8")
+        embeddings = stack_embeddings([chunk.embedding for chunk in chunks])  # type: ignore
+        lines = []
+        for chunk, embedding in zip(chunks, embeddings.tolist()):
+            record = chunk_to_record(chunk)
+            record["embedding"] = embedding
+            lines.append(json.dumps(record))
+        self._file.write("\n".join(lines) + "\n")
+
+    def _write_parquet(self, chunks: List[DocumentChunk]):
+        pa, pq = _import_pyarrow()
+        records = [chunk_to_record(chunk) for chunk in chunks]
+        embeddings = stack_embeddings([chunk.embedding for chunk in chunks])  # type: ignore
+        columns = {
+            field: pa.array([record[field] for record in records], type=pa.string())
+            for field in ["id", "text", *METADATA_FIELDS]
+        }
+        # the embeddings go in as one flat float32 buffer, without a Python float per value
+        columns["embedding"] = pa.FixedSizeListArray.from_arrays(
+            pa.array(embeddings.ravel(), type=pa.float32()), embeddings.shape[1]
+        )
+        table = pa.table(columns)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def read_chunks(path: str, batch_size: int = BULK_BATCH_SIZE) -> Iterator[List[DocumentChunk]]:
+    """
+    Read the chunks of a bulk file in batches, with their embeddings as rows of one EmbeddingBatch
+    per batch. Only one batch is held in memory at a time.
+    """
+    if get_format(path) == "parquet":
+        yield from _read_parquet(path, batch_size)
+    else:
+        yield from _read_jsonl(path, batch_size)
+
+
+def _read_jsonl(path: str, batch_size: int) -> Iterator[List[DocumentChunk]]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as file:  # type: ignore
+        chunks: List[DocumentChunk] = []
+        embeddings: List[List[float]] = []
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            chunks.append(record_to_chunk(record))
+            embeddings.append(record["embedding"])
+            if len(chunks) == batch_size:
+                assign_embeddings(chunks, np.asarray(embeddings, dtype=np.float32))
+                yield chunks
+                chunks, embeddings = [], []
+        if chunks:
+            assign_embeddings(chunks, np.asarray(embeddings, dtype=np.float32))
+            yield chunks
+
+
+def _read_parquet(path: str, batch_size: int) -> Iterator[List[DocumentChunk]]:
+    _, pq = _import_pyarrow()
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        names = batch.schema.names
+        columns = {
+            name: batch.column(i).to_pylist() for i, name in enumerate(names) if name != "embedding"
+        }
+        embeddings = batch.column(names.index("embedding")).flatten().to_numpy(zero_copy_only=False)
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(batch.num_rows, -1)
+        chunks = [
+            record_to_chunk({name: values[i] for name, values in columns.items()})
+            for i in range(batch.num_rows)
+        ]
+        assign_embeddings(chunks, embeddings)
+        yield chunks
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError(
+            "Parquet files need the pyarrow package, install it with `pip install pyarrow`"
+        ) from e
+    return pa, pq
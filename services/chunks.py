@@ -1,10 +1,16 @@
-from typing import Dict, List, Optional, Tuple
+import asyncio
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
 import uuid
+from models.embeddings import EmbeddingBatch
 from models.models import Document, DocumentChunk, DocumentChunkMetadata
 
 import tiktoken
 
-from services.openai import get_embeddings
+from services.embedding_cache import get_embedding_cache
+from services.openai import EMBEDDING_MODEL, get_embeddings
 
 # Global variables
 tokenizer = tiktoken.get_encoding(
@@ -18,46 +24,74 @@ MIN_CHUNK_LENGTH_TO_EMBED = 5  # Discard chunks shorter than this
 EMBEDDINGS_BATCH_SIZE = 128  # The number of embeddings to request at a time
 MAX_NUM_CHUNKS = 10000  # The maximum number of chunks to generate from a text
 
+# The number of worker processes that chunk documents, 0 chunks in a thread of the event loop instead
+CHUNKING_WORKERS = int(os.environ.get("CHUNKING_WORKERS", os.cpu_count() or 1))
 
-def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
+_chunking_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_chunking_executor() -> Optional[ProcessPoolExecutor]:
     """
-    Split a text into chunks of ~CHUNK_SIZE tokens, based on punctuation and newline boundaries.
+    Return the process pool that chunks documents, shared by the process, or None if CHUNKING_WORKERS is 0.
+    Tokenizing is the main CPU cost of an ingest, so it runs outside of the process serving queries.
+    """
+    global _chunking_executor
+    if _chunking_executor is None and CHUNKING_WORKERS > 0:
+        _chunking_executor = ProcessPoolExecutor(max_workers=CHUNKING_WORKERS)
+    return _chunking_executor
+
+
+def shutdown_chunking_executor():
+    global _chunking_executor
+    if _chunking_executor is not None:
+        _chunking_executor.shutdown(cancel_futures=True)
+        _chunking_executor = None
+
+
+def iter_text_chunks(text: str, chunk_token_size: Optional[int]) -> Iterator[str]:
+    """
+    Lazily split a text into chunks of ~CHUNK_SIZE tokens, based on punctuation and newline boundaries.
+
+    The text is encoded once and walked with a cursor into the token list, so the cost is linear in the
+    length of the text. The cursor advances by the token length of each emitted chunk's text, which is
+    what the original slicing implementation did, so the chunk boundaries are unchanged.
 
     Args:
         text: The text to split into chunks.
         chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
 
-    Returns:
-        A list of text chunks, each of which is a string of ~CHUNK_SIZE tokens.
+    Yields:
+        Text chunks, each of which is a string of ~CHUNK_SIZE tokens.
     """
-    # Return an empty list if the text is empty or whitespace
+    # Return early if the text is empty or whitespace
     if not text or text.isspace():
-        return []
+        return
 
     # Tokenize the text
     tokens = tokenizer.encode(text, disallowed_special=())
-
-    # Initialize an empty list of chunks
-    chunks = []
+    num_tokens = len(tokens)
 
     # Use the provided chunk token size or the default one
     chunk_size = chunk_token_size or CHUNK_SIZE
 
+    # The index of the first token that has not been consumed yet
+    cursor = 0
+
     # Initialize a counter for the number of chunks
     num_chunks = 0
 
     # Loop until all tokens are consumed
-    while tokens and num_chunks < MAX_NUM_CHUNKS:
-        # Take the first chunk_size tokens as a chunk
-        chunk = tokens[:chunk_size]
+    while cursor < num_tokens and num_chunks < MAX_NUM_CHUNKS:
+        # Take the next chunk_size tokens as a chunk
+        chunk = tokens[cursor : cursor + chunk_size]
 
         # Decode the chunk into text
         chunk_text = tokenizer.decode(chunk)
 
         # Skip the chunk if it is empty or whitespace
         if not chunk_text or chunk_text.isspace():
-            # Remove the tokens corresponding to the chunk text from the remaining tokens
-            tokens = tokens[len(chunk) :]
+            # Move the cursor past the tokens of the chunk
+            cursor += len(chunk)
             # Continue to the next iteration of the loop
             continue
 
@@ -78,22 +112,41 @@ def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
         chunk_text_to_append = chunk_text.replace("\n", " ").strip()
 
         if len(chunk_text_to_append) > MIN_CHUNK_LENGTH_TO_EMBED:
-            # Append the chunk text to the list of chunks
-            chunks.append(chunk_text_to_append)
+            yield chunk_text_to_append
 
-        # Remove the tokens corresponding to the chunk text from the remaining tokens
-        tokens = tokens[len(tokenizer.encode(chunk_text, disallowed_special=())) :]
+        # Move the cursor past the tokens of the chunk text. The chunk text is re-encoded rather than
+        # mapped back onto the original tokens because BPE can merge a truncated prefix differently,
+        # and the boundaries have to stay identical to the ones already stored in existing indexes.
+        # The re-encoded text is at most chunk_size tokens long, so this stays linear overall.
+        cursor += len(tokenizer.encode(chunk_text, disallowed_special=()))
 
         # Increment the number of chunks
         num_chunks += 1
 
     # Handle the remaining tokens
-    if tokens:
-        remaining_text = tokenizer.decode(tokens).replace("\n", " ").strip()
+    if cursor < num_tokens:
+        remaining_text = tokenizer.decode(tokens[cursor:]).replace("\n", " ").strip()
         if len(remaining_text) > MIN_CHUNK_LENGTH_TO_EMBED:
-            chunks.append(remaining_text)
+            yield remaining_text
+
 
-    return chunks
+def count_tokens(text: str) -> int:
+    """Return the number of tokens of a text, with the tokenizer chunks are split with."""
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+
+def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
+    """
+    Split a text into chunks of ~CHUNK_SIZE tokens, based on punctuation and newline boundaries.
+
+    Args:
+        text: The text to split into chunks.
+        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+
+    Returns:
+        A list of text chunks, each of which is a string of ~CHUNK_SIZE tokens.
+    """
+    return list(iter_text_chunks(text, chunk_token_size))
 
 
 def create_document_chunks(
@@ -117,8 +170,8 @@ def create_document_chunks(
     # Generate a document id if not provided
     doc_id = doc.id or str(uuid.uuid4())
 
-    # Split the document text into chunks
-    text_chunks = get_text_chunks(doc.text, chunk_token_size)
+    # Split the document text into chunks lazily
+    text_chunks = iter_text_chunks(doc.text, chunk_token_size)
 
     metadata = (
         DocumentChunkMetadata(**doc.metadata.__dict__)
@@ -138,6 +191,7 @@ def create_document_chunks(
             id=chunk_id,
             text=text_chunk,
             metadata=metadata,
+            token_count=count_tokens(text_chunk),
         )
         # Append the chunk object to the list of chunks for this document
         doc_chunks.append(doc_chunk)
@@ -146,57 +200,82 @@ def create_document_chunks(
     return doc_chunks, doc_id
 
 
-def get_document_chunks(
+def chunk_documents(
     documents: List[Document], chunk_token_size: Optional[int]
-) -> Dict[str, List[DocumentChunk]]:
+) -> List[Tuple[List[DocumentChunk], str]]:
     """
-    Convert a list of documents into a dictionary from document id to list of document chunks.
-
-    Args:
-        documents: The list of documents to convert.
-        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+    Create the chunks of a batch of documents. A module level function, so it can run in a worker process.
 
     Returns:
-        A dictionary mapping each document id to a list of document chunks, each of which is a DocumentChunk object
-        with text, metadata, and embedding attributes.
+        A list of (doc_chunks, doc_id) tuples aligned with documents, as returned by create_document_chunks.
     """
-    # Initialize an empty dictionary of lists of chunks
-    chunks: Dict[str, List[DocumentChunk]] = {}
+    return [create_document_chunks(doc, chunk_token_size) for doc in documents]
 
-    # Initialize an empty list of all chunks
-    all_chunks: List[DocumentChunk] = []
 
-    # Loop over each document and create chunks
-    for doc in documents:
-        doc_chunks, doc_id = create_document_chunks(doc, chunk_token_size)
+async def embed_chunks(chunks: List[DocumentChunk]) -> Optional[EmbeddingBatch]:
+    """
+    Set the embeddings of document chunks in place. Embeddings already computed for the same text
+    are taken from the embedding cache, and only the misses are sent to OpenAI, in parallel batches.
 
-        # Append the chunks for this document to the list of all chunks
-        all_chunks.extend(doc_chunks)
+    Returns:
+        The embeddings of the chunks as an EmbeddingBatch, which the chunk embeddings are rows of,
+        or None if there are no chunks.
+    """
+    if not chunks:
+        return None
+
+    # Look up the embeddings that were already computed for the same text, only the misses are sent to OpenAI
+    embedding_cache = get_embedding_cache()
+    texts = [chunk.text for chunk in chunks]
+    embeddings = await embedding_cache.get_many(EMBEDDING_MODEL, texts)
+    miss_texts = list(
+        dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None)
+    )
 
-        # Add the list of chunks for this document to the dictionary with the document id as the key
-        chunks[doc_id] = doc_chunks
+    if miss_texts:
+        # Get the embeddings for the misses in batches, using get_embeddings.
+        # The batches are requested in parallel, get_embeddings bounds how many run at once.
+        batches = [
+            miss_texts[i : i + EMBEDDINGS_BATCH_SIZE]
+            for i in range(0, len(miss_texts), EMBEDDINGS_BATCH_SIZE)
+        ]
+        batch_embeddings = await asyncio.gather(
+            *[get_embeddings(batch_texts) for batch_texts in batches]
+        )
 
-    # Check if there are no chunks
-    if not all_chunks:
-        return {}
+        # Flatten the batch embeddings, gather keeps them in the order of the batches
+        miss_embeddings = [embedding for batch in batch_embeddings for embedding in batch]
+        await embedding_cache.put_many(EMBEDDING_MODEL, miss_texts, miss_embeddings)
 
-    # Get all the embeddings for the document chunks in batches, using get_embeddings
-    embeddings: List[List[float]] = []
-    for i in range(0, len(all_chunks), EMBEDDINGS_BATCH_SIZE):
-        # Get the text of the chunks in the current batch
-        batch_texts = [
-            chunk.text for chunk in all_chunks[i : i + EMBEDDINGS_BATCH_SIZE]
+        embeddings_by_text = dict(zip(miss_texts, miss_embeddings))
+        embeddings = [
+            embedding if embedding is not None else embeddings_by_text[text]
+            for text, embedding in zip(texts, embeddings)
         ]
 
-        # Get the embeddings for the batch texts
-        batch_embeddings = get_embeddings(batch_texts)
+    # Copy the embeddings into one matrix, and point the document chunk objects at its rows. They are
+    # assigned without pydantic validation, which would convert every float of every embedding.
+    batch = EmbeddingBatch.empty(len(chunks), len(embeddings[0]))  # type: ignore
+    for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
+        batch.vectors[i] = embedding
+        chunk.embedding = batch[i]  # type: ignore
+    return batch
 
-        # Append the batch embeddings to the embeddings list
-        embeddings.extend(batch_embeddings)
 
-    # Update the document chunk objects with the embeddings
-    for i, chunk in enumerate(all_chunks):
-        # Assign the embedding from the embeddings list to the chunk object
-        chunk.embedding = embeddings[i]
+def shard_documents(documents: List[Document], num_shards: int) -> List[List[int]]:
+    """
+    Split documents into at most num_shards shards of about the same amount of text, so the
+    workers chunking them finish at about the same time.
 
-    return chunks
+    Returns:
+        The indexes of the documents in each shard, in input order within a shard.
+    """
+    num_shards = max(1, min(num_shards, len(documents)))
+    # assign the longest documents first, each to the shard with the least text so far
+    shards: List[Tuple[int, int]] = [(0, shard) for shard in range(num_shards)]
+    indexes: List[List[int]] = [[] for _ in range(num_shards)]
+    for i in sorted(range(len(documents)), key=lambda i: -len(documents[i].text or "")):
+        size, shard = heapq.heappop(shards)
+        indexes[shard].append(i)
+        heapq.heappush(shards, (size + len(documents[i].text or ""), shard))
+    return [sorted(shard_indexes) for shard_indexes in indexes if shard_indexes]
@@ -0,0 +1,335 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from models.embeddings import Embedding, embedding_to_list
+from services.openai import get_query_embeddings
+
+# The SQLite file that persists embeddings between runs. The cache is in memory only unless it is set
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "")
+# The maximum number of embeddings kept in the SQLite file, least recently used ones are evicted first.
+# An ada embedding takes about 6 KB, so the default bounds the file to about 600 MB
+EMBEDDING_CACHE_MAX_ENTRIES = int(
+    os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 100_000)
+)
+# The maximum number of embeddings kept in process memory
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(
+    os.environ.get("EMBEDDING_CACHE_MEMORY_ENTRIES", 10_000)
+)
+
+# The maximum number of query embeddings kept in process memory, and how long they are reused for
+QUERY_EMBEDDING_CACHE_ENTRIES = int(
+    os.environ.get("QUERY_EMBEDDING_CACHE_ENTRIES", 10_000)
+)
+QUERY_EMBEDDING_CACHE_TTL_SECONDS = float(
+    os.environ.get("QUERY_EMBEDDING_CACHE_TTL_SECONDS", 3600)
+)
+
+# The number of keys per SQL statement, below SQLite's default limit on host parameters
+SQLITE_BATCH_SIZE = 500
+
+
+class LRUCache:
+    """
+    A size-bounded in-process cache that evicts the least recently used entries first.
+    Entries optionally expire ttl_seconds after they were stored.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, Tuple[Any, Optional[float]]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> int:
+        """Store a value and return the number of entries evicted to make room for it."""
+        expires_at = (
+            time.monotonic() + self.ttl_seconds if self.ttl_seconds is not None else None
+        )
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        evicted = 0
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    def clear(self):
+        self._entries.clear()
+
+
+class EmbeddingCache:
+    """
+    A content-addressed cache of embeddings, keyed by a hash of the model name and the embedded text.
+
+    Lookups go to an in-process LRU tier first and then, when a path is given, to a SQLite file, so
+    embeddings survive restarts and a re-index only pays for text that was never embedded before.
+    Both tiers are size-bounded and evict the least recently used embeddings.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = EMBEDDING_CACHE_PATH,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+        memory_entries: int = EMBEDDING_CACHE_MEMORY_ENTRIES,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self._memory = LRUCache(memory_entries)
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_entries = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+            )
+            self._db.commit()
+            self._db_entries = self._db.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()[0]
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+            "disk_entries": self._db_entries,
+        }
+
+    async def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Look up the embeddings of texts.
+
+        Returns:
+            A list aligned with texts, holding the cached embedding as a float32 array or None for each text.
+        """
+        keys = [self.key(model, text) for text in texts]
+        results: List[Optional[np.ndarray]] = [self._memory.get(key) for key in keys]
+        self.memory_hits += sum(result is not None for result in results)
+
+        missing = [key for key, result in zip(keys, results) if result is None]
+        if missing and self._db is not None:
+            found = await asyncio.to_thread(self._db_get, missing)
+            for i, key in enumerate(keys):
+                if results[i] is None and key in found:
+                    results[i] = found[key]
+                    self.disk_hits += 1
+                    # Promote the embedding to the memory tier
+                    self.evictions += self._memory.put(key, found[key])
+
+        self.misses += sum(result is None for result in results)
+        return results
+
+    async def put_many(
+        self, model: str, texts: List[str], embeddings: Sequence[Embedding]
+    ):
+        """Store the embeddings of texts in both tiers."""
+        items: Dict[str, np.ndarray] = {}
+        for text, embedding in zip(texts, embeddings):
+            key = self.key(model, text)
+            # copy the embedding, so a cached row doesn't keep the whole batch it is a view of alive
+            items[key] = np.array(embedding, dtype=np.float32)
+            self.evictions += self._memory.put(key, items[key])
+
+        if items and self._db is not None:
+            await asyncio.to_thread(self._db_put, items)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _db_get(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found: Dict[str, np.ndarray] = {}
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(keys), SQLITE_BATCH_SIZE):
+                batch = keys[i : i + SQLITE_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._db.execute(  # type: ignore
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+                # Mark the hits as recently used, so they are the last to be evicted
+                self._db.execute(  # type: ignore
+                    f"UPDATE embeddings SET last_used = ? WHERE key IN ({placeholders})",
+                    [now, *batch],
+                )
+            self._db.commit()  # type: ignore
+        return found
+
+    def _db_put(self, items: Dict[str, np.ndarray]):
+        now = time.time()
+        with self._lock:
+            before = self._db.total_changes  # type: ignore
+            self._db.executemany(  # type: ignore
+                "INSERT OR IGNORE INTO embeddings (key, embedding, last_used) VALUES (?, ?, ?)",
+                [
+                    (key, embedding.tobytes(), now)
+                    for key, embedding in items.items()
+                ],
+            )
+            self._db_entries += self._db.total_changes - before  # type: ignore
+
+            # Evict the least recently used embeddings once the file grows past its bound
+            excess = self._db_entries - self.max_entries
+            if excess > 0:
+                self._db.execute(  # type: ignore
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+                self._db_entries -= excess
+                self.evictions += excess
+            self._db.commit()  # type: ignore
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Return the embedding cache shared by the process."""
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache()
+    return _embedding_cache
+
+
+class QueryEmbeddingCache:
+    """
+    A TTL and LRU bounded cache of query text to embedding, with in-flight request coalescing.
+
+    Query texts are compared after collapsing whitespace. Concurrent lookups of a query that is
+    already being embedded wait for that request instead of sending their own, so a burst of
+    identical queries costs a single upstream call.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = QUERY_EMBEDDING_CACHE_ENTRIES,
+        ttl_seconds: float = QUERY_EMBEDDING_CACHE_TTL_SECONDS,
+    ):
+        self._cache = LRUCache(max_entries, ttl_seconds)
+        # the request embedding each query text that is being embedded
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split())
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "entries": len(self._cache),
+        }
+
+    async def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed query texts, reusing cached and in-flight embeddings.
+
+        Returns:
+            A list of embeddings aligned with texts.
+        """
+        keys = [self.normalize(text) for text in texts]
+
+        embeddings: Dict[str, List[float]] = {}
+        waiting: Dict[str, asyncio.Task] = {}
+        to_fetch: List[str] = []
+        for key in dict.fromkeys(keys):
+            cached = self._cache.get(key)
+            if cached is not None:
+                self.hits += 1
+                embeddings[key] = cached
+            elif key in self._in_flight:
+                self.coalesced += 1
+                waiting[key] = self._in_flight[key]
+            else:
+                self.misses += 1
+                to_fetch.append(key)
+
+        if to_fetch:
+            # the request runs in a task of its own, so cancelling the caller that started it, such
+            # as on a client disconnect, doesn't fail the callers coalesced onto it
+            fetch = asyncio.create_task(self._fetch(to_fetch))
+            # the error is raised to the callers, don't warn if they were all cancelled
+            fetch.add_done_callback(lambda task: task.cancelled() or task.exception())
+            for key in to_fetch:
+                self._in_flight[key] = fetch
+                waiting[key] = fetch
+
+        for key, fetch in waiting.items():
+            # Shield the shared request, so cancelling this caller doesn't cancel it for the others
+            embeddings[key] = (await asyncio.shield(fetch))[key]
+
+        return [embeddings[key] for key in keys]
+
+    async def _fetch(self, keys: List[str]) -> Dict[str, List[float]]:
+        """Embed the query texts of keys and cache them, failed requests aren't cached."""
+        try:
+            fetched = await get_query_embeddings(keys)
+            embeddings = {}
+            # queries are validated as lists of floats, so they are cached as lists
+            for key, embedding in zip(keys, map(embedding_to_list, fetched)):
+                self._cache.put(key, embedding)
+                embeddings[key] = embedding
+            return embeddings
+        finally:
+            for key in keys:
+                self._in_flight.pop(key, None)
+
+
+_query_embedding_cache: Optional[QueryEmbeddingCache] = None
+
+
+def get_query_embedding_cache() -> QueryEmbeddingCache:
+    """Return the query embedding cache shared by the process."""
+    global _query_embedding_cache
+    if _query_embedding_cache is None:
+        _query_embedding_cache = QueryEmbeddingCache()
+    return _query_embedding_cache
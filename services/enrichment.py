@@ -0,0 +1,299 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from models.models import DocumentMetadata
+from services.embedding_cache import SQLITE_BATCH_SIZE, LRUCache
+from services.extract_metadata import (
+    METADATA_EXTRACTION_MODEL,
+    extract_metadata_from_document_async,
+)
+from services.pii_detection import PII_DETECTION_MODEL, screen_text_for_pii_async
+
+# The SQLite file that persists PII screening and metadata extraction results between runs, set to
+# an empty string to keep the cache in memory only
+ENRICHMENT_CACHE_PATH = os.environ.get(
+    "ENRICHMENT_CACHE_PATH", ".enrichment_cache.sqlite3"
+)
+# The maximum number of results kept in the SQLite file, least recently used ones are evicted first
+ENRICHMENT_CACHE_MAX_ENTRIES = int(
+    os.environ.get("ENRICHMENT_CACHE_MAX_ENTRIES", 1_000_000)
+)
+# The maximum number of results kept in process memory
+ENRICHMENT_CACHE_MEMORY_ENTRIES = int(
+    os.environ.get("ENRICHMENT_CACHE_MEMORY_ENTRIES", 10_000)
+)
+# The number of documents of a file dump enriched at the same time, the chat completions they send
+# are bounded by CHAT_COMPLETIONS_MAX_CONCURRENCY
+ENRICHMENT_BATCH_SIZE = int(os.environ.get("ENRICHMENT_BATCH_SIZE", 64))
+
+PII_TASK = "pii"
+METADATA_TASK = "metadata"
+
+# The result of enriching a document: its metadata, None if PII was detected in it, or the error
+# that made it fail
+EnrichmentResult = Union[DocumentMetadata, None, BaseException]
+
+
+class EnrichmentCache:
+    """
+    A content-addressed cache of enrichment results, keyed by a hash of the task, the model and the
+    text sent to it, so re-ingesting a dump only pays for the documents that changed.
+
+    Like the embedding cache, lookups go to an in-process LRU tier first and then to a SQLite file,
+    and both tiers evict the least recently used results. Results are stored as JSON.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = ENRICHMENT_CACHE_PATH,
+        max_entries: int = ENRICHMENT_CACHE_MAX_ENTRIES,
+        memory_entries: int = ENRICHMENT_CACHE_MEMORY_ENTRIES,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self._memory = LRUCache(memory_entries)
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_entries = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, result TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+            )
+            self._db.commit()
+            self._db_entries = self._db.execute(
+                "SELECT COUNT(*) FROM results"
+            ).fetchone()[0]
+
+    @staticmethod
+    def key(task: str, model: str, text: str) -> str:
+        return hashlib.sha256(f"{task}\0{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_entries": len(self._memory),
+            "disk_entries": self._db_entries,
+        }
+
+    async def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """Return the cached results of the keys that have one."""
+        found: Dict[str, Any] = {}
+        missing = []
+        for key in keys:
+            # results are wrapped in a tuple, so a cached None is told apart from a miss
+            entry = self._memory.get(key)
+            if entry is None:
+                missing.append(key)
+            else:
+                found[key] = entry[0]
+
+        if missing and self._db is not None:
+            for key, result in (await asyncio.to_thread(self._db_get, missing)).items():
+                found[key] = result
+                self._memory.put(key, (result,))
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    async def put_many(self, results: Dict[str, Any]):
+        """Store results by key in both tiers."""
+        for key, result in results.items():
+            self._memory.put(key, (result,))
+        if results and self._db is not None:
+            await asyncio.to_thread(self._db_put, results)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _db_get(self, keys: List[str]) -> Dict[str, Any]:
+        found: Dict[str, Any] = {}
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(keys), SQLITE_BATCH_SIZE):
+                batch = keys[i : i + SQLITE_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._db.execute(  # type: ignore
+                    f"SELECT key, result FROM results WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for key, result in rows:
+                    found[key] = json.loads(result)
+                # Mark the hits as recently used, so they are the last to be evicted
+                self._db.execute(  # type: ignore
+                    f"UPDATE results SET last_used = ? WHERE key IN ({placeholders})",
+                    [now, *batch],
+                )
+            self._db.commit()  # type: ignore
+        return found
+
+    def _db_put(self, results: Dict[str, Any]):
+        now = time.time()
+        with self._lock:
+            before = self._db.total_changes  # type: ignore
+            self._db.executemany(  # type: ignore
+                "INSERT OR IGNORE INTO results (key, result, last_used) VALUES (?, ?, ?)",
+                [(key, json.dumps(result), now) for key, result in results.items()],
+            )
+            self._db_entries += self._db.total_changes - before  # type: ignore
+
+            # Evict the least recently used results once the file grows past its bound
+            excess = self._db_entries - self.max_entries
+            if excess > 0:
+                self._db.execute(  # type: ignore
+                    "DELETE FROM results WHERE key IN "
+                    "(SELECT key FROM results ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+                self._db_entries -= excess
+            self._db.commit()  # type: ignore
+
+
+_enrichment_cache: Optional[EnrichmentCache] = None
+
+
+def get_enrichment_cache() -> EnrichmentCache:
+    """Return the enrichment cache shared by the process."""
+    global _enrichment_cache
+    if _enrichment_cache is None:
+        _enrichment_cache = EnrichmentCache()
+    return _enrichment_cache
+
+
+class DocumentEnricher:
+    """
+    Screens documents for PII and extracts their metadata with a language model, as an async stage
+    of an ingest.
+
+    The documents of a batch are enriched concurrently: the chat completions they need are sent at
+    once and throttled by the shared chat completions rate limiter. Results are cached by content
+    hash, and documents with the same text in a batch share a single request.
+    """
+
+    def __init__(
+        self,
+        screen_for_pii: bool,
+        extract_metadata: bool,
+        cache: Optional[EnrichmentCache] = None,
+        screen_text: Callable[[str], Awaitable[bool]] = screen_text_for_pii_async,
+        extract: Callable[[str], Awaitable[Dict[str, str]]] = extract_metadata_from_document_async,
+    ):
+        """
+        Args:
+            screen_for_pii: Whether to skip the documents the model finds PII in.
+            extract_metadata: Whether to replace the metadata of the documents with the metadata
+                the model extracts from them.
+            cache: The cache of results, the cache shared by the process by default.
+        """
+        self.screen_for_pii = screen_for_pii
+        self.extract_metadata = extract_metadata
+        self._cache = cache
+        self.screen_text = screen_text
+        self.extract = extract
+
+    @property
+    def enabled(self) -> bool:
+        return self.screen_for_pii or self.extract_metadata
+
+    @property
+    def cache(self) -> EnrichmentCache:
+        # the shared cache is only opened once it is used, so ingests without enrichment don't create its file
+        if self._cache is None:
+            self._cache = get_enrichment_cache()
+        return self._cache
+
+    async def enrich_many(
+        self, documents: List[Tuple[str, DocumentMetadata]]
+    ) -> List[EnrichmentResult]:
+        """
+        Enrich documents given as (text, metadata) tuples.
+
+        Returns:
+            A list aligned with documents, holding for each document its metadata, None if PII was
+            detected in it, or the exception raised while enriching it.
+        """
+        results: List[EnrichmentResult] = [metadata for _, metadata in documents]
+
+        if self.screen_for_pii:
+            screened = await self._run(
+                PII_TASK,
+                PII_DETECTION_MODEL,
+                [text for text, _ in documents],
+                self.screen_text,
+            )
+            for i, pii_detected in enumerate(screened):
+                if isinstance(pii_detected, BaseException):
+                    results[i] = pii_detected
+                elif pii_detected:
+                    results[i] = None
+
+        if self.extract_metadata:
+            # metadata is only extracted from the documents that passed the screening
+            pending = [
+                i for i, result in enumerate(results) if isinstance(result, DocumentMetadata)
+            ]
+            extracted = await self._run(
+                METADATA_TASK,
+                METADATA_EXTRACTION_MODEL,
+                [f"Text: {documents[i][0]}; Metadata: {str(results[i])}" for i in pending],
+                self.extract,
+            )
+            for i, extracted_metadata in zip(pending, extracted):
+                if isinstance(extracted_metadata, BaseException):
+                    results[i] = extracted_metadata
+                    continue
+                try:
+                    # get a Metadata object from the extracted metadata
+                    results[i] = DocumentMetadata(**extracted_metadata)
+                except Exception as e:
+                    results[i] = e
+
+        return results
+
+    async def _run(
+        self,
+        task: str,
+        model: str,
+        texts: List[str],
+        compute: Callable[[str], Awaitable[Any]],
+    ) -> List[Any]:
+        """Return the result of a task for each text, from the cache or computed concurrently."""
+        keys = [EnrichmentCache.key(task, model, text) for text in texts]
+        results = await self.cache.get_many(keys)
+
+        # texts that appear more than once are only sent once
+        to_compute = {key: text for key, text in zip(keys, texts) if key not in results}
+        if to_compute:
+            computed = await asyncio.gather(
+                *(compute(text) for text in to_compute.values()),
+                return_exceptions=True,
+            )
+            # errors are returned to the caller and not cached, so they are retried on the next run
+            succeeded = {
+                key: result
+                for key, result in zip(to_compute, computed)
+                if not isinstance(result, BaseException)
+            }
+            await self.cache.put_many(succeeded)
+            results.update(zip(to_compute, computed))
+
+        return [results[key] for key in keys]
@@ -1,14 +1,17 @@
 from models.models import Source
-from services.openai import get_chat_completion
+from services.openai import get_chat_completion, get_chat_completion_async
 import json
-from typing import Dict
+from typing import Dict, List
 
+# The model used to extract metadata from documents
+METADATA_EXTRACTION_MODEL = "gpt-4"  # TODO: change to your preferred model name
 
-def extract_metadata_from_document(text: str) -> Dict[str, str]:
+
+def get_metadata_messages(text: str) -> List[Dict[str, str]]:
     sources = Source.__members__.keys()
     sources_string = ", ".join(sources)
     # This prompt is just an example, change it to fit your use case
-    messages = [
+    return [
         {
             "role": "system",
             "content": f"""
@@ -24,15 +27,29 @@ def extract_metadata_from_document(text: str) -> Dict[str, str]:
         {"role": "user", "content": text},
     ]
 
-    completion = get_chat_completion(
-        messages, "gpt-4"
-    )  # TODO: change to your preferred model name
-
-    print(f"completion: {completion}")
 
+def parse_metadata_completion(completion: str) -> Dict[str, str]:
     try:
         metadata = json.loads(completion)
     except:
         metadata = {}
 
     return metadata
+
+
+def extract_metadata_from_document(text: str) -> Dict[str, str]:
+    completion = get_chat_completion(
+        get_metadata_messages(text), METADATA_EXTRACTION_MODEL
+    )
+
+    print(f"completion: {completion}")
+
+    return parse_metadata_completion(completion)
+
+
+async def extract_metadata_from_document_async(text: str) -> Dict[str, str]:
+    """Like extract_metadata_from_document, without blocking the event loop while the model answers."""
+    completion = await get_chat_completion_async(
+        get_metadata_messages(text), METADATA_EXTRACTION_MODEL
+    )
+    return parse_metadata_completion(completion)
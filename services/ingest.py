@@ -0,0 +1,236 @@
+import asyncio
+import codecs
+import io
+import itertools
+import os
+import uuid
+import zipfile
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from datastore.datastore import DataStore
+from models.models import Document, DocumentMetadata, Source
+from services.enrichment import ENRICHMENT_BATCH_SIZE, DocumentEnricher
+from services.file import extract_text_from_file
+from services.jobs import JobProgress
+from services.manifest import IndexManifest, get_document_id, git_blob_sha
+from services.pipeline import IngestPipeline
+
+# How often the manifest is saved while an archive is indexed, in documents
+MANIFEST_SAVE_INTERVAL_DOCUMENTS = 50
+# How much of a file is inspected to decide whether it is binary, the same amount git looks at
+BINARY_SNIFF_BYTES = 8000
+
+
+def is_binary(sample: bytes) -> bool:
+    """Guess whether a file is binary from the first bytes of its content."""
+    if b"\0" in sample:
+        return True
+    try:
+        # The sample can end in the middle of a multi-byte character, so decode it incrementally
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+def iter_zip_documents(
+    zip_file: zipfile.ZipFile,
+    custom_metadata: dict,
+    skipped_files: List[str],
+    repo_url: Optional[str] = None,
+    manifest: Optional[IndexManifest] = None,
+    seen_paths: Optional[List[str]] = None,
+) -> Iterator[Tuple[Document, str, str]]:
+    """
+    Lazily read the files of a zip archive as documents, one member at a time and without
+    extracting the archive to disk. Binary files are skipped by sniffing their first bytes.
+
+    When a repo_url is given, the archive is treated as a GitHub archive: paths are relative to its
+    top-level directory, and documents get ids derived from the repo and path. When a manifest is
+    given, files whose content is unchanged since they were last indexed are skipped.
+
+    The documents are not screened for PII nor enriched here, process_file_dump does it
+    concurrently for a window of documents at a time.
+
+    Yields:
+        Tuples of (document, path, sha), where path is the path of the file in the archive (or repo)
+        and sha is the git blob SHA of its content.
+    """
+    for info in zip_file.infolist():
+        if info.is_dir():
+            continue
+
+        filename = os.path.basename(info.filename)
+        # the path of the file in the repo, without the "<repo>-<branch>" directory of the archive
+        path = info.filename.split("/", 1)[-1] if repo_url else info.filename
+
+        try:
+            with zip_file.open(info) as member:
+                sample = member.read(BINARY_SNIFF_BYTES)
+                if is_binary(sample):
+                    continue
+                content = sample + member.read()
+
+            # binary files are left out, so a file that became binary has its old document deleted
+            if seen_paths is not None:
+                seen_paths.append(path)
+
+            # skip files whose content is unchanged since the last time they were indexed
+            sha = git_blob_sha(content)
+            if manifest is not None and manifest.is_unchanged(path, sha):
+                continue
+
+            extracted_text = extract_text_from_file(io.BytesIO(content), None)
+
+            # create a metadata object with the source and source_id fields
+            metadata = DocumentMetadata(
+                source=Source.file,
+                source_id=filename,
+            )
+
+            # update metadata with custom values
+            for key, value in custom_metadata.items():
+                if hasattr(metadata, key):
+                    setattr(metadata, key, value)
+
+            # create a document object with an id derived from the repo and path, or a random id, text and metadata
+            document = Document(
+                id=get_document_id(repo_url, path) if repo_url else str(uuid.uuid4()),
+                text=extracted_text,
+                metadata=metadata,
+            )
+            yield document, path, sha
+        except Exception as e:
+            # log the error and continue with the next file
+            print(f"Error processing {info.filename}: {e}")
+            skipped_files.append(info.filename)  # add the skipped file to the list
+
+
+async def process_file_dump(
+    filepath: str,
+    datastore: DataStore,
+    custom_metadata: dict,
+    screen_for_pii: bool,
+    extract_metadata: bool,
+    repo_url: Optional[str] = None,
+    manifest: Optional[IndexManifest] = None,
+    progress: Optional[JobProgress] = None,
+):
+    """
+    Index the files of a zip archive, streaming them from the archive through the ingest pipeline so
+    memory use doesn't grow with the size of the archive.
+    """
+    skipped_files: List[str] = []
+    seen_paths: List[str] = []
+    # the path and sha of the documents that are in the pipeline, by document id
+    in_flight: Dict[str, Tuple[str, str]] = {}
+    num_documents = 0
+    num_done = 0
+
+    enricher = DocumentEnricher(screen_for_pii, extract_metadata)
+
+    def track(document: Document, path: str, sha: str) -> Document:
+        nonlocal num_documents
+        in_flight[document.id] = (path, sha)  # type: ignore
+        num_documents += 1
+        return document
+
+    def iter_documents(zip_file: zipfile.ZipFile) -> Iterator[Document]:
+        for document, path, sha in iter_zip_documents(
+            zip_file,
+            custom_metadata,
+            skipped_files,
+            repo_url=repo_url,
+            manifest=manifest,
+            seen_paths=seen_paths,
+        ):
+            yield track(document, path, sha)
+
+    async def iter_enriched_documents(zip_file: zipfile.ZipFile) -> AsyncIterator[Document]:
+        documents = iter_zip_documents(
+            zip_file,
+            custom_metadata,
+            skipped_files,
+            repo_url=repo_url,
+            manifest=manifest,
+            seen_paths=seen_paths,
+        )
+        while True:
+            # reading the files blocks, so the next window of documents is read in a thread
+            batch = await asyncio.to_thread(
+                list, itertools.islice(documents, ENRICHMENT_BATCH_SIZE)
+            )
+            if not batch:
+                return
+            # screen the documents for pii and extract their metadata concurrently
+            results = await enricher.enrich_many(
+                [(document.text, document.metadata) for document, _, _ in batch]  # type: ignore
+            )
+            # the vectors of an earlier version of a file that now has pii are deleted before the
+            # file is recorded as skipped, or nothing would delete them later
+            pii_files = [
+                (path, sha)
+                for (_, path, sha), result in zip(batch, results)
+                if result is None
+            ]
+            if manifest is not None and pii_files:
+                indexed_ids = [
+                    manifest.entries[path]["document_id"]
+                    for path, _ in pii_files
+                    if manifest.entries.get(path, {}).get("document_id") is not None
+                ]
+                if indexed_ids:
+                    await datastore.delete(ids=indexed_ids)
+                for path, sha in pii_files:
+                    manifest.record(path, sha, None)
+
+            for (document, path, sha), result in zip(batch, results):
+                if result is None:
+                    # if pii detected, print a warning and skip the document
+                    print("PII detected in document, skipping")
+                    skipped_files.append(path)  # add the skipped file to the list
+                elif isinstance(result, BaseException):
+                    # log the error and continue with the next file
+                    print(f"Error processing {path}: {result}")
+                    skipped_files.append(path)  # add the skipped file to the list
+                else:
+                    document.metadata = result
+                    yield track(document, path, sha)
+
+    def on_document_done(document: Document):
+        nonlocal num_done
+        path, sha = in_flight.pop(document.id)  # type: ignore
+        num_done += 1
+        if progress is not None:
+            progress.record_files(1)
+        # record the files in the manifest only once their vectors are written
+        if manifest is not None:
+            manifest.record(path, sha, document.id)
+            if num_done % MANIFEST_SAVE_INTERVAL_DOCUMENTS == 0:
+                print(f"Upserted {num_done} documents so far")
+                manifest.save()
+
+    with zipfile.ZipFile(filepath) as zip_file:
+        pipeline = IngestPipeline(
+            datastore, progress=progress, on_document_done=on_document_done
+        )
+        if enricher.enabled:
+            await pipeline.run(iter_enriched_documents(zip_file))
+        else:
+            await pipeline.run(iter_documents(zip_file))
+
+    # delete the vectors of files that were removed since the last time the archive was indexed
+    if manifest is not None:
+        removed_paths, removed_document_ids = manifest.remove_missing(seen_paths)
+        if removed_document_ids:
+            print(f"Deleting {len(removed_document_ids)} documents of removed files")
+            await datastore.delete(ids=removed_document_ids)
+        print(f"Removed {len(removed_paths)} files from the manifest")
+        manifest.save()
+
+    print(f"Upserted {num_documents} documents")
+
+    # print the skipped files
+    print(f"Skipped {len(skipped_files)} files due to errors or PII detection")
+    for file in skipped_files:
+        print(file)
@@ -0,0 +1,258 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from models.api import JobStatus
+
+# The SQLite file that persists jobs, so queued and interrupted jobs survive a restart
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", ".jobs.sqlite3")
+# The number of jobs that run at the same time
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+# How often the progress of a running job is written to the job store
+PROGRESS_SAVE_INTERVAL_SECONDS = 2
+
+
+class JobProgress:
+    """
+    Counters for the progress of a running job, with the throughput derived from them.
+    """
+
+    def __init__(self, on_update: Optional[Callable[["JobProgress"], None]] = None):
+        self.files_processed = 0
+        self.chunks_embedded = 0
+        self.vectors_written = 0
+        # the metrics of each stage of the ingest pipeline, by stage name
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.started_at = time.time()
+        self._on_update = on_update
+        self._last_saved = 0.0
+
+    def record_files(self, count: int):
+        self.files_processed += count
+        self._updated()
+
+    def record_chunks(self, count: int):
+        self.chunks_embedded += count
+        self._updated()
+
+    def record_vectors(self, count: int):
+        self.vectors_written += count
+        self._updated()
+
+    def record_stages(self, stages: Dict[str, Dict[str, float]]):
+        self.stages = stages
+        self._updated()
+
+    def _updated(self):
+        now = time.monotonic()
+        if self._on_update and now - self._last_saved >= PROGRESS_SAVE_INTERVAL_SECONDS:
+            self._last_saved = now
+            self._on_update(self)
+
+    def snapshot(self) -> Dict[str, Any]:
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        return {
+            "files_processed": self.files_processed,
+            "chunks_embedded": self.chunks_embedded,
+            "vectors_written": self.vectors_written,
+            "elapsed_seconds": elapsed,
+            "files_per_second": self.files_processed / elapsed,
+            "chunks_per_second": self.chunks_embedded / elapsed,
+            "vectors_per_second": self.vectors_written / elapsed,
+            "stages": self.stages,
+        }
+
+
+class JobStore:
+    """
+    A table of jobs in a local SQLite file, holding each job's payload, status and progress.
+    """
+
+    def __init__(self, path: str = JOBS_DB_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, payload TEXT NOT NULL, status TEXT NOT NULL, "
+            "progress TEXT, error TEXT, created_at REAL NOT NULL, finished_at REAL)"
+        )
+        self._db.commit()
+
+    def create(self, payload: Dict[str, Any]) -> str:
+        job_id = str(uuid.uuid4())
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, payload, status, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, json.dumps(payload), JobStatus.queued.value, time.time()),
+            )
+            self._db.commit()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["progress"] = json.loads(job["progress"]) if job["progress"] else {}
+        return job
+
+    def update(self, job_id: str, **fields):
+        if "status" in fields:
+            fields["status"] = fields["status"].value
+        if "progress" in fields:
+            fields["progress"] = json.dumps(fields["progress"])
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        with self._lock:
+            self._db.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ?", [*fields.values(), job_id]
+            )
+            self._db.commit()
+
+    def unfinished(self) -> List[str]:
+        """Return the ids of the jobs that are queued or were running when the process stopped."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created_at",
+                (JobStatus.queued.value, JobStatus.running.value),
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+
+class JobQueue:
+    """
+    Runs jobs in the background on a bounded pool of asyncio workers.
+
+    Submitted jobs are persisted in a JobStore before they are queued, and jobs that were queued
+    or running when the process stopped are queued again on start, so they run to completion.
+    The handler gets the job's payload and a JobProgress to report its progress to. The calls to
+    the store run in a thread, so its writes don't block the event loop.
+
+    Jobs with the same key, such as two jobs indexing the same repo, run one at a time in the order
+    they were submitted, so they don't write to the same index and files at once. A job whose key
+    is busy is set aside instead of holding a worker, and runs once the jobs before it are done.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Dict[str, Any], JobProgress], Awaitable[None]],
+        store: Optional[JobStore] = None,
+        num_workers: int = JOB_WORKERS,
+        key: Optional[Callable[[Dict[str, Any]], str]] = None,
+    ):
+        """
+        Args:
+            key: Returns the key of a job from its payload, jobs with the same key don't overlap.
+                Every job can run at the same time as the others by default.
+        """
+        self.handler = handler
+        self.store = store or JobStore()
+        self.num_workers = num_workers
+        self.key = key
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        # the jobs set aside for each key with a running job, in the order they were submitted
+        self._deferred: Dict[str, Deque[Tuple[str, Dict[str, Any]]]] = {}
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        for job_id in await asyncio.to_thread(self.store.unfinished):
+            print(f"Resuming job {job_id}")
+            self._queue.put_nowait(job_id)
+        self._workers = [
+            asyncio.create_task(self._work()) for _ in range(self.num_workers)
+        ]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, payload: Dict[str, Any]) -> str:
+        """Persist and queue a job, and return its id."""
+        assert self._queue is not None, "The job queue is not started"
+        job_id = await asyncio.to_thread(self.store.create, payload)
+        self._queue.put_nowait(job_id)
+        return job_id
+
+    async def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self.store.get, job_id)
+
+    async def _work(self):
+        assert self._queue is not None
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str):
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is None:
+            return
+        if self.key is None:
+            await self._run_job(job_id, job)
+            return
+
+        key = self.key(job["payload"])
+        deferred = self._deferred.get(key)
+        if deferred is not None:
+            # an earlier job with the same key is running, the worker that runs it runs this one next
+            deferred.append((job_id, job))
+            return
+
+        deferred = self._deferred[key] = deque()
+        try:
+            await self._run_job(job_id, job)
+            while deferred:
+                await self._run_job(*deferred.popleft())
+        finally:
+            # jobs left over by a cancelled worker are still queued in the store, and resumed on start
+            del self._deferred[key]
+
+    async def _run_job(self, job_id: str, job: Dict[str, Any]):
+        # the progress is saved in the background, one save at a time, and the updates made while
+        # one is being written are in the snapshot of the next one
+        saving: Optional[asyncio.Future] = None
+
+        def save_progress(progress: JobProgress):
+            nonlocal saving
+            if saving is None or saving.done():
+                saving = asyncio.ensure_future(
+                    asyncio.to_thread(self.store.update, job_id, progress=progress.snapshot())
+                )
+
+        progress = JobProgress(on_update=save_progress)
+
+        async def finish(**fields):
+            # the last progress save must not land after the final snapshot
+            if saving is not None:
+                await asyncio.gather(saving, return_exceptions=True)
+            await asyncio.to_thread(
+                self.store.update,
+                job_id,
+                progress=progress.snapshot(),
+                finished_at=time.time(),
+                **fields,
+            )
+
+        await asyncio.to_thread(
+            self.store.update, job_id, status=JobStatus.running, progress=progress.snapshot()
+        )
+        try:
+            await self.handler(job["payload"], progress)
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            await finish(status=JobStatus.failed, error=str(e))
+            return
+        await finish(status=JobStatus.completed)
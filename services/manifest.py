@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+# The directory holding one manifest file per index
+MANIFEST_DIR = os.environ.get("MANIFEST_DIR", "manifests")
+
+
+def git_blob_sha(content: bytes) -> str:
+    """Return the git blob SHA of a file's content, the same hash git uses to identify it."""
+    header = f"blob {len(content)}\0".encode("utf-8")
+    return hashlib.sha1(header + content).hexdigest()
+
+
+def get_document_id(repo_url: str, path: str) -> str:
+    """
+    Return a deterministic document id for a file in a repo, so re-indexing a file replaces its
+    vectors instead of adding a second copy.
+    """
+    repo_url = repo_url.rstrip("/")
+    if repo_url.endswith(".git"):
+        repo_url = repo_url[:-4]
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{repo_url}/{path}"))
+
+
+class IndexManifest:
+    """
+    The files indexed into an index, as a mapping of path to the git blob SHA of the indexed
+    content and the id of the document created from it (None if the file was skipped).
+    """
+
+    def __init__(self, index_name: str, entries: Optional[Dict[str, Dict]] = None):
+        self.index_name = index_name
+        self.entries: Dict[str, Dict] = entries or {}
+
+    @staticmethod
+    def _path(index_name: str) -> str:
+        return os.path.join(MANIFEST_DIR, f"{index_name}.json")
+
+    @classmethod
+    def exists(cls, index_name: str) -> bool:
+        return os.path.exists(cls._path(index_name))
+
+    @classmethod
+    def load(cls, index_name: str) -> "IndexManifest":
+        """Load the manifest of an index, or an empty one if the index was never indexed."""
+        try:
+            with open(cls._path(index_name)) as manifest_file:
+                return cls(index_name, json.load(manifest_file))
+        except FileNotFoundError:
+            return cls(index_name)
+
+    def save(self):
+        """Write the manifest atomically, so an interrupted write keeps the previous version."""
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        path = self._path(self.index_name)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(self.entries, manifest_file)
+        os.replace(tmp_path, path)
+
+    def is_unchanged(self, path: str, sha: str) -> bool:
+        entry = self.entries.get(path)
+        return entry is not None and entry["sha"] == sha
+
+    def record(self, path: str, sha: str, document_id: Optional[str]):
+        self.entries[path] = {"sha": sha, "document_id": document_id}
+
+    def remove_missing(self, paths: List[str]) -> Tuple[List[str], List[str]]:
+        """
+        Drop the entries of files that are not in paths anymore.
+
+        Returns:
+            A tuple of (removed_paths, document_ids), where document_ids are the ids of the
+            documents created from the removed files, whose vectors should be deleted.
+        """
+        present = set(paths)
+        removed_paths = [path for path in self.entries if path not in present]
+        document_ids = []
+        for path in removed_paths:
+            document_id = self.entries.pop(path)["document_id"]
+            if document_id is not None:
+                document_ids.append(document_id)
+        return removed_paths, document_ids
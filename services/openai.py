@@ -1,32 +1,325 @@
-from typing import List
-import openai
+import asyncio
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
 
+import aiohttp
+import openai
+from loguru import logger
+from openai.error import (
+    APIConnectionError,
+    APIError,
+    RateLimitError,
+    ServiceUnavailableError,
+    Timeout,
+)
 
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 
+from models.embeddings import EmbeddingBatch
 
-@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
-def get_embeddings(texts: List[str]) -> List[List[float]]:
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# The maximum number of embedding requests in flight at once
+EMBEDDINGS_MAX_CONCURRENCY = int(os.environ.get("EMBEDDINGS_MAX_CONCURRENCY", 8))
+# Optional client-side limits, matching the rate limits of the OpenAI account
+EMBEDDINGS_REQUESTS_PER_MINUTE = int(os.environ.get("EMBEDDINGS_REQUESTS_PER_MINUTE", 0))
+EMBEDDINGS_TOKENS_PER_MINUTE = int(os.environ.get("EMBEDDINGS_TOKENS_PER_MINUTE", 0))
+# How many times a rate limited or failed request is retried before giving up
+EMBEDDINGS_MAX_RETRIES = int(os.environ.get("EMBEDDINGS_MAX_RETRIES", 6))
+# The same limits for the embeddings of queries, which have their own budget and backoff so a bulk
+# ingest saturating the embedding limits doesn't hold up /query
+QUERY_EMBEDDINGS_MAX_CONCURRENCY = int(os.environ.get("QUERY_EMBEDDINGS_MAX_CONCURRENCY", 4))
+QUERY_EMBEDDINGS_REQUESTS_PER_MINUTE = int(
+    os.environ.get("QUERY_EMBEDDINGS_REQUESTS_PER_MINUTE", 0)
+)
+QUERY_EMBEDDINGS_TOKENS_PER_MINUTE = int(
+    os.environ.get("QUERY_EMBEDDINGS_TOKENS_PER_MINUTE", 0)
+)
+
+# The same limits for the chat completions of the enrichment stage, PII screening and metadata extraction
+CHAT_COMPLETIONS_MAX_CONCURRENCY = int(
+    os.environ.get("CHAT_COMPLETIONS_MAX_CONCURRENCY", 8)
+)
+CHAT_COMPLETIONS_REQUESTS_PER_MINUTE = int(
+    os.environ.get("CHAT_COMPLETIONS_REQUESTS_PER_MINUTE", 0)
+)
+CHAT_COMPLETIONS_TOKENS_PER_MINUTE = int(
+    os.environ.get("CHAT_COMPLETIONS_TOKENS_PER_MINUTE", 0)
+)
+CHAT_COMPLETIONS_MAX_RETRIES = int(os.environ.get("CHAT_COMPLETIONS_MAX_RETRIES", 6))
+
+# Errors that are worth retrying after backing off
+RETRYABLE_ERRORS = (
+    RateLimitError,
+    ServiceUnavailableError,
+    APIConnectionError,
+    APIError,
+    Timeout,
+)
+
+MIN_BACKOFF_SECONDS = 1
+MAX_BACKOFF_SECONDS = 60
+
+
+class RateLimiter:
+    """
+    Client-side rate limiter shared by all requests to an OpenAI endpoint.
+
+    Requests wait for a free concurrency slot, for the optional requests and tokens per minute
+    budgets, and for any cooldown set after a rate limit error. The cooldown doubles on every
+    consecutive rate limit error (or follows the Retry-After header) and decays on success, so
+    concurrent requests back off together instead of each retrying blindly.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        requests_per_minute: int = 0,
+        tokens_per_minute: int = 0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._request_budget = float(requests_per_minute)
+        self._token_budget = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._backoff = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self._last_refill) / 60
+        self._last_refill = now
+        if self.requests_per_minute:
+            self._request_budget = min(
+                self.requests_per_minute,
+                self._request_budget + elapsed_minutes * self.requests_per_minute,
+            )
+        if self.tokens_per_minute:
+            self._token_budget = min(
+                self.tokens_per_minute,
+                self._token_budget + elapsed_minutes * self.tokens_per_minute,
+            )
+
+    def _seconds_until_ready(self, num_tokens: int) -> float:
+        self._refill()
+        wait = max(0.0, self._blocked_until - time.monotonic())
+        if self.requests_per_minute and self._request_budget < 1:
+            wait = max(
+                wait, (1 - self._request_budget) * 60 / self.requests_per_minute
+            )
+        if self.tokens_per_minute:
+            # A single request larger than the whole budget would never fit, so cap it
+            num_tokens = min(num_tokens, self.tokens_per_minute)
+            if self._token_budget < num_tokens:
+                wait = max(
+                    wait,
+                    (num_tokens - self._token_budget) * 60 / self.tokens_per_minute,
+                )
+        return wait
+
+    @asynccontextmanager
+    async def slot(self, num_tokens: int = 0) -> AsyncIterator[None]:
+        """Wait until a request of num_tokens tokens may be sent, and hold a concurrency slot while it runs."""
+        async with self._semaphore:
+            while True:
+                wait = self._seconds_until_ready(num_tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.requests_per_minute:
+                self._request_budget -= 1
+            if self.tokens_per_minute:
+                self._token_budget -= min(num_tokens, self.tokens_per_minute)
+            yield
+
+    def record_success(self):
+        self._backoff /= 2
+        if self._backoff < MIN_BACKOFF_SECONDS:
+            self._backoff = 0.0
+
+    def record_failure(self, error: Exception):
+        """Back off every request sharing this limiter after a failed request."""
+        if isinstance(error, RateLimitError):
+            self._backoff = min(
+                MAX_BACKOFF_SECONDS, max(MIN_BACKOFF_SECONDS, self._backoff * 2)
+            )
+        else:
+            self._backoff = max(self._backoff, MIN_BACKOFF_SECONDS)
+
+        delay = self._backoff * (1 + random.random()) / 2
+        retry_after = _get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+
+
+def _get_retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _estimate_tokens(texts: List[str]) -> int:
+    # A rough estimate for the tokens per minute budget, ~4 characters per token for English text
+    return sum(len(text) for text in texts) // 4 + len(texts)
+
+
+# The rate limiters of the running event loop by endpoint, and the loop they were created on
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_loop: Optional[asyncio.AbstractEventLoop] = None
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _get_rate_limiter(
+    name: str, max_concurrency: int, requests_per_minute: int, tokens_per_minute: int
+) -> RateLimiter:
+    """Return the rate limiter shared by the requests of an endpoint on the running event loop."""
+    global _rate_limiters_loop
+    loop = asyncio.get_running_loop()
+    if _rate_limiters_loop is not loop:
+        _rate_limiters.clear()
+        _rate_limiters_loop = loop
+    if name not in _rate_limiters:
+        _rate_limiters[name] = RateLimiter(
+            max_concurrency,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+        )
+    return _rate_limiters[name]
+
+
+def get_embeddings_rate_limiter() -> RateLimiter:
+    """Return the rate limiter shared by all embedding requests of ingestion on the running event loop."""
+    return _get_rate_limiter(
+        "embeddings",
+        EMBEDDINGS_MAX_CONCURRENCY,
+        EMBEDDINGS_REQUESTS_PER_MINUTE,
+        EMBEDDINGS_TOKENS_PER_MINUTE,
+    )
+
+
+def get_query_embeddings_rate_limiter() -> RateLimiter:
+    """Return the rate limiter shared by all query embedding requests on the running event loop."""
+    return _get_rate_limiter(
+        "query_embeddings",
+        QUERY_EMBEDDINGS_MAX_CONCURRENCY,
+        QUERY_EMBEDDINGS_REQUESTS_PER_MINUTE,
+        QUERY_EMBEDDINGS_TOKENS_PER_MINUTE,
+    )
+
+
+def get_chat_completions_rate_limiter() -> RateLimiter:
+    """Return the rate limiter shared by all chat completion requests on the running event loop."""
+    return _get_rate_limiter(
+        "chat_completions",
+        CHAT_COMPLETIONS_MAX_CONCURRENCY,
+        CHAT_COMPLETIONS_REQUESTS_PER_MINUTE,
+        CHAT_COMPLETIONS_TOKENS_PER_MINUTE,
+    )
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """
+    Return the HTTP session shared by all OpenAI requests on the running event loop, so
+    connections to the API are pooled and reused instead of opened per request. The code that runs
+    the loop closes it with close_session before the loop ends.
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        if _session is not None and not _session.closed:
+            # a session can only be closed on its own loop, if that loop is still running
+            if _session_loop is not None and _session_loop.is_running():
+                asyncio.run_coroutine_threadsafe(_session.close(), _session_loop)
+            else:
+                logger.warning("The OpenAI session of an event loop that ended wasn't closed")
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=(
+                    EMBEDDINGS_MAX_CONCURRENCY
+                    + QUERY_EMBEDDINGS_MAX_CONCURRENCY
+                    + CHAT_COMPLETIONS_MAX_CONCURRENCY
+                )
+                * 2
+            )
+        )
+        _session_loop = loop
+    return _session
+
+
+async def close_session():
+    """Close the shared HTTP session, if one was opened."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def get_embeddings(texts: List[str]) -> EmbeddingBatch:
     """
     Embed texts using OpenAI's ada model.
 
+    Requests run concurrently up to EMBEDDINGS_MAX_CONCURRENCY over a pooled connection, and are
+    retried with a shared, adaptive backoff when the API rate limits or fails transiently.
+
     Args:
         texts: The list of texts to embed.
 
     Returns:
-        A list of embeddings, each of which is a list of floats.
+        The embeddings of the texts, as the rows of a float32 EmbeddingBatch.
 
     Raises:
-        Exception: If the OpenAI API call fails.
+        Exception: If the OpenAI API call fails after EMBEDDINGS_MAX_RETRIES retries.
+    """
+    return await _create_embeddings(texts, get_embeddings_rate_limiter())
+
+
+async def get_query_embeddings(texts: List[str]) -> EmbeddingBatch:
+    """
+    Embed query texts like get_embeddings, within the query limits of
+    QUERY_EMBEDDINGS_MAX_CONCURRENCY instead of the ingestion ones, so queries don't wait behind
+    the requests and the backoff of an ingest.
     """
-    # Call the OpenAI API to get the embeddings
-    response = openai.Embedding.create(input=texts, model="text-embedding-ada-002")
+    return await _create_embeddings(texts, get_query_embeddings_rate_limiter())
+
+
+async def _create_embeddings(texts: List[str], rate_limiter: RateLimiter) -> EmbeddingBatch:
+    num_tokens = _estimate_tokens(texts)
+
+    attempt = 0
+    while True:
+        async with rate_limiter.slot(num_tokens):
+            try:
+                # Send the request over the shared session
+                openai.aiosession.set(await get_session())
+                # Call the OpenAI API to get the embeddings
+                response = await openai.Embedding.acreate(
+                    input=texts, model=EMBEDDING_MODEL
+                )
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                if attempt > EMBEDDINGS_MAX_RETRIES:
+                    raise e
+                logger.warning(f"Embedding request failed, retrying (attempt {attempt}): {e}")
+                rate_limiter.record_failure(e)
+                continue
+
+        rate_limiter.record_success()
+        break
 
     # Extract the embedding data from the response
     data = response["data"]  # type: ignore
 
-    # Return the embeddings as a list of lists of floats
-    return [result["embedding"] for result in data]
+    # Return the embeddings as one float32 matrix, converted from the parsed JSON in a single pass
+    return EmbeddingBatch.from_lists([result["embedding"] for result in data])
 
 
 @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
@@ -57,3 +350,52 @@ def get_chat_completion(
     completion = choices[0].message.content.strip()
     print(f"Completion: {completion}")
     return completion
+
+
+async def get_chat_completion_async(
+    messages,
+    model="gpt-3.5-turbo",
+) -> str:
+    """
+    Generate a chat completion without blocking the event loop, so many can run at once.
+
+    Requests run concurrently up to CHAT_COMPLETIONS_MAX_CONCURRENCY over the pooled connection, and
+    are retried with a shared, adaptive backoff when the API rate limits or fails transiently.
+
+    Args:
+        messages: The list of messages in the chat history.
+        model: The name of the model to use for the completion.
+
+    Returns:
+        A string containing the chat completion.
+
+    Raises:
+        Exception: If the OpenAI API call fails after CHAT_COMPLETIONS_MAX_RETRIES retries.
+    """
+    rate_limiter = get_chat_completions_rate_limiter()
+    num_tokens = _estimate_tokens([message["content"] for message in messages])
+
+    attempt = 0
+    while True:
+        async with rate_limiter.slot(num_tokens):
+            try:
+                openai.aiosession.set(await get_session())
+                response = await openai.ChatCompletion.acreate(
+                    model=model,
+                    messages=messages,
+                )
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                if attempt > CHAT_COMPLETIONS_MAX_RETRIES:
+                    raise e
+                logger.warning(
+                    f"Chat completion request failed, retrying (attempt {attempt}): {e}"
+                )
+                rate_limiter.record_failure(e)
+                continue
+
+        rate_limiter.record_success()
+        break
+
+    choices = response["choices"]  # type: ignore
+    return choices[0].message.content.strip()
@@ -1,9 +1,14 @@
-from services.openai import get_chat_completion
+from typing import Dict, List
 
+from services.openai import get_chat_completion, get_chat_completion_async
 
-def screen_text_for_pii(text: str) -> bool:
+# The model used to screen documents for PII
+PII_DETECTION_MODEL = "gpt-3.5-turbo"
+
+
+def get_pii_messages(text: str) -> List[Dict[str, str]]:
     # This prompt is just an example, change it to fit your use case
-    messages = [
+    return [
         {
             "role": "system",
             "content": f"""
@@ -20,11 +25,23 @@ def screen_text_for_pii(text: str) -> bool:
         {"role": "user", "content": text},
     ]
 
+
+def screen_text_for_pii(text: str) -> bool:
     completion = get_chat_completion(
-        messages,
+        get_pii_messages(text),
+        PII_DETECTION_MODEL,
     )
 
     if completion.startswith("True"):
         return True
 
     return False
+
+
+async def screen_text_for_pii_async(text: str) -> bool:
+    """Like screen_text_for_pii, without blocking the event loop while the model answers."""
+    completion = await get_chat_completion_async(
+        get_pii_messages(text),
+        PII_DETECTION_MODEL,
+    )
+    return completion.startswith("True")
@@ -0,0 +1,360 @@
+import asyncio
+import os
+import time
+import uuid
+from concurrent.futures import Executor
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterable,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from models.models import Document, DocumentChunk
+from services.chunks import (
+    CHUNKING_WORKERS,
+    EMBEDDINGS_BATCH_SIZE,
+    chunk_documents,
+    embed_chunks,
+    get_chunking_executor,
+    shard_documents,
+)
+from services.jobs import JobProgress
+
+if TYPE_CHECKING:
+    from datastore.datastore import DataStore
+
+# The number of batches buffered between two stages, which bounds the memory held by the pipeline
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 4))
+# The number of documents chunked at a time, split into shards across the chunking process pool
+PIPELINE_DOCUMENT_BATCH_SIZE = int(os.environ.get("PIPELINE_DOCUMENT_BATCH_SIZE", 16))
+# The number of chunk batches embedded and written to the datastore at the same time
+PIPELINE_EMBED_WORKERS = int(os.environ.get("PIPELINE_EMBED_WORKERS", 4))
+PIPELINE_UPSERT_WORKERS = int(os.environ.get("PIPELINE_UPSERT_WORKERS", 2))
+
+# Marks the end of the input of a stage worker
+_DONE = object()
+
+
+class StageMetrics:
+    """The amount of work done by a pipeline stage and the time spent doing it."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def record(self, items: int, seconds: float):
+        self.batches += 1
+        self.items += items
+        self.busy_seconds += seconds
+
+    def snapshot(self) -> Dict[str, float]:
+        elapsed = 0.0
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "busy_seconds": self.busy_seconds,
+            "elapsed_seconds": elapsed,
+            "items_per_second": self.items / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class IngestPipeline:
+    """
+    Upserts documents through a staged pipeline with bounded queues between the stages:
+
+    - extract: pulls documents from the input, which can be a lazy iterable such as a stream of files
+    - chunk: deletes the existing vectors of the documents and chunks them in a process pool
+    - embed: embeds batches of chunks, several batches at a time
+    - upsert: writes batches of embedded chunks to the datastore, several batches at a time
+
+    The stages run concurrently, so the CPU-bound chunking overlaps with the network-bound embedding
+    and writes, and the throughput is set by the slowest stage instead of the sum of all of them.
+    The bounded queues apply backpressure, so a fast stage can't run ahead of a slow one and fill memory.
+    """
+
+    def __init__(
+        self,
+        datastore: "DataStore",
+        chunk_token_size: Optional[int] = None,
+        progress: Optional[JobProgress] = None,
+        on_document_done: Optional[Callable[[Document], None]] = None,
+        document_batch_size: int = PIPELINE_DOCUMENT_BATCH_SIZE,
+        embed_batch_size: int = EMBEDDINGS_BATCH_SIZE,
+        chunk_workers: Optional[int] = None,
+        embed_workers: int = PIPELINE_EMBED_WORKERS,
+        upsert_workers: int = PIPELINE_UPSERT_WORKERS,
+        queue_size: int = PIPELINE_QUEUE_SIZE,
+        executor: Optional[Executor] = None,
+    ):
+        """
+        Args:
+            datastore: The datastore to write the chunks to.
+            chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+            progress: Records the number of chunks embedded and vectors written, if given.
+            on_document_done: Called with each document once all of its chunks are written.
+            executor: The executor that chunks documents, the shared chunking process pool by default.
+        """
+        self.datastore = datastore
+        self.chunk_token_size = chunk_token_size
+        self.progress = progress
+        self.on_document_done = on_document_done
+        self.document_batch_size = document_batch_size
+        self.embed_batch_size = embed_batch_size
+        self.chunk_workers = chunk_workers or CHUNKING_WORKERS or 1
+        self.embed_workers = embed_workers
+        self.upsert_workers = upsert_workers
+        self.queue_size = queue_size
+        self.executor = executor
+        self.metrics = {
+            name: StageMetrics(name) for name in ("extract", "chunk", "embed", "upsert")
+        }
+
+        # the number of chunks of each document that are not written yet
+        self._pending_chunks: Dict[str, int] = {}
+        self._documents: Dict[str, Document] = {}
+
+    async def run(
+        self, documents: Union[Iterable[Document], AsyncIterable[Document]]
+    ) -> List[str]:
+        """
+        Upsert documents through the pipeline, and return the ids of the documents in input order.
+        If a stage fails, the other stages are cancelled and the error is raised.
+        """
+        chunk_queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        embed_queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        upsert_queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        doc_ids: List[str] = []
+
+        tasks = [
+            asyncio.create_task(self._extract(documents, doc_ids, chunk_queue)),
+            asyncio.create_task(
+                self._stage(
+                    "chunk",
+                    chunk_queue,
+                    embed_queue,
+                    self._chunk,
+                    self.chunk_workers,
+                    self.embed_workers,
+                )
+            ),
+            asyncio.create_task(
+                self._stage(
+                    "embed",
+                    embed_queue,
+                    upsert_queue,
+                    self._embed,
+                    self.embed_workers,
+                    self.upsert_workers,
+                )
+            ),
+            asyncio.create_task(
+                self._stage(
+                    "upsert", upsert_queue, None, self._upsert, self.upsert_workers, 0
+                )
+            ),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            # stop the other stages when one fails or the pipeline is cancelled
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for task in done:
+            task.result()
+
+        self._report_metrics()
+        for name, metrics in self.metrics.items():
+            snapshot = metrics.snapshot()
+            print(
+                f"Pipeline stage {name}: {snapshot['items']} items in {snapshot['batches']} batches, "
+                f"busy {snapshot['busy_seconds']:.2f}s of {snapshot['elapsed_seconds']:.2f}s, "
+                f"{snapshot['items_per_second']:.1f} items/s"
+            )
+        return doc_ids
+
+    def _report_metrics(self):
+        """Record the metrics of the stages to the progress, so the status of a job shows them."""
+        if self.progress is not None:
+            self.progress.record_stages(
+                {name: metrics.snapshot() for name, metrics in self.metrics.items()}
+            )
+
+    async def _extract(
+        self,
+        documents: Union[Iterable[Document], AsyncIterable[Document]],
+        doc_ids: List[str],
+        outbox: asyncio.Queue,
+    ):
+        metrics = self.metrics["extract"]
+        metrics.started_at = time.monotonic()
+        batch: List[Tuple[Document, bool]] = []
+
+        # time spent waiting on the chunk stage is backpressure, not work of this stage, so it isn't
+        # counted as busy time
+        started = time.monotonic()
+        async for document in self._iter_documents(documents):
+            # only documents that came with an id can have vectors in the datastore already
+            had_id = bool(document.id)
+            if not had_id:
+                document = document.copy(update={"id": str(uuid.uuid4())})
+            doc_ids.append(document.id)  # type: ignore
+            batch.append((document, had_id))
+            if len(batch) == self.document_batch_size:
+                metrics.record(len(batch), time.monotonic() - started)
+                await outbox.put(batch)
+                batch = []
+                started = time.monotonic()
+        if batch:
+            metrics.record(len(batch), time.monotonic() - started)
+            await outbox.put(batch)
+
+        for _ in range(self.chunk_workers):
+            await outbox.put(_DONE)
+        metrics.finished_at = time.monotonic()
+
+    @staticmethod
+    async def _iter_documents(
+        documents: Union[Iterable[Document], AsyncIterable[Document]]
+    ):
+        if isinstance(documents, AsyncIterable):
+            async for document in documents:
+                yield document
+        elif isinstance(documents, (list, tuple)):
+            for document in documents:
+                yield document
+        else:
+            # a lazy iterable can do blocking work, like reading and parsing files, to produce a
+            # document, so it is advanced in a thread to keep the event loop free
+            iterator = iter(documents)
+            while True:
+                document = await asyncio.to_thread(next, iterator, _DONE)
+                if document is _DONE:
+                    return
+                yield document
+
+    async def _stage(
+        self,
+        name: str,
+        inbox: asyncio.Queue,
+        outbox: Optional[asyncio.Queue],
+        handle: Callable[[list, Optional[asyncio.Queue]], Awaitable[int]],
+        num_workers: int,
+        num_next_workers: int,
+    ):
+        metrics = self.metrics[name]
+
+        async def worker():
+            while True:
+                batch = await inbox.get()
+                if batch is _DONE:
+                    return
+                if metrics.started_at is None:
+                    metrics.started_at = time.monotonic()
+                started = time.monotonic()
+                items = await handle(batch, outbox)
+                metrics.record(items, time.monotonic() - started)
+                self._report_metrics()
+
+        await asyncio.gather(*[worker() for _ in range(num_workers)])
+        metrics.finished_at = time.monotonic()
+
+        # tell every worker of the next stage that there is no more input
+        if outbox is not None:
+            for _ in range(num_next_workers):
+                await outbox.put(_DONE)
+
+    async def _chunk(
+        self, batch: List[Tuple[Document, bool]], outbox: Optional[asyncio.Queue]
+    ) -> int:
+        assert outbox is not None
+        documents = [document for document, _ in batch]
+        loop = asyncio.get_running_loop()
+
+        # split the batch into shards of about the same amount of text, one task of the process
+        # pool each, so a long document doesn't hold back the chunks of the others
+        results: List[Tuple[List[DocumentChunk], str]] = [([], "")] * len(documents)
+
+        async def chunk_shard(indexes: List[int]):
+            shard_results = await loop.run_in_executor(
+                self.executor or get_chunking_executor(),
+                chunk_documents,
+                [documents[i] for i in indexes],
+                self.chunk_token_size,
+            )
+            for i, result in zip(indexes, shard_results):
+                results[i] = result
+
+        # delete the existing vectors of the documents while they are being chunked, the whole
+        # batch in one call, their new chunks are only passed on once the deletes are done
+        chunking = asyncio.gather(
+            *[
+                chunk_shard(indexes)
+                for indexes in shard_documents(documents, self.chunk_workers)
+            ]
+        )
+        replaced_ids = [document.id for document, had_id in batch if had_id]
+        if replaced_ids:
+            await asyncio.gather(
+                chunking, self.datastore.delete_documents(replaced_ids)  # type: ignore
+            )
+        else:
+            await chunking
+
+        # the chunks are passed on with the id of their document, to group them for the writes
+        chunks: List[Tuple[str, DocumentChunk]] = []
+        for document, (doc_chunks, doc_id) in zip(documents, results):
+            if not doc_chunks:
+                self._document_done(document)
+                continue
+            self._pending_chunks[doc_id] = len(doc_chunks)
+            self._documents[doc_id] = document
+            chunks.extend((doc_id, chunk) for chunk in doc_chunks)
+
+        for i in range(0, len(chunks), self.embed_batch_size):
+            await outbox.put(chunks[i : i + self.embed_batch_size])
+        return len(documents)
+
+    async def _embed(
+        self, chunks: List[Tuple[str, DocumentChunk]], outbox: Optional[asyncio.Queue]
+    ) -> int:
+        assert outbox is not None
+        await embed_chunks([chunk for _, chunk in chunks])
+        if self.progress is not None:
+            self.progress.record_chunks(len(chunks))
+        await outbox.put(chunks)
+        return len(chunks)
+
+    async def _upsert(
+        self, chunks: List[Tuple[str, DocumentChunk]], outbox: Optional[asyncio.Queue]
+    ) -> int:
+        chunks_by_document: Dict[str, List[DocumentChunk]] = {}
+        for doc_id, chunk in chunks:
+            chunks_by_document.setdefault(doc_id, []).append(chunk)
+        await self.datastore._upsert(chunks_by_document)
+        if self.progress is not None:
+            self.progress.record_vectors(len(chunks))
+
+        for doc_id, doc_chunks in chunks_by_document.items():
+            self._pending_chunks[doc_id] -= len(doc_chunks)
+            if self._pending_chunks[doc_id] == 0:
+                del self._pending_chunks[doc_id]
+                self._document_done(self._documents.pop(doc_id))
+        return len(chunks)
+
+    def _document_done(self, document: Document):
+        if self.on_document_done is not None:
+            self.on_document_done(document)
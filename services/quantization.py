@@ -0,0 +1,71 @@
+import os
+from typing import Tuple
+
+import numpy as np
+
+# The precision embeddings are stored at by the datastores: "float32", "float16" for half the bytes,
+# or "int8" for scalar quantized vectors with a quarter of the bytes
+VECTOR_PRECISION = os.environ.get("VECTOR_PRECISION", "float32")
+# The number of best candidates of a quantized search rescored at full precision, 0 to not rescore
+VECTOR_RESCORE = int(os.environ.get("VECTOR_RESCORE", 100))
+
+PRECISIONS = ("float32", "float16", "int8")
+assert VECTOR_PRECISION in PRECISIONS, f"VECTOR_PRECISION must be one of {PRECISIONS}"
+
+# The largest magnitude of an int8 code, the range is kept symmetric around 0
+INT8_MAX = 127
+
+
+def float_dtype(precision: str = VECTOR_PRECISION) -> np.dtype:
+    """
+    Return the float dtype vectors are sent and stored at for a precision. int8 vectors are
+    quantized from float32 ones, so they are sent as float32.
+    """
+    return np.dtype(np.float16 if precision == "float16" else np.float32)
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Quantize the rows of a float matrix to int8 codes with a scale per row, so that
+    codes * scale[:, None] approximates the rows.
+
+    Returns:
+        A tuple of (codes, scales), the int8 codes and the float32 scale of each row.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / INT8_MAX
+    # rows of zeros keep a scale of 1, so they decode to zeros
+    scales = np.where(scales > 0, scales, 1).astype(np.float32)
+    codes = np.clip(np.rint(vectors / scales[:, None]), -INT8_MAX, INT8_MAX)
+    return codes.astype(np.int8), scales
+
+
+def dequantize_int8(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    """Return the float32 rows approximated by int8 codes and their scales."""
+    return codes.astype(np.float32) * scales[:, None]
+
+
+def rescore(
+    candidates: np.ndarray, scores: np.ndarray, exact_scores, k: int, num_rescored: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Keep the num_rescored best candidates by approximate score, replace their scores with the
+    scores returned by exact_scores for them, and return the k best, best first.
+
+    Args:
+        candidates: The candidate rows.
+        scores: The approximate score of each candidate.
+        exact_scores: A function returning the full precision scores of an array of rows.
+        k: The number of results.
+        num_rescored: The number of candidates rescored, at least k of them are.
+    """
+    keep = max(k, num_rescored)
+    if len(candidates) > keep:
+        best = np.argpartition(-scores, keep - 1)[:keep]
+        candidates = candidates[best]
+    # read the rows in file order, which is faster for memory-mapped vectors
+    candidates = np.sort(candidates)
+    scores = np.asarray(exact_scores(candidates), dtype=np.float32)
+    top = np.argsort(-scores, kind="stable")[:k]
+    return candidates[top], scores[top]
+
@@ -0,0 +1,155 @@
+import codecs
+import json
+import os
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+# The number of documents an ingest script upserts at a time, and checkpoints after
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 1000))
+# The number of bytes read from a JSON file at a time when parsing it incrementally
+JSON_READ_SIZE = 1 << 20
+
+
+def iter_jsonl_records(path: str, offset: int = 0) -> Iterator[Tuple[Any, int]]:
+    """
+    Yield the records of a JSONL file one line at a time, starting at a byte offset.
+
+    Returns:
+        An iterator of (record, offset) tuples, where offset is the byte offset right after the
+        record, the offset to resume from once the record is processed.
+    """
+    with open(path, "rb") as file:
+        file.seek(offset)
+        for line in file:
+            offset += len(line)
+            if line.strip():
+                yield json.loads(line), offset
+
+
+def iter_json_records(path: str, offset: int = 0) -> Iterator[Tuple[Any, int]]:
+    """
+    Yield the elements of a JSON file holding an array, parsing it incrementally so only about
+    JSON_READ_SIZE bytes and the current element are held in memory, starting at a byte offset
+    returned with a previous element.
+
+    Returns:
+        An iterator of (element, offset) tuples, where offset is the byte offset right after the element.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    with open(path, "rb") as file:
+        file.seek(offset)
+        buffer = ""
+        # the position of the parser in the buffer, and the position up to which the bytes of the
+        # buffer are counted in offset
+        position = counted = 0
+        at_end_of_file = False
+        # an offset past 0 is right after an element, so the opening bracket was already read
+        in_array = offset > 0
+
+        def count_to(end: int):
+            nonlocal offset, counted
+            offset += len(buffer[counted:end].encode("utf-8"))
+            counted = end
+
+        def read_more() -> bool:
+            nonlocal buffer, position, counted, at_end_of_file
+            if at_end_of_file:
+                return False
+            count_to(position)
+            data = file.read(JSON_READ_SIZE)
+            at_end_of_file = not data
+            # drop the parsed part of the buffer, so it holds the unparsed text only
+            buffer = buffer[position:] + text_decoder.decode(data, final=at_end_of_file)
+            position = counted = 0
+            return True
+
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position == len(buffer):
+                if read_more():
+                    continue
+                raise ValueError(f"{path} ended before its JSON array was closed")
+
+            char = buffer[position]
+            if not in_array:
+                if char != "[":
+                    raise ValueError(f"{path} doesn't hold a JSON array")
+                in_array = True
+                position += 1
+            elif char == ",":
+                position += 1
+            elif char == "]":
+                return
+            else:
+                try:
+                    element, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError as e:
+                    # the element may continue past the end of the buffer, otherwise it's malformed
+                    # and reading the rest of the file wouldn't help
+                    if _is_cut_short(e, buffer) and read_more():
+                        continue
+                    raise
+                if end == len(buffer) and not at_end_of_file:
+                    # a number or literal can be cut short by the end of the buffer
+                    if read_more():
+                        continue
+                position = end
+                count_to(end)
+                yield element, offset
+
+
+def _is_cut_short(error: json.JSONDecodeError, buffer: str) -> bool:
+    """Return whether a decoding error may be caused by the end of the buffer."""
+    if error.msg.startswith("Unterminated string"):
+        # reported at the start of the string, which only ends with the buffer
+        return True
+    if error.msg.startswith("Invalid \\uXXXX escape"):
+        # reported at the start of the escape
+        return error.pos >= len(buffer) - 6
+    return error.pos >= len(buffer) - 1
+
+
+class IngestCheckpoint:
+    """
+    How far an ingest script got through a file, as the byte offset after the last record whose
+    document was upserted. It is saved after every batch, so an interrupted run resumes after the
+    last written batch instead of starting over. It is kept next to the file by default, and
+    ignored if the file changed size since it was saved.
+    """
+
+    def __init__(self, filepath: str, path: Optional[str] = None):
+        self.filepath = filepath
+        self.path = path or f"{filepath}.checkpoint"
+        self.offset = 0
+        self.records = 0
+
+        file_size = os.path.getsize(filepath)
+        if os.path.exists(self.path):
+            with open(self.path) as checkpoint_file:
+                state: Dict[str, int] = json.load(checkpoint_file)
+            if state.get("file_size") == file_size:
+                self.offset = state["offset"]
+                self.records = state["records"]
+            else:
+                print(f"{filepath} changed since {self.path} was saved, starting over")
+
+    def save(self, offset: int, records: int):
+        """Write the checkpoint atomically, so an interrupted write keeps the previous one."""
+        self.offset, self.records = offset, records
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump(
+                {
+                    "offset": offset,
+                    "records": records,
+                    "file_size": os.path.getsize(self.filepath),
+                },
+                checkpoint_file,
+            )
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        """Remove the checkpoint once the whole file is ingested."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,79 @@
+import os
+from typing import List, Optional, Set
+
+from models.models import DocumentChunk, QueryResult
+from services.chunks import count_tokens
+
+# The number of tokens the chunks of a query response add up to when the request doesn't set
+# max_response_tokens, so a response to a plugin fits in its context on the first try. 0, the
+# default, returns every result
+QUERY_RESPONSE_MAX_TOKENS = int(os.environ.get("QUERY_RESPONSE_MAX_TOKENS", 0))
+# The tokens a chunk costs on top of its text: its id, score and metadata and the JSON around them
+CHUNK_OVERHEAD_TOKENS = 40
+# The tokens a value of an embedding costs, when the embeddings are returned
+EMBEDDING_VALUE_TOKENS = 5
+
+
+def chunk_tokens(chunk: DocumentChunk) -> int:
+    """Return the number of tokens a chunk adds to a response."""
+    tokens = chunk.token_count if chunk.token_count is not None else count_tokens(chunk.text)
+    if chunk.embedding is not None:
+        tokens += len(chunk.embedding) * EMBEDDING_VALUE_TOKENS
+    return tokens + CHUNK_OVERHEAD_TOKENS
+
+
+def pack_query_results(
+    results: List[QueryResult], max_tokens: Optional[int]
+) -> List[QueryResult]:
+    """
+    Fit the chunks of the results of several queries to a token budget, in place.
+
+    The chunks are taken rank by rank across the queries: the best chunk of every query, then the
+    second best of every query, and so on. A chunk that doesn't fit in what is left of the budget is
+    left out and the next ones are still tried, so a single large chunk doesn't use up the budget of
+    the smaller ones after it. Taking them by rank shares the budget between the queries, which
+    scores can't do since their scales differ between datastores. A chunk returned by more than one
+    query is only kept where it ranks best, and the earliest query on a tie.
+
+    Args:
+        results: The results of the queries, each ordered best first.
+        max_tokens: The budget in tokens, None or 0 for no budget.
+
+    Returns:
+        The results, with the chunks that didn't fit removed.
+    """
+    if not max_tokens or max_tokens <= 0:
+        return results
+
+    kept: List[List[DocumentChunk]] = [[] for _ in results]
+    seen: Set[str] = set()
+    remaining = max_tokens
+    depth = max((len(result.results) for result in results), default=0)
+    for rank in range(depth):
+        for i, result in enumerate(results):
+            if remaining < CHUNK_OVERHEAD_TOKENS:
+                # no chunk fits anymore
+                return _set_results(results, kept)
+            if rank >= len(result.results):
+                continue
+            chunk = result.results[rank]
+            if chunk.id is not None:
+                if chunk.id in seen:
+                    continue
+                seen.add(chunk.id)
+            tokens = chunk_tokens(chunk)
+            if tokens > remaining:
+                continue
+            remaining -= tokens
+            kept[i].append(chunk)
+
+    return _set_results(results, kept)
+
+
+def _set_results(
+    results: List[QueryResult], kept: List[List[DocumentChunk]]
+) -> List[QueryResult]:
+    for result, chunks in zip(results, kept):
+        # assigned without validation, so the chunks aren't copied
+        result.results = chunks
+    return results
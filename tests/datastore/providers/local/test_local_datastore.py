@@ -0,0 +1,426 @@
+import asyncio
+import threading
+from typing import Dict, List
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from datastore.providers.local_datastore import LocalDataStore, ReadWriteLock
+from models.models import (
+    DocumentChunk,
+    DocumentChunkMetadata,
+    DocumentMetadataFilter,
+    QueryWithEmbedding,
+    Source,
+)
+
+
+def create_embedding(non_zero_pos: int, size: int) -> List[float]:
+    vector = [0.0] * size
+    vector[non_zero_pos % size] = 1.0
+    return vector
+
+
+@pytest.fixture
+def path(tmp_path) -> str:
+    return str(tmp_path)
+
+
+@pytest.fixture
+def local_datastore(path) -> LocalDataStore:
+    return LocalDataStore("documents", create_index=True, path=path)
+
+
+@pytest.fixture
+def document_chunks() -> Dict[str, List[DocumentChunk]]:
+    first_doc_chunks = [
+        DocumentChunk(
+            id=f"first-doc_{i}",
+            text=f"Lorem ipsum {i}",
+            metadata=DocumentChunkMetadata(
+                source=Source.email, created_at="2023-03-05", document_id="first-doc"
+            ),
+            embedding=create_embedding(i, 5),
+        )
+        for i in range(3)
+    ]
+    second_doc_chunks = [
+        DocumentChunk(
+            id=f"second-doc_{i}",
+            text=f"Dolor sit amet {i}",
+            metadata=DocumentChunkMetadata(
+                created_at="2023-03-04", document_id="second-doc"
+            ),
+            embedding=create_embedding(i + len(first_doc_chunks), 5),
+        )
+        for i in range(2)
+    ]
+    return {
+        "first-doc": first_doc_chunks,
+        "second-doc": second_doc_chunks,
+    }
+
+
+def count_alive(datastore: LocalDataStore) -> int:
+    return int(np.count_nonzero(datastore.alive[: datastore.count]))
+
+
+def test_missing_index_is_not_indexed(path):
+    with pytest.raises(HTTPException) as e:
+        LocalDataStore("missing", path=path)
+    assert e.value.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_upsert_is_persisted(local_datastore, document_chunks, path):
+    document_ids = await local_datastore._upsert(document_chunks)
+    assert ["first-doc", "second-doc"] == document_ids
+
+    reopened = LocalDataStore("documents", path=path)
+    assert 5 == count_alive(reopened)
+    query = QueryWithEmbedding(query="ipsum", top_k=1, embedding=create_embedding(1, 5))
+    query_results = await reopened._query(queries=[query])
+    assert "first-doc_1" == query_results[0].results[0].id
+    assert "Lorem ipsum 1" == query_results[0].results[0].text
+
+
+@pytest.mark.asyncio
+async def test_close_flushes_and_unmaps_the_files(local_datastore, document_chunks, path):
+    await local_datastore._upsert(document_chunks)
+    await local_datastore.close()
+    assert local_datastore._executor is None
+    with pytest.raises(RuntimeError, match="closed"):
+        await local_datastore._query(
+            queries=[QueryWithEmbedding(query="ipsum", embedding=create_embedding(1, 5))]
+        )
+
+    assert 5 == count_alive(LocalDataStore("documents", path=path))
+
+
+@pytest.mark.asyncio
+async def test_upsert_grows_the_files(path):
+    datastore = LocalDataStore("documents", create_index=True, path=path)
+    chunks = [
+        DocumentChunk(id=f"doc_{i}", text=f"text {i}", embedding=np.random.rand(8).tolist())
+        for i in range(3000)
+    ]
+    await datastore._upsert({"doc": chunks})
+    assert 3000 == count_alive(datastore)
+    assert datastore.state["capacity"] >= 3000
+    assert "text 2999" == datastore.texts.get(2999)
+
+
+@pytest.mark.asyncio
+async def test_query_returns_closest_entry(local_datastore, document_chunks):
+    await local_datastore._upsert(document_chunks)
+
+    query = QueryWithEmbedding(
+        query="ipsum",
+        top_k=1,
+        embedding=[0.0, 0.0, 0.5, 0.0, 0.0],
+    )
+    query_results = await local_datastore._query(queries=[query])
+
+    assert 1 == len(query_results)
+    assert 1 == len(query_results[0].results)
+    first_document_chunk = query_results[0].results[0]
+    assert pytest.approx(1.0) == first_document_chunk.score
+    assert Source.email == first_document_chunk.metadata.source
+    assert "2023-03-05" == first_document_chunk.metadata.created_at
+    assert "first-doc" == first_document_chunk.metadata.document_id
+
+
+@pytest.mark.asyncio
+async def test_query_returns_embeddings_only_when_asked(local_datastore, document_chunks):
+    await local_datastore._upsert(document_chunks)
+
+    query = QueryWithEmbedding(query="ipsum", top_k=1, embedding=create_embedding(1, 5))
+    query_results = await local_datastore._query(queries=[query])
+    assert query_results[0].results[0].embedding is None
+
+    query.include_embeddings = True
+    query_results = await local_datastore._query(queries=[query])
+    assert create_embedding(1, 5) == query_results[0].results[0].embedding
+
+
+@pytest.mark.asyncio
+async def test_query_returns_token_counts(local_datastore, document_chunks):
+    document_chunks["first-doc"][0].token_count = 42
+    await local_datastore._upsert(document_chunks)
+
+    query = QueryWithEmbedding(query="ipsum", top_k=2, embedding=create_embedding(0, 5))
+    first, second = (await local_datastore._query(queries=[query]))[0].results
+
+    assert 42 == first.token_count
+    # chunks without a token count are counted when they are written
+    assert second.token_count is not None and second.token_count > 0
+
+
+@pytest.mark.asyncio
+async def test_query_orders_by_score(local_datastore, document_chunks):
+    await local_datastore._upsert(document_chunks)
+
+    query = QueryWithEmbedding(
+        query="lorem",
+        top_k=3,
+        embedding=[0.1, 0.2, 0.3, 0.4, 0.5],
+    )
+    query_results = await local_datastore._query(queries=[query])
+
+    scores = [result.score for result in query_results[0].results]
+    assert ["second-doc_1", "second-doc_0", "first-doc_2"] == [
+        result.id for result in query_results[0].results
+    ]
+    assert scores == sorted(scores, reverse=True)
+
+
+@pytest.mark.asyncio
+async def test_query_filter_by_document_id_returns_this_document_chunks(
+    local_datastore, document_chunks
+):
+    await local_datastore._upsert(document_chunks)
+
+    queries = [
+        QueryWithEmbedding(
+            query="dolor",
+            filter=DocumentMetadataFilter(document_id=document_id),
+            top_k=5,
+            embedding=[0.0, 0.0, 0.5, 0.0, 0.0],
+        )
+        for document_id in ["first-doc", "second-doc", "unknown-doc"]
+    ]
+    query_results = await local_datastore._query(queries=queries)
+
+    assert [3, 2, 0] == [len(result.results) for result in query_results]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "filter, expected",
+    [
+        (DocumentMetadataFilter(start_date="2023-03-05"), 3),
+        (DocumentMetadataFilter(end_date="2023-03-04T00:00:00"), 2),
+        (DocumentMetadataFilter(source=Source.email), 3),
+        (DocumentMetadataFilter(source=Source.chat), 0),
+        (DocumentMetadataFilter(source=Source.email, end_date="2023-03-04"), 0),
+    ],
+)
+async def test_query_metadata_filters(local_datastore, document_chunks, filter, expected):
+    await local_datastore._upsert(document_chunks)
+
+    query = QueryWithEmbedding(
+        query="sit amet", filter=filter, top_k=5, embedding=[0.0, 0.0, 0.5, 0.0, 0.0]
+    )
+    query_results = await local_datastore._query(queries=[query])
+
+    assert expected == len(query_results[0].results)
+
+
+@pytest.mark.asyncio
+async def test_delete_removes_by_ids(local_datastore, document_chunks):
+    await local_datastore._upsert(document_chunks)
+
+    await local_datastore.delete(ids=["first-doc"])
+
+    assert 2 == count_alive(local_datastore)
+
+
+@pytest.mark.asyncio
+async def test_delete_removes_by_document_id_filter(local_datastore, document_chunks):
+    await local_datastore._upsert(document_chunks)
+
+    await local_datastore.delete(filter=DocumentMetadataFilter(document_id="second-doc"))
+
+    assert 3 == count_alive(local_datastore)
+    query = QueryWithEmbedding(query="dolor", top_k=5, embedding=create_embedding(3, 5))
+    query_results = await local_datastore._query(queries=[query])
+    assert all(r.metadata.document_id == "first-doc" for r in query_results[0].results)
+
+
+@pytest.mark.asyncio
+async def test_delete_compacts_and_keeps_live_rows(local_datastore, document_chunks, path):
+    await local_datastore._upsert(document_chunks)
+
+    await local_datastore.delete(ids=["first-doc"])
+
+    # more than half of the rows were deleted, so the index was rewritten without them
+    assert 1 == local_datastore.state["generation"]
+    assert 2 == local_datastore.count
+    assert ["second-doc"] == local_datastore.dictionaries["document_id"]
+    reopened = LocalDataStore("documents", path=path)
+    query = QueryWithEmbedding(query="dolor", top_k=5, embedding=create_embedding(4, 5))
+    query_results = await reopened._query(queries=[query])
+    assert ["second-doc_1", "second-doc_0"] == [r.id for r in query_results[0].results]
+
+
+@pytest.mark.asyncio
+async def test_delete_removes_all(local_datastore, document_chunks):
+    await local_datastore._upsert(document_chunks)
+
+    await local_datastore.delete(delete_all=True)
+
+    assert 0 == local_datastore.count
+    await local_datastore._upsert(document_chunks)
+    assert 5 == count_alive(local_datastore)
+
+
+IVFPQ_PARAMS = {
+    "type": "ivfpq",
+    "nlist": 16,
+    "m": 8,
+    "min_train_rows": 1000,
+    "nprobe": 16,
+    "rerank": 50,
+}
+
+
+def random_chunks(doc_id: str, vectors: np.ndarray, offset: int = 0) -> List[DocumentChunk]:
+    return [
+        DocumentChunk(id=f"{doc_id}_{offset + i}", text=f"text {offset + i}", embedding=vector.tolist())
+        for i, vector in enumerate(vectors)
+    ]
+
+
+async def exact_top_ids(path: str, vectors: np.ndarray, query: np.ndarray, k: int) -> List[str]:
+    exact = LocalDataStore("exact", create_index=True, path=path)
+    await exact._upsert({"doc": random_chunks("doc", vectors)})
+    results = await exact._query([QueryWithEmbedding(query="q", top_k=k, embedding=query.tolist())])
+    return [result.id for result in results[0].results]
+
+
+@pytest.mark.asyncio
+async def test_ivfpq_index_is_trained_and_persisted(path):
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(1200, 32)).astype(np.float32)
+    query = vectors[7] + 0.1 * rng.normal(size=32).astype(np.float32)
+
+    datastore = LocalDataStore("ann", create_index=True, path=path, index_params=dict(IVFPQ_PARAMS))
+    await datastore._upsert({"doc": random_chunks("doc", vectors[:800])})
+    assert not datastore.ann.trained
+    await datastore._upsert({"doc": random_chunks("doc", vectors[800:], offset=800)})
+    assert datastore.ann.trained
+
+    expected = await exact_top_ids(path, vectors, query, 10)
+    reopened = LocalDataStore("ann", path=path)
+    assert reopened.ann.trained
+    results = await reopened._query([QueryWithEmbedding(query="q", top_k=10, embedding=query.tolist())])
+    # every list is probed and the candidates are rescored, so the result is exact
+    assert expected == [result.id for result in results[0].results]
+
+    reopened.set_search_params(nprobe=2, rerank=20)
+    assert LocalDataStore("ann", path=path).index_params["nprobe"] == 2
+    results = await reopened._query([QueryWithEmbedding(query="q", top_k=10, embedding=query.tolist())])
+    assert expected[0] == results[0].results[0].id
+
+
+@pytest.mark.asyncio
+async def test_queries_run_while_the_ivfpq_index_trains(path):
+    vectors = np.random.default_rng(2).normal(size=(1200, 32)).astype(np.float32)
+    datastore = LocalDataStore("ann", create_index=True, path=path, index_params=dict(IVFPQ_PARAMS))
+    await datastore._upsert({"doc": random_chunks("doc", vectors[:800])})
+
+    training = threading.Event()
+    queried = threading.Event()
+    fit = datastore.ann.fit
+
+    def slow_fit(sample):
+        training.set()
+        # the training waits for a query, which only runs if it doesn't need the lock
+        assert queried.wait(timeout=5)
+        return fit(sample)
+
+    datastore.ann.fit = slow_fit
+    upsert = asyncio.create_task(
+        datastore._upsert({"doc": random_chunks("doc", vectors[800:], offset=800)})
+    )
+    await asyncio.to_thread(training.wait, 5)
+    query = QueryWithEmbedding(query="q", top_k=1, embedding=vectors[3].tolist())
+    results = await datastore._query([query])
+    queried.set()
+    await upsert
+
+    assert "doc_3" == results[0].results[0].id
+    assert datastore.ann.trained
+
+
+@pytest.mark.asyncio
+async def test_ivfpq_index_supports_inserts_and_deletes(path):
+    rng = np.random.default_rng(2)
+    vectors = rng.normal(size=(1000, 32)).astype(np.float32)
+    datastore = LocalDataStore("ann", create_index=True, path=path, index_params=dict(IVFPQ_PARAMS))
+    await datastore._upsert({"doc": random_chunks("doc", vectors)})
+    assert datastore.ann.trained
+
+    new_vector = rng.normal(size=32).astype(np.float32)
+    await datastore._upsert({"new-doc": random_chunks("new-doc", new_vector[None, :])})
+    query = QueryWithEmbedding(query="q", top_k=1, embedding=new_vector.tolist())
+    results = await datastore._query([query])
+    assert "new-doc_0" == results[0].results[0].id
+
+    await datastore.delete(ids=["new-doc"])
+    results = await datastore._query([query])
+    assert "new-doc_0" != results[0].results[0].id
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("precision", ["float16", "int8"])
+async def test_reduced_precision_index_matches_exact_search(path, precision):
+    rng = np.random.default_rng(3)
+    vectors = rng.normal(size=(500, 32)).astype(np.float32)
+    query = vectors[11] + 0.1 * rng.normal(size=32).astype(np.float32)
+    expected = await exact_top_ids(path, vectors, query, 10)
+
+    params = {"type": "flat", "precision": precision, "rescore": 50}
+    datastore = LocalDataStore("reduced", create_index=True, path=path, index_params=params)
+    await datastore._upsert({"doc": random_chunks("doc", vectors)})
+    assert datastore.vectors.dtype == (np.float16 if precision == "float16" else np.float32)
+
+    reopened = LocalDataStore("reduced", path=path)
+    results = await reopened._query([QueryWithEmbedding(query="q", top_k=10, embedding=query.tolist())])
+    assert expected == [result.id for result in results[0].results]
+
+    # the rows are still found after a compaction copies them to a new generation
+    await reopened.delete(ids=["doc"])
+    await reopened._upsert({"new-doc": random_chunks("new-doc", vectors[:20])})
+    results = await reopened._query([QueryWithEmbedding(query="q", top_k=1, embedding=vectors[3].tolist())])
+    assert "new-doc_3" == results[0].results[0].id
+
+
+@pytest.mark.asyncio
+async def test_queries_and_writes_run_off_the_event_loop(local_datastore, document_chunks):
+    threads = set()
+    search_rows = local_datastore._search_rows
+
+    def record_thread(queries):
+        threads.add(threading.current_thread().name)
+        return search_rows(queries)
+
+    local_datastore._search_rows = record_thread
+    await local_datastore._upsert(document_chunks)
+    query = QueryWithEmbedding(query="ipsum", top_k=1, embedding=create_embedding(1, 5))
+
+    results = await asyncio.gather(*[local_datastore._query(queries=[query]) for _ in range(4)])
+
+    assert all("first-doc_1" == result[0].results[0].id for result in results)
+    assert threads and all(name.startswith("LocalDataStore") for name in threads)
+
+
+def test_read_write_lock_lets_readers_share_it():
+    lock = ReadWriteLock()
+    readers_inside = threading.Barrier(2, timeout=1)
+
+    def read():
+        with lock.read():
+            # both readers hold the lock at once, or the barrier times out
+            readers_inside.wait()
+
+    threads = [threading.Thread(target=read) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not readers_inside.broken
+
+    with lock.write():
+        pass
@@ -1,6 +1,7 @@
 from datastore.providers.redis_datastore import RedisDataStore
 import datastore.providers.redis_datastore as static_redis
 from models.models import DocumentChunk, DocumentChunkMetadata, QueryWithEmbedding, Source
+from services.token_budget import pack_query_results
 import pytest
 import redis.asyncio as redis
 import numpy as np
@@ -42,4 +43,35 @@ async def test_redis_upsert_query(redis_datastore):
     assert 1 == len(query_results)
     for i in range(5):
         assert f"Lorem ipsum {i}" == query_results[0].results[i].text
-        assert f"doc-{i}" == query_results[0].results[i].id
+        assert f"first-doc_{i}" == query_results[0].results[i].id
+        assert f"doc-{i}" == query_results[0].results[i].metadata.document_id
+
+
+@pytest.mark.asyncio
+async def test_redis_query_returns_every_chunk_of_a_document(redis_datastore):
+    chunks = [create_document_chunk(i, 5) for i in range(4)]
+    for chunk in chunks:
+        chunk.metadata.document_id = "doc-1"
+    await redis_datastore._upsert({"doc-1": chunks})
+    query = QueryWithEmbedding(query="Lorem ipsum", top_k=4, embedding=create_embedding(0, 5))
+
+    query_results = pack_query_results(await redis_datastore._query(queries=[query]), 10_000)
+
+    # each chunk keeps its own id, so none is dropped as a repeat of another one
+    assert sorted(f"first-doc_{i}" for i in range(4)) == sorted(
+        chunk.id for chunk in query_results[0].results
+    )
+
+
+@pytest.mark.asyncio
+async def test_redis_delete_documents(redis_datastore):
+    docs = create_document_chunks(3, 5)
+    keys = [redis_datastore._redis_key("docs", chunk.id) for chunk in docs["docs"]]
+    await redis_datastore._upsert(docs)
+    set_key = redis_datastore._document_keys_key("docs")
+    assert 3 == await redis_datastore.client.scard(set_key)
+
+    await redis_datastore.delete_documents(["docs"])
+    assert 0 == await redis_datastore.client.exists(set_key)
+    for key in keys:
+        assert 0 == await redis_datastore.client.exists(key)
@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from datastore.datastore import DataStore
+from models.models import DocumentChunkWithScore, Query, QueryResult
+
+
+class BlockingDataStore(DataStore):
+    """Calls a blocking client, like most provider SDKs."""
+
+    def __init__(self):
+        self.threads = set()
+
+    def _search(self, seconds: float) -> str:
+        self.threads.add(threading.current_thread().name)
+        time.sleep(seconds)
+        return "done"
+
+    async def _upsert(self, chunks):
+        return list(chunks)
+
+    async def _query(self, queries):
+        return []
+
+    async def delete(self, ids=None, filter=None, delete_all=None):
+        return True
+
+
+@pytest.mark.asyncio
+async def test_run_sync_overlaps_blocking_calls():
+
+    datastore = BlockingDataStore()
+    started = time.monotonic()
+    results = await asyncio.gather(*[datastore._run_sync(datastore._search, 0.1) for _ in range(4)])
+    elapsed = time.monotonic() - started
+
+    assert results == ["done"] * 4
+    # the calls ran in the thread pool of the datastore, at the same time
+    assert elapsed < 0.3
+    assert all(name.startswith("BlockingDataStore") for name in datastore.threads)
+
+
+@pytest.mark.asyncio
+async def test_run_sync_passes_keyword_arguments():
+    datastore = BlockingDataStore()
+    assert await datastore._run_sync(datastore._search, seconds=0) == "done"
+
+
+class VectorReturningDataStore(BlockingDataStore):
+    """Returns the vectors of its results whether they are asked for or not."""
+
+    async def _query(self, queries, index=None):
+        return [
+            QueryResult(
+                query=query.query,
+                results=[
+                    DocumentChunkWithScore(
+                        id=query.query, text=query.query, score=1.0, embedding=[1.0, 0.0]
+                    )
+                ],
+            )
+            for query in queries
+        ]
+
+
+@pytest.mark.asyncio
+async def test_query_drops_embeddings_unless_asked(monkeypatch):
+    class FakeEmbeddingCache:
+        async def get_embeddings(self, texts):
+            return [[1.0, 0.0]] * len(texts)
+
+    monkeypatch.setattr(
+        "datastore.datastore.get_query_embedding_cache", lambda: FakeEmbeddingCache()
+    )
+    datastore = VectorReturningDataStore()
+
+    results = await datastore.query(
+        [Query(query="a"), Query(query="b", include_embeddings=True)], None
+    )
+
+    assert results[0].results[0].embedding is None
+    assert [1.0, 0.0] == results[1].results[0].embedding
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from datastore.registry import DataStoreRegistry
+
+
+class FakeDataStore:
+    def __init__(self, index_name, create_index):
+        self.index_name = index_name
+        self.create_index = create_index
+        self.ensured = 0
+        self.closed = False
+
+    async def ensure_index(self):
+        self.ensured += 1
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def created():
+    return []
+
+
+@pytest.fixture
+def registry(created) -> DataStoreRegistry:
+    async def factory(index_name, create_index):
+        await asyncio.sleep(0.01)
+        created.append(index_name)
+        return FakeDataStore(index_name, create_index)
+
+    return DataStoreRegistry(factory, max_entries=2)
+
+
+@pytest.mark.asyncio
+async def test_registry_reuses_handles(registry, created):
+    first = await registry.get("owner-repo")
+    assert await registry.get("owner-repo") is first
+    assert created == ["owner-repo"]
+    assert registry.stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+
+@pytest.mark.asyncio
+async def test_registry_creates_concurrent_lookups_once(registry, created):
+    handles = await asyncio.gather(*[registry.get("owner-repo") for _ in range(5)])
+    assert all(handle is handles[0] for handle in handles)
+    assert created == ["owner-repo"]
+
+
+@pytest.mark.asyncio
+async def test_registry_evicts_least_recently_used(registry, created):
+    a = await registry.get("a")
+    b = await registry.get("b")
+    await registry.get("a")
+    await registry.get("c")
+    assert len(registry) == 2
+    assert b.closed and not a.closed
+
+    await registry.get("a")
+    await registry.get("b")
+    assert created == ["a", "b", "c", "b"]
+
+
+@pytest.mark.asyncio
+async def test_registry_creates_the_index_on_the_open_handle(registry, created):
+    first = await registry.get("owner-repo")
+    assert await registry.get("owner-repo", create_index=True) is first
+    assert first.ensured == 1 and not first.closed
+    assert created == ["owner-repo"]
+
+    # a new handle is created with its index
+    new = await registry.get("new-repo", create_index=True)
+    assert new.create_index and new.ensured == 0
+
+
+@pytest.mark.asyncio
+async def test_registry_drops_the_lock_of_a_failed_creation():
+    async def factory(index_name, create_index):
+        raise LookupError(f"{index_name} is not indexed")
+
+    registry = DataStoreRegistry(factory)
+    with pytest.raises(LookupError):
+        await registry.get("missing")
+    assert registry._locks == {}
+    assert len(registry) == 0
@@ -0,0 +1,75 @@
+from typing import Dict, List
+
+import numpy as np
+import pytest
+
+from datastore.providers.local_datastore import LocalDataStore
+from models.models import DocumentChunk, DocumentChunkMetadata, QueryWithEmbedding, Source
+from services.bulk import BulkWriter, read_chunks
+
+
+def make_chunks(doc_id: str, count: int, dimension: int = 8) -> List[DocumentChunk]:
+    rng = np.random.default_rng(len(doc_id))
+    return [
+        DocumentChunk(
+            id=f"{doc_id}_{i}",
+            text=f"chunk {i} of {doc_id}",
+            metadata=DocumentChunkMetadata(
+                document_id=doc_id, source=Source.file, created_at="2023-03-05"
+            ),
+            embedding=rng.normal(size=dimension).tolist(),
+        )
+        for i in range(count)
+    ]
+
+
+async def export_to(datastore: LocalDataStore, path: str, batch_size: int) -> int:
+    with BulkWriter(path) as writer:
+        async for chunks in datastore.export_chunks(batch_size):
+            writer.write(chunks)
+        return writer.count
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("filename", ["export.jsonl", "export.jsonl.gz", "export.parquet"])
+async def test_export_and_import_round_trip(tmp_path, filename):
+    if filename.endswith(".parquet"):
+        pytest.importorskip("pyarrow")
+    source = LocalDataStore("source", create_index=True, path=str(tmp_path))
+    chunks: Dict[str, List[DocumentChunk]] = {"a": make_chunks("a", 5), "b": make_chunks("b", 4)}
+    await source._upsert(chunks)
+    await source.delete(ids=["b"])
+    await source._upsert({"c": make_chunks("c", 3)})
+
+    path = str(tmp_path / filename)
+    assert await export_to(source, path, batch_size=4) == 8
+
+    batches = list(read_chunks(path, batch_size=3))
+    assert [len(batch) for batch in batches] == [3, 3, 2]
+    exported = [chunk for batch in batches for chunk in batch]
+    assert [chunk.id for chunk in exported] == [f"a_{i}" for i in range(5)] + [f"c_{i}" for i in range(3)]
+    assert exported[0].metadata.source == Source.file
+    assert exported[0].metadata.created_at == "2023-03-05"
+    assert exported[0].embedding.dtype == np.float32
+
+    destination = LocalDataStore("destination", create_index=True, path=str(tmp_path))
+    destination.IMPORT_BATCH_SIZE = 5
+    assert await destination.import_chunks(read_chunks(path, batch_size=3)) == 8
+    assert destination.count == 8
+
+    query = QueryWithEmbedding(query="q", top_k=1, embedding=chunks["a"][2].embedding)
+    results = await destination._query([query])
+    assert results[0].results[0].id == "a_2"
+    assert results[0].results[0].metadata.document_id == "a"
+
+
+@pytest.mark.asyncio
+async def test_import_requires_embeddings(tmp_path):
+    datastore = LocalDataStore("documents", create_index=True, path=str(tmp_path))
+    with pytest.raises(ValueError, match="no embedding"):
+        await datastore.import_chunks([[DocumentChunk(id="x", text="no embedding")]])
+
+
+def test_unknown_format_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match="format"):
+        BulkWriter(str(tmp_path / "export.csv"))
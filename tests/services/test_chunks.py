@@ -0,0 +1,125 @@
+import inspect
+from typing import List, Optional
+
+import numpy as np
+import pytest
+
+import services.chunks as chunks
+from models.embeddings import EmbeddingBatch
+from models.models import Document, DocumentChunk
+from services.embedding_cache import EmbeddingCache
+from services.chunks import (
+    CHUNK_SIZE,
+    MAX_NUM_CHUNKS,
+    MIN_CHUNK_LENGTH_TO_EMBED,
+    MIN_CHUNK_SIZE_CHARS,
+    create_document_chunks,
+    embed_chunks,
+    get_text_chunks,
+    iter_text_chunks,
+    shard_documents,
+    tokenizer,
+)
+
+
+def slicing_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
+    """The original token-slicing chunker, kept as a reference for chunk boundaries."""
+    if not text or text.isspace():
+        return []
+    tokens = tokenizer.encode(text, disallowed_special=())
+    result = []
+    chunk_size = chunk_token_size or CHUNK_SIZE
+    num_chunks = 0
+    while tokens and num_chunks < MAX_NUM_CHUNKS:
+        chunk = tokens[:chunk_size]
+        chunk_text = tokenizer.decode(chunk)
+        if not chunk_text or chunk_text.isspace():
+            tokens = tokens[len(chunk) :]
+            continue
+        last_punctuation = max(
+            chunk_text.rfind("."),
+            chunk_text.rfind("?"),
+            chunk_text.rfind("!"),
+            chunk_text.rfind("\n"),
+        )
+        if last_punctuation != -1 and last_punctuation > MIN_CHUNK_SIZE_CHARS:
+            chunk_text = chunk_text[: last_punctuation + 1]
+        chunk_text_to_append = chunk_text.replace("\n", " ").strip()
+        if len(chunk_text_to_append) > MIN_CHUNK_LENGTH_TO_EMBED:
+            result.append(chunk_text_to_append)
+        tokens = tokens[len(tokenizer.encode(chunk_text, disallowed_special=())) :]
+        num_chunks += 1
+    if tokens:
+        remaining_text = tokenizer.decode(tokens).replace("\n", " ").strip()
+        if len(remaining_text) > MIN_CHUNK_LENGTH_TO_EMBED:
+            result.append(remaining_text)
+    return result
+
+
+@pytest.fixture
+def texts() -> List[str]:
+    return [
+        "",
+        "   \n\t ",
+        "Short text.",
+        "Lorem ipsum dolor sit amet. " * 400,
+        "What? Really! Yes.\nNo\n\n\n" * 300,
+        "ünïcödé 漢字 🙂 mixed with ascii. " * 250,
+        inspect.getsource(chunks),
+    ]
+
+
+@pytest.mark.parametrize("chunk_token_size", [None, 17, 200])
+def test_chunk_boundaries_match_slicing_chunker(texts, chunk_token_size):
+    for text in texts:
+        assert get_text_chunks(text, chunk_token_size) == slicing_text_chunks(
+            text, chunk_token_size
+        )
+
+
+def test_document_chunks_have_token_counts(texts):
+    doc_chunks, _ = create_document_chunks(Document(text=texts[3]), None)
+    assert doc_chunks
+    for chunk in doc_chunks:
+        assert chunk.token_count == len(tokenizer.encode(chunk.text, disallowed_special=()))
+
+
+def test_iter_text_chunks_is_lazy():
+    chunk_iter = iter_text_chunks("Lorem ipsum dolor sit amet. " * 400, None)
+    assert not isinstance(chunk_iter, list)
+    assert next(chunk_iter)
+
+
+def test_shard_documents_balances_text():
+    documents = [Document(id=str(i), text="x" * size) for i, size in enumerate([9, 1, 5, 4, 3, 2])]
+    shards = shard_documents(documents, 3)
+    assert sorted(i for shard in shards for i in shard) == list(range(6))
+    sizes = [sum(len(documents[i].text) for i in shard) for shard in shards]
+    # the largest document alone sets the lower bound on the largest shard
+    assert max(sizes) == 9
+    assert shard_documents(documents[:2], 8) == [[0], [1]]
+
+
+@pytest.mark.asyncio
+async def test_embed_chunks_sets_rows_of_one_batch(monkeypatch):
+    requested = []
+
+    async def get_embeddings(texts):
+        requested.append(texts)
+        return EmbeddingBatch.from_lists([[float(len(text)), 1.0] for text in texts])
+
+    cache = EmbeddingCache(path="", memory_entries=10)
+    await cache.put_many(chunks.EMBEDDING_MODEL, ["cached"], [[-1.0, -1.0]])
+    monkeypatch.setattr(chunks, "get_embeddings", get_embeddings)
+    monkeypatch.setattr(chunks, "get_embedding_cache", lambda: cache)
+
+    doc_chunks = [DocumentChunk(text=text) for text in ["one", "cached", "three", "one"]]
+    batch = await embed_chunks(doc_chunks)
+
+    # only the misses are requested, once per distinct text
+    assert requested == [["one", "three"]]
+    assert batch is not None and batch.vectors.dtype == np.float32
+    assert batch.tolist() == [[3.0, 1.0], [-1.0, -1.0], [5.0, 1.0], [3.0, 1.0]]
+    for i, chunk in enumerate(doc_chunks):
+        assert np.shares_memory(chunk.embedding, batch.vectors)
+        assert chunk.embedding.tolist() == batch[i].tolist()
@@ -0,0 +1,167 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+import services.embedding_cache as embedding_cache
+from services.embedding_cache import EmbeddingCache, LRUCache, QueryEmbeddingCache
+
+MODEL = "text-embedding-ada-002"
+
+
+def as_lists(embeddings):
+    return [None if embedding is None else embedding.tolist() for embedding in embeddings]
+
+
+@pytest.fixture
+def cache_path(tmp_path) -> str:
+    return str(tmp_path / "embeddings.sqlite3")
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    assert cache.put("c", 3) == 1
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_lru_cache_expires_entries(monkeypatch):
+    now = time.monotonic()
+    cache = LRUCache(max_entries=2, ttl_seconds=10)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_round_trip(cache_path):
+    cache = EmbeddingCache(path=cache_path, memory_entries=10)
+    assert await cache.get_many(MODEL, ["first", "second"]) == [None, None]
+
+    await cache.put_many(MODEL, ["first"], [[0.5, 0.25]])
+    assert as_lists(await cache.get_many(MODEL, ["first", "second"])) == [[0.5, 0.25], None]
+    assert await cache.get_many("another-model", ["first"]) == [None]
+
+    stats = cache.stats()
+    assert stats["memory_hits"] == 1
+    assert stats["misses"] == 4
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_persists_between_instances(cache_path):
+    cache = EmbeddingCache(path=cache_path)
+    await cache.put_many(MODEL, ["first", "second"], [[0.5], [0.25]])
+    cache.close()
+
+    cache = EmbeddingCache(path=cache_path)
+    assert as_lists(await cache.get_many(MODEL, ["second", "first"])) == [[0.25], [0.5]]
+    assert cache.stats()["disk_hits"] == 2
+    assert cache.stats()["disk_entries"] == 2
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_bounds_disk_entries(cache_path):
+    cache = EmbeddingCache(path=cache_path, max_entries=3, memory_entries=1)
+    texts = [f"text {i}" for i in range(5)]
+    for i, text in enumerate(texts):
+        await cache.put_many(MODEL, [text], [[float(i)]])
+
+    assert cache.stats()["disk_entries"] == 3
+    assert cache.stats()["evictions"] > 0
+    # The oldest embeddings were evicted from both tiers
+    assert await cache.get_many(MODEL, texts[:2]) == [None, None]
+    assert as_lists(await cache.get_many(MODEL, texts[2:])) == [[2.0], [3.0], [4.0]]
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache_coalesces_concurrent_queries(monkeypatch):
+    requests = []
+
+    async def get_embeddings(texts):
+        requests.append(texts)
+        await asyncio.sleep(0.01)
+        return [[float(len(text))] for text in texts]
+
+    monkeypatch.setattr(embedding_cache, "get_query_embeddings", get_embeddings)
+    cache = QueryEmbeddingCache(max_entries=10, ttl_seconds=60)
+
+    results = await asyncio.gather(
+        cache.get_embeddings(["what is this repo", "how do I run it"]),
+        cache.get_embeddings(["what  is this repo "]),
+        cache.get_embeddings(["how do I run it", "how do I run it"]),
+    )
+    assert results == [[[17.0], [15.0]], [[17.0]], [[15.0], [15.0]]]
+    assert requests == [["what is this repo", "how do I run it"]]
+    assert cache.stats()["coalesced"] == 2
+
+    assert await cache.get_embeddings(["what is this repo"]) == [[17.0]]
+    assert len(requests) == 1
+    assert cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache_propagates_errors(monkeypatch):
+    async def get_embeddings(texts):
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream failed")
+
+    monkeypatch.setattr(embedding_cache, "get_query_embeddings", get_embeddings)
+    cache = QueryEmbeddingCache(max_entries=10, ttl_seconds=60)
+
+    results = await asyncio.gather(
+        cache.get_embeddings(["query"]),
+        cache.get_embeddings(["query"]),
+        return_exceptions=True,
+    )
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert cache.stats()["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_returns_float32_copies(cache_path):
+    cache = EmbeddingCache(path=cache_path)
+    batch = np.arange(6, dtype=np.float32).reshape(3, 2)
+    await cache.put_many(MODEL, ["a", "b", "c"], list(batch))
+    batch[1] = -1
+
+    (embedding,) = await cache.get_many(MODEL, ["b"])
+    assert embedding.dtype == np.float32
+    assert embedding.tolist() == [2.0, 3.0]
+    # the cached row is not a view of the batch, so it doesn't keep the batch alive
+    assert embedding.base is None
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache_survives_cancelling_the_first_caller(monkeypatch):
+    requests = []
+
+    async def get_embeddings(texts):
+        requests.append(texts)
+        await asyncio.sleep(0.02)
+        return [[1.0] for _ in texts]
+
+    monkeypatch.setattr(embedding_cache, "get_query_embeddings", get_embeddings)
+    cache = QueryEmbeddingCache(max_entries=10, ttl_seconds=60)
+
+    first = asyncio.create_task(cache.get_embeddings(["query"]))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(cache.get_embeddings(["query"]))
+    await asyncio.sleep(0)
+    first.cancel()
+
+    # the caller coalesced onto the cancelled one still gets the embedding
+    assert await second == [[1.0]]
+    assert requests == [["query"]]
+    with pytest.raises(asyncio.CancelledError):
+        await first
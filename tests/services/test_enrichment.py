@@ -0,0 +1,123 @@
+import pytest
+
+from models.models import DocumentMetadata, Source
+from services.enrichment import DocumentEnricher, EnrichmentCache
+
+
+@pytest.fixture
+def cache_path(tmp_path) -> str:
+    return str(tmp_path / "enrichment.sqlite3")
+
+
+class FakeModel:
+    """Stands in for the chat completions, flagging texts that contain an @ as PII."""
+
+    def __init__(self):
+        self.screened = []
+        self.extracted = []
+
+    async def screen_text(self, text: str) -> bool:
+        self.screened.append(text)
+        return "@" in text
+
+    async def extract(self, text: str):
+        self.extracted.append(text)
+        if "broken" in text:
+            raise ValueError("the model failed")
+        return {"source": "email", "author": "extracted"}
+
+
+@pytest.mark.asyncio
+async def test_enrich_many_screens_and_extracts(cache_path):
+    model = FakeModel()
+    enricher = DocumentEnricher(
+        screen_for_pii=True,
+        extract_metadata=True,
+        cache=EnrichmentCache(path=cache_path),
+        screen_text=model.screen_text,
+        extract=model.extract,
+    )
+    metadata = DocumentMetadata(source=Source.file)
+    results = await enricher.enrich_many(
+        [("clean", metadata), ("mail me at a@b.c", metadata), ("broken", metadata)]
+    )
+
+    assert isinstance(results[0], DocumentMetadata)
+    assert results[0].author == "extracted"
+    assert results[0].source == Source.email
+    # PII detected
+    assert results[1] is None
+    assert isinstance(results[2], ValueError)
+    # metadata isn't extracted from documents with PII
+    assert len(model.extracted) == 2
+
+
+@pytest.mark.asyncio
+async def test_enrich_many_reuses_cached_and_duplicate_texts(cache_path):
+    model = FakeModel()
+
+    def make_enricher():
+        return DocumentEnricher(
+            screen_for_pii=True,
+            extract_metadata=True,
+            cache=EnrichmentCache(path=cache_path),
+            screen_text=model.screen_text,
+            extract=model.extract,
+        )
+
+    metadata = DocumentMetadata()
+    documents = [("same", metadata), ("same", metadata), ("a@b.c", metadata)]
+    first = await make_enricher().enrich_many(documents)
+    assert model.screened == ["same", "a@b.c"]
+    assert len(model.extracted) == 1
+
+    # a new run with the same cache file pays for nothing, and PII results are cached too
+    second = await make_enricher().enrich_many(documents)
+    assert len(model.screened) == 2
+    assert len(model.extracted) == 1
+    assert second == first
+
+
+@pytest.mark.asyncio
+async def test_enrich_many_doesnt_cache_errors():
+    model = FakeModel()
+    enricher = DocumentEnricher(
+        screen_for_pii=False,
+        extract_metadata=True,
+        cache=EnrichmentCache(path=""),
+        extract=model.extract,
+    )
+    documents = [("broken", DocumentMetadata())]
+    assert isinstance((await enricher.enrich_many(documents))[0], ValueError)
+    assert isinstance((await enricher.enrich_many(documents))[0], ValueError)
+    assert len(model.extracted) == 2
+
+
+class Interrupted(BaseException):
+    pass
+
+
+@pytest.mark.asyncio
+async def test_enrich_many_returns_base_exceptions_as_errors():
+    async def screen_text(text: str) -> bool:
+        if text == "screen":
+            raise Interrupted()
+        return False
+
+    async def extract(text: str):
+        raise Interrupted()
+
+    enricher = DocumentEnricher(
+        screen_for_pii=True,
+        extract_metadata=True,
+        cache=EnrichmentCache(path=""),
+        screen_text=screen_text,
+        extract=extract,
+    )
+    results = await enricher.enrich_many(
+        [("screen", DocumentMetadata()), ("extract", DocumentMetadata())]
+    )
+
+    # neither is taken for PII detected or for extracted metadata
+    assert isinstance(results[0], Interrupted)
+    assert isinstance(results[1], Interrupted)
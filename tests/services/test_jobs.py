@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from models.api import JobStatus
+from services.jobs import JobProgress, JobQueue, JobStore
+
+
+@pytest.fixture
+def store(tmp_path) -> JobStore:
+    return JobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+async def wait_until_finished(queue: JobQueue, job_id: str):
+    for _ in range(100):
+        if (await queue.status(job_id))["status"] in (JobStatus.completed, JobStatus.failed):
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError(job_id)
+
+
+@pytest.mark.asyncio
+async def test_job_queue_runs_jobs_and_records_progress(store):
+    async def handler(payload, progress: JobProgress):
+        progress.record_files(payload["files"])
+        progress.record_chunks(7)
+        progress.record_vectors(7)
+
+    queue = JobQueue(handler, store=store, num_workers=1)
+    await queue.start()
+    job_id = await queue.submit({"files": 3})
+    await wait_until_finished(queue, job_id)
+    await queue.stop()
+
+    job = await queue.status(job_id)
+    assert job["status"] == JobStatus.completed
+    assert job["payload"] == {"files": 3}
+    assert job["progress"]["files_processed"] == 3
+    assert job["progress"]["chunks_embedded"] == 7
+    assert job["progress"]["vectors_written"] == 7
+    assert job["finished_at"] is not None
+
+
+@pytest.mark.asyncio
+async def test_job_queue_records_failures(store):
+    async def handler(payload, progress):
+        raise RuntimeError("download failed")
+
+    queue = JobQueue(handler, store=store, num_workers=1)
+    await queue.start()
+    job_id = await queue.submit({})
+    await wait_until_finished(queue, job_id)
+    await queue.stop()
+
+    job = await queue.status(job_id)
+    assert job["status"] == JobStatus.failed
+    assert job["error"] == "download failed"
+
+
+@pytest.mark.asyncio
+async def test_job_queue_resumes_unfinished_jobs(store):
+    queued_id = store.create({"name": "queued"})
+    running_id = store.create({"name": "running"})
+    store.update(running_id, status=JobStatus.running)
+
+    ran = []
+
+    async def handler(payload, progress):
+        ran.append(payload["name"])
+
+    queue = JobQueue(handler, store=store, num_workers=1)
+    await queue.start()
+    await wait_until_finished(queue, queued_id)
+    await wait_until_finished(queue, running_id)
+    await queue.stop()
+
+    assert ran == ["queued", "running"]
+    assert store.unfinished() == []
+
+
+@pytest.mark.asyncio
+async def test_job_queue_runs_jobs_with_the_same_key_one_at_a_time(store):
+    running = set()
+    overlapped = []
+
+    async def handler(payload, progress):
+        if payload["repo"] in running:
+            overlapped.append(payload["repo"])
+        running.add(payload["repo"])
+        await asyncio.sleep(0.02)
+        running.discard(payload["repo"])
+
+    queue = JobQueue(handler, store=store, num_workers=3, key=lambda payload: payload["repo"])
+    await queue.start()
+    job_ids = [await queue.submit({"repo": repo}) for repo in ["a", "a", "b"]]
+    for job_id in job_ids:
+        await wait_until_finished(queue, job_id)
+    await queue.stop()
+
+    assert overlapped == []
+    assert queue._deferred == {}
+
+
+@pytest.mark.asyncio
+async def test_job_queue_runs_other_keys_while_a_key_is_busy(store):
+    b_ran = asyncio.Event()
+    ran = []
+
+    async def handler(payload, progress):
+        if payload["repo"] == "a":
+            # every "a" job waits for "b", which needs a worker the waiting jobs don't hold
+            await asyncio.wait_for(b_ran.wait(), 1)
+        else:
+            b_ran.set()
+        ran.append(payload["repo"])
+
+    queue = JobQueue(handler, store=store, num_workers=2, key=lambda payload: payload["repo"])
+    await queue.start()
+    job_ids = [await queue.submit({"repo": repo}) for repo in ["a", "a", "a", "b"]]
+    for job_id in job_ids:
+        await wait_until_finished(queue, job_id)
+    await queue.stop()
+
+    assert ran == ["b", "a", "a", "a"]
+    assert [(await queue.status(job_id))["status"] for job_id in job_ids] == [JobStatus.completed] * 4
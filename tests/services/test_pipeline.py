@@ -0,0 +1,156 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import pytest
+
+import services.pipeline as pipeline
+from datastore.datastore import DataStore
+from models.models import Document, DocumentChunk
+from services.jobs import JobProgress
+from services.pipeline import IngestPipeline
+
+
+class FakeDataStore:
+    def __init__(self, fail_upsert: bool = False):
+        self.fail_upsert = fail_upsert
+        self.deleted: List[str] = []
+        self.delete_calls: List[List[str]] = []
+        self.written: Dict[str, List[DocumentChunk]] = {}
+
+    async def delete_documents(self, document_ids: List[str]) -> bool:
+        self.delete_calls.append(document_ids)
+        self.deleted.extend(document_ids)
+        return True
+
+    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+        await asyncio.sleep(0.001)
+        if self.fail_upsert:
+            raise RuntimeError("write failed")
+        for doc_id, doc_chunks in chunks.items():
+            self.written.setdefault(doc_id, []).extend(doc_chunks)
+        return list(chunks)
+
+
+@pytest.fixture(autouse=True)
+def fake_embeddings(monkeypatch):
+    async def embed_chunks(chunks):
+        await asyncio.sleep(0.001)
+        for chunk in chunks:
+            chunk.embedding = [float(len(chunk.text))]
+
+    monkeypatch.setattr(pipeline, "embed_chunks", embed_chunks)
+
+
+def make_pipeline(datastore, **kwargs) -> IngestPipeline:
+    return IngestPipeline(
+        datastore,
+        chunk_token_size=20,
+        document_batch_size=2,
+        embed_batch_size=3,
+        chunk_workers=2,
+        queue_size=1,
+        executor=ThreadPoolExecutor(2),
+        **kwargs,
+    )
+
+
+def make_documents(count: int) -> List[Document]:
+    sentence = "The pipeline splits this sentence into a few chunks of text. "
+    return [Document(id=f"doc-{i}", text=sentence * (i + 1)) for i in range(count)]
+
+
+@pytest.mark.asyncio
+async def test_pipeline_writes_every_chunk():
+    datastore = FakeDataStore()
+    documents = make_documents(7) + [Document(text="Some text without an id to delete.")]
+    done = []
+    ingest = make_pipeline(datastore, on_document_done=done.append)
+
+    doc_ids = await ingest.run(iter(documents))
+
+    assert doc_ids[:7] == [f"doc-{i}" for i in range(7)]
+    assert len(doc_ids) == 8 and doc_ids[7]
+    assert sorted(datastore.deleted) == [f"doc-{i}" for i in range(7)]
+    # the documents of a batch are deleted in a single call
+    assert len(datastore.delete_calls) == 4
+    assert sorted(document.id for document in done) == sorted(doc_ids)
+    for doc_id in doc_ids:
+        chunks = datastore.written[doc_id]
+        assert chunks and all(chunk.embedding for chunk in chunks)
+        assert len({chunk.id for chunk in chunks}) == len(chunks)
+
+    metrics = {name: stage.snapshot() for name, stage in ingest.metrics.items()}
+    assert metrics["extract"]["items"] == 8
+    assert metrics["chunk"]["items"] == 8
+    num_chunks = sum(len(chunks) for chunks in datastore.written.values())
+    assert metrics["embed"]["items"] == num_chunks
+    assert metrics["upsert"]["items"] == num_chunks
+
+
+@pytest.mark.asyncio
+async def test_pipeline_records_stage_metrics_to_the_progress():
+    progress = JobProgress()
+    ingest = make_pipeline(FakeDataStore(), progress=progress)
+
+    await ingest.run(make_documents(3))
+
+    stages = progress.snapshot()["stages"]
+    assert set(stages) == {"extract", "chunk", "embed", "upsert"}
+    assert stages["chunk"]["items"] == 3
+    assert stages["upsert"]["items"] == progress.vectors_written
+
+
+@pytest.mark.asyncio
+async def test_pipeline_chunks_a_batch_in_shards(monkeypatch):
+    shards = []
+    serial_chunk_documents = pipeline.chunk_documents
+
+    def chunk_documents(documents, chunk_token_size):
+        shards.append([document.id for document in documents])
+        return serial_chunk_documents(documents, chunk_token_size)
+
+    monkeypatch.setattr(pipeline, "chunk_documents", chunk_documents)
+    documents = make_documents(2)
+    ingest = make_pipeline(FakeDataStore())
+
+    assert await ingest.run(documents) == ["doc-0", "doc-1"]
+
+    # the two documents of the batch are chunked by the two workers
+    assert sorted(shards) == [["doc-0"], ["doc-1"]]
+
+
+@pytest.mark.asyncio
+async def test_pipeline_reports_empty_documents_as_done():
+    done = []
+    ingest = make_pipeline(FakeDataStore(), on_document_done=done.append)
+    assert await ingest.run([Document(id="empty", text=" ")]) == ["empty"]
+    assert [document.id for document in done] == ["empty"]
+
+
+@pytest.mark.asyncio
+async def test_pipeline_raises_stage_errors():
+    ingest = make_pipeline(FakeDataStore(fail_upsert=True))
+    with pytest.raises(RuntimeError, match="write failed"):
+        await ingest.run(make_documents(20))
+
+
+@pytest.mark.asyncio
+async def test_delete_documents_deletes_by_document_ids_in_one_call():
+    class RecordingDataStore(DataStore):
+        def __init__(self):
+            self.deletes = []
+
+        async def _upsert(self, chunks):
+            return list(chunks)
+
+        async def _query(self, queries):
+            return []
+
+        async def delete(self, ids=None, filter=None, delete_all=None):
+            self.deletes.append(ids)
+            return True
+
+    datastore = RecordingDataStore()
+    assert await datastore.delete_documents(["a", "b"])
+    assert datastore.deletes == [["a", "b"]]
@@ -0,0 +1,30 @@
+import numpy as np
+
+from services.quantization import dequantize_int8, quantize_int8, rescore
+
+
+def test_quantize_int8_round_trips_within_half_a_step():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(100, 64)).astype(np.float32)
+    vectors[5] = 0
+
+    codes, scales = quantize_int8(vectors)
+    assert codes.dtype == np.int8 and scales.dtype == np.float32
+    assert np.abs(codes).max() == 127
+    decoded = dequantize_int8(codes, scales)
+    assert np.all(np.abs(decoded - vectors) <= scales[:, None] / 2 + 1e-6)
+    assert not decoded[5].any()
+
+
+def test_rescore_keeps_the_best_exact_scores():
+    exact = np.array([0.1, 0.9, 0.5, 0.7, 0.3], dtype=np.float32)
+    approximate = np.array([0.2, 0.6, 0.8, 0.7, 0.1], dtype=np.float32)
+    candidates = np.arange(5)
+
+    rows, scores = rescore(candidates, approximate, lambda rows: exact[rows], 2, 3)
+    assert rows.tolist() == [1, 3]
+    assert np.allclose(scores, [0.9, 0.7])
+
+    # only the best approximate candidates are rescored
+    rows, _ = rescore(candidates, approximate, lambda rows: exact[rows], 1, 1)
+    assert rows.tolist() == [2]
@@ -0,0 +1,102 @@
+import json
+
+import pytest
+
+import services.records as records
+from services.records import IngestCheckpoint, iter_json_records, iter_jsonl_records
+
+ITEMS = [
+    {"id": str(i), "text": f"document {i} " + "é" * i, "nested": {"values": [i, i / 2]}}
+    for i in range(25)
+]
+
+
+@pytest.fixture(autouse=True)
+def small_reads(monkeypatch):
+    # read a few bytes at a time, so elements span several reads
+    monkeypatch.setattr(records, "JSON_READ_SIZE", 7)
+
+
+def test_json_records_are_parsed_incrementally(tmp_path):
+    path = tmp_path / "dump.json"
+    path.write_text(" [\n" + ",\n  ".join(json.dumps(item, ensure_ascii=False) for item in ITEMS) + "\n]\n", encoding="utf-8")
+
+    parsed = list(iter_json_records(str(path)))
+    assert [item for item, _ in parsed] == ITEMS
+
+    # resuming at the offset of an element yields the elements after it
+    _, offset = parsed[9]
+    assert [item for item, _ in iter_json_records(str(path), offset)] == ITEMS[10:]
+    assert parsed[-1][1] < path.stat().st_size
+
+
+def test_json_records_of_an_empty_array(tmp_path):
+    path = tmp_path / "dump.json"
+    path.write_text("[ ]")
+    assert list(iter_json_records(str(path))) == []
+
+    path.write_text('{"text": "not an array"}')
+    with pytest.raises(ValueError, match="array"):
+        list(iter_json_records(str(path)))
+
+
+def test_json_records_with_escapes_cut_by_reads(tmp_path):
+    path = tmp_path / "dump.json"
+    path.write_text(json.dumps(ITEMS + [{"text": "\u00e9\\\"\U0001f600"}]))
+    assert [item for item, _ in iter_json_records(str(path))][-1] == {"text": "\u00e9\\\"\U0001f600"}
+
+
+def test_json_records_raise_on_a_malformed_element_without_reading_on(tmp_path, monkeypatch):
+    path = tmp_path / "dump.json"
+    path.write_text('[{"id": "1", "text": oops}, ' + ", ".join(json.dumps(item) for item in ITEMS) + "]")
+
+    read_sizes = []
+
+    class CountingFile:
+        def __init__(self, file):
+            self.file = file
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            self.file.close()
+
+        def seek(self, offset):
+            self.file.seek(offset)
+
+        def read(self, size):
+            data = self.file.read(size)
+            read_sizes.append(len(data))
+            return data
+
+    monkeypatch.setattr(records, "open", lambda *args: CountingFile(open(*args)), raising=False)
+    with pytest.raises(json.JSONDecodeError, match="Expecting value"):
+        list(iter_json_records(str(path)))
+    assert sum(read_sizes) < 40
+
+
+def test_jsonl_records_resume_at_offset(tmp_path):
+    path = tmp_path / "dump.jsonl"
+    path.write_text("\n".join(json.dumps(item, ensure_ascii=False) for item in ITEMS) + "\n\n", encoding="utf-8")
+
+    parsed = list(iter_jsonl_records(str(path)))
+    assert [item for item, _ in parsed] == ITEMS
+    _, offset = parsed[4]
+    assert [item for item, _ in iter_jsonl_records(str(path), offset)] == ITEMS[5:]
+
+
+def test_checkpoint_is_ignored_when_the_file_changes(tmp_path):
+    path = tmp_path / "dump.jsonl"
+    path.write_text('{"text": "a"}\n')
+
+    checkpoint = IngestCheckpoint(str(path))
+    assert checkpoint.offset == 0
+    checkpoint.save(14, 1)
+    assert IngestCheckpoint(str(path)).offset == 14
+
+    path.write_text('{"text": "a"}\n{"text": "b"}\n')
+    assert IngestCheckpoint(str(path)).offset == 0
+
+    checkpoint.clear()
+    assert not (tmp_path / "dump.jsonl.checkpoint").exists()
@@ -0,0 +1,67 @@
+from typing import List
+
+from models.models import DocumentChunkMetadata, DocumentChunkWithScore, QueryResult
+from services.token_budget import CHUNK_OVERHEAD_TOKENS, chunk_tokens, pack_query_results
+
+
+def result(query: str, ids: List[str], token_count: int = 100) -> QueryResult:
+    return QueryResult(
+        query=query,
+        results=[
+            DocumentChunkWithScore(id=id, text=id, score=1.0, token_count=token_count)
+            for id in ids
+        ],
+    )
+
+
+def ids(results: List[QueryResult]) -> List[List[str]]:
+    return [[chunk.id for chunk in result.results] for result in results]
+
+
+def test_no_budget_keeps_every_result():
+    results = [result("a", ["a0", "a1"]), result("b", ["a0", "b1"])]
+    assert ids(pack_query_results(results, 0)) == [["a0", "a1"], ["a0", "b1"]]
+
+
+def test_budget_is_shared_rank_by_rank():
+    cost = 100 + CHUNK_OVERHEAD_TOKENS
+    results = [result("a", ["a0", "a1", "a2"]), result("b", ["b0", "b1", "b2"])]
+
+    packed = pack_query_results(results, 3 * cost + 1)
+
+    # the lowest ranked chunks are left out
+    assert ids(packed) == [["a0", "a1"], ["b0"]]
+
+
+def test_chunks_that_dont_fit_are_skipped():
+    cost = 100 + CHUNK_OVERHEAD_TOKENS
+    results = [result("a", ["a0", "a1", "a2"])]
+    results[0].results[0].token_count = 10_000
+
+    packed = pack_query_results(results, 2 * cost)
+
+    # a large top ranked chunk doesn't leave the response empty
+    assert ids(packed) == [["a1", "a2"]]
+
+
+def test_chunks_returned_by_several_queries_are_kept_once():
+    results = [result("a", ["x", "a1"]), result("b", ["b0", "x", "b2"])]
+
+    packed = pack_query_results(results, 10_000)
+
+    assert ids(packed) == [["x", "a1"], ["b0", "b2"]]
+
+
+def test_chunks_of_the_same_document_are_all_kept():
+    results = [result("a", ["doc-1_0", "doc-1_1", "doc-1_2", "doc-1_3"])]
+    for chunk in results[0].results:
+        chunk.metadata = DocumentChunkMetadata(document_id="doc-1")
+
+    packed = pack_query_results(results, 10_000)
+
+    assert ids(packed) == [["doc-1_0", "doc-1_1", "doc-1_2", "doc-1_3"]]
+
+
+def test_chunks_without_a_token_count_are_counted():
+    chunk = DocumentChunkWithScore(id="a", text="hello world", score=1.0)
+    assert chunk_tokens(chunk) > CHUNK_OVERHEAD_TOKENS